@@ -0,0 +1,265 @@
+"""
+Download di più video con un solo messaggio: più link nello stesso testo oppure,
+con il tag ``PL``, tutti i video di una playlist o di un canale.
+
+Le playlist vengono lette a pagine con ``extract_flat`` in un thread dedicato e i
+video entrano in coda man mano che vengono trovati, senza risolverli tutti prima.
+Ogni batch tiene al massimo ``BATCH_MAX_ACTIVE_JOBS`` job nella coda dei download
+(così una playlist da 500 video non occupa tutti i worker) e ha una sola voce nel
+tracker e un solo messaggio in chat con l'avanzamento complessivo.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from telegram import Bot
+from telegram.error import TelegramError
+
+from . import config
+from .download_queue import DownloadJob, download_queue
+from .downloader import iter_playlist_urls
+from .status_tracker import tracker
+
+logger = logging.getLogger(__name__)
+
+# Stati finali di un job considerati riusciti.
+_SUCCESS_STATUSES = {"inviato", "inviato come documento", "scaricato"}
+# Fine dei link trovati (``None`` indica una playlist che non è stato possibile leggere).
+_END = object()
+
+
+@dataclass
+class Batch:
+    entry_id: int
+    chat_id: int
+    user_id: Optional[int]
+    username: Optional[str]
+    mode: str
+    urls: List[str]
+    expand_playlists: bool
+    status_message_id: Optional[int] = None
+    found: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    expanding: bool = True
+    cancelled: bool = False
+    jobs: Dict[int, DownloadJob] = field(default_factory=dict)
+
+    @property
+    def finished(self) -> int:
+        return self.succeeded + self.failed
+
+    def summary(self) -> str:
+        text = f"{self.finished}/{self.found} completati"
+        if self.failed:
+            text += f", {self.failed} non riusciti"
+        if self.jobs:
+            text += f", {len(self.jobs)} in corso"
+        if self.expanding and self.expand_playlists:
+            text += ", ricerca di altri video"
+        return text
+
+
+class BatchRunner:
+    def __init__(self, max_active_jobs: int = config.BATCH_MAX_ACTIVE_JOBS) -> None:
+        self._max_active = max(1, max_active_jobs)
+        self._batches: Dict[int, Batch] = {}
+        self._slots: Dict[int, asyncio.Semaphore] = {}
+        self._tasks: Dict[int, asyncio.Task[None]] = {}
+        self._last_edit: Dict[int, float] = {}
+        self._edit_tasks: Dict[int, asyncio.Task[None]] = {}
+        self._refresh_tasks: Set[asyncio.Task[None]] = set()
+        self._bot: Optional[Bot] = None
+        download_queue.subscribe_finished(self._on_job_finished)
+
+    def active_batches(self) -> int:
+        return len(self._batches)
+
+    def start(self, batch: Batch, bot: Bot) -> None:
+        """Avvia il batch in background: i job vengono accodati man mano."""
+
+        self._bot = bot
+        self._batches[batch.entry_id] = batch
+        self._slots[batch.entry_id] = asyncio.Semaphore(self._max_active)
+        task = asyncio.create_task(self._run(batch))
+        self._tasks[batch.entry_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(batch.entry_id, None))
+
+    async def cancel(self, entry_id: int) -> bool:
+        """Interrompe la ricerca dei video e annulla i job del batch ancora attivi."""
+
+        batch = self._batches.get(entry_id)
+        if batch is None:
+            return False
+        batch.cancelled = True
+        batch.expanding = False
+        task = self._tasks.get(entry_id)
+        if task is not None:
+            task.cancel()
+        for job_entry_id in list(batch.jobs):
+            await download_queue.cancel(job_entry_id)
+        await self._refresh(batch, final=not batch.jobs)
+        return True
+
+    async def _run(self, batch: Batch) -> None:
+        await tracker.update(batch.entry_id, status="downloading", detail=batch.summary())
+        links = self._links(batch)
+        try:
+            async for link in links:
+                batch.found += 1
+                if link is None:
+                    batch.failed += 1
+                    continue
+                await self._slots[batch.entry_id].acquire()
+                await self._submit(batch, link)
+        except Exception:
+            logger.exception("Errore durante l'espansione del batch %s", batch.entry_id)
+        finally:
+            batch.expanding = False
+            # Ferma subito il thread della playlist anche se il batch è stato annullato.
+            await links.aclose()
+        await self._refresh(batch, final=not batch.jobs)
+
+    async def _links(self, batch: Batch) -> AsyncIterator[Optional[str]]:
+        """Link da scaricare; con ``PL`` vengono letti dalle playlist in un thread, a pagine."""
+
+        if not batch.expand_playlists:
+            for url in batch.urls:
+                yield url
+            return
+        # La coda è corta: il thread legge nuove pagine solo quando i job avanzano.
+        links: "asyncio.Queue[object]" = asyncio.Queue(maxsize=self._max_active)
+        stop = threading.Event()
+        threading.Thread(
+            target=self._expand,
+            args=(batch.urls, links, stop, asyncio.get_running_loop()),
+            name=f"batch-{batch.entry_id}",
+            daemon=True,
+        ).start()
+        try:
+            while True:
+                link = await links.get()
+                if link is _END:
+                    return
+                yield link
+        finally:
+            stop.set()
+            # Sblocca il thread se è fermo sulla coda piena.
+            while not links.empty():
+                links.get_nowait()
+
+    @staticmethod
+    def _expand(
+        urls: List[str],
+        links: "asyncio.Queue[object]",
+        stop: threading.Event,
+        loop: asyncio.AbstractEventLoop,
+    ) -> None:
+        def put(item: object) -> None:
+            asyncio.run_coroutine_threadsafe(links.put(item), loop).result()
+
+        try:
+            for url in urls:
+                try:
+                    for link in iter_playlist_urls(url, config.PLAYLIST_MAX_ENTRIES):
+                        if stop.is_set():
+                            return
+                        put(link)
+                except Exception:
+                    logger.exception("Impossibile leggere la playlist %s", url)
+                    put(None)
+            put(_END)
+        except RuntimeError:
+            pass  # loop chiuso durante l'arresto del bot
+
+    async def _submit(self, batch: Batch, url: str) -> None:
+        entry_id = await tracker.add(
+            url=url,
+            user_id=batch.user_id,
+            username=batch.username,
+            status="in coda",
+            detail=f"Batch #{batch.entry_id}",
+        )
+        job = DownloadJob(
+            entry_id=entry_id,
+            url=url,
+            chat_id=batch.chat_id,
+            user_id=batch.user_id,
+            username=batch.username,
+            mode=batch.mode,
+            batch_id=batch.entry_id,
+        )
+        batch.jobs[entry_id] = job
+        await download_queue.enqueue(job, bot=self._bot)
+        await self._refresh(batch)
+
+    def _on_job_finished(self, job: DownloadJob) -> None:
+        batch = self._batches.get(job.batch_id) if job.batch_id is not None else None
+        if batch is None or batch.jobs.pop(job.entry_id, None) is None:
+            return
+        entry = tracker.get(job.entry_id)
+        if entry is not None and entry.status in _SUCCESS_STATUSES:
+            batch.succeeded += 1
+        else:
+            batch.failed += 1
+        self._slots[batch.entry_id].release()
+        task = asyncio.create_task(self._refresh(batch, final=not batch.expanding and not batch.jobs))
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+
+    async def _refresh(self, batch: Batch, final: bool = False) -> None:
+        """Aggiorna la voce del batch nel tracker e il messaggio in chat (con un limite di frequenza)."""
+
+        if batch.entry_id not in self._batches:
+            return
+        if not final:
+            await tracker.update(batch.entry_id, status="downloading", detail=batch.summary())
+            self._schedule_edit(batch, config.BATCH_PROGRESS_MESSAGE.format(summary=batch.summary()))
+            return
+
+        del self._batches[batch.entry_id]
+        del self._slots[batch.entry_id]
+        self._last_edit.pop(batch.entry_id, None)
+        if batch.cancelled:
+            status = "annullato"
+        elif batch.succeeded or not batch.found:
+            status = "completato"
+        else:
+            status = "errore"
+        await tracker.update(batch.entry_id, status=status, detail=batch.summary())
+        pending = self._edit_tasks.get(batch.entry_id)
+        if pending is not None:
+            # Un aggiornamento in volo non deve sovrascrivere il riepilogo finale.
+            await asyncio.wait([pending])
+        await self._edit(
+            batch,
+            config.BATCH_DONE_MESSAGE.format(
+                succeeded=batch.succeeded, found=batch.found, failed=batch.failed
+            ),
+        )
+
+    def _schedule_edit(self, batch: Batch, text: str) -> None:
+        if batch.status_message_id is None or batch.entry_id in self._edit_tasks:
+            return
+        now = time.monotonic()
+        if now - self._last_edit.get(batch.entry_id, 0.0) < config.PROGRESS_EDIT_INTERVAL_S:
+            return
+        self._last_edit[batch.entry_id] = now
+        task = asyncio.create_task(self._edit(batch, text))
+        self._edit_tasks[batch.entry_id] = task
+        task.add_done_callback(lambda _: self._edit_tasks.pop(batch.entry_id, None))
+
+    async def _edit(self, batch: Batch, text: str) -> None:
+        if self._bot is None or batch.status_message_id is None:
+            return
+        try:
+            await self._bot.edit_message_text(text, chat_id=batch.chat_id, message_id=batch.status_message_id)
+        except TelegramError as exc:
+            logger.debug("Aggiornamento del messaggio del batch %s saltato: %s", batch.entry_id, exc)
+
+
+batch_runner = BatchRunner()
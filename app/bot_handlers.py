@@ -1,27 +1,34 @@
 import re
-from typing import Optional
+from typing import List, Optional, Set
 
 from telegram import Update
 from telegram.ext import ContextTypes
 
 from . import config
+from .batch import Batch, batch_runner
 from .download_queue import DownloadJob, download_queue
 from .status_tracker import tracker
 
 URL_REGEX = re.compile(r"https?://\S+")
 
 
-def extract_url(text: Optional[str]) -> Optional[str]:
+def extract_urls(text: Optional[str]) -> List[str]:
+    """Tutti i link del messaggio, nell'ordine in cui compaiono e senza duplicati."""
+
     if not text:
-        return None
-    match = URL_REGEX.search(text)
-    return match.group(0) if match else None
+        return []
+    return list(dict.fromkeys(URL_REGEX.findall(text)))
+
+
+def _tags(text: str) -> Set[str]:
+    # I link vengono esclusi: un dominio come ``.pl`` non è un tag.
+    return set(re.findall(r"\b[a-z]{2}\b", URL_REGEX.sub(" ", text).lower()))
 
 
 def extract_mode(text: str) -> str:
     """Trova tag opzionali nel testo per controllare il comportamento del job."""
 
-    tokens = set(re.findall(r"\b[a-z]{2}\b", text.lower()))
+    tokens = _tags(text)
     has_upload_only = "uo" in tokens
     has_download_only = "do" in tokens
 
@@ -34,6 +41,12 @@ def extract_mode(text: str) -> str:
     return "standard"
 
 
+def wants_playlist(text: str) -> bool:
+    """Tag ``PL``: scarica tutti i video delle playlist o dei canali indicati."""
+
+    return "pl" in _tags(text)
+
+
 def is_authorized(update: Update) -> bool:
     user = update.effective_user
     return bool(user and user.id in config.ALLOWED_USER_IDS)
@@ -48,6 +61,22 @@ async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text(message)
 
 
+async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_authorized(update):
+        await update.message.reply_text(config.UNAUTHORIZED_MESSAGE)
+        return
+
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text(config.CANCEL_USAGE_MESSAGE)
+        return
+
+    entry_id = int(context.args[0])
+    if await batch_runner.cancel(entry_id) or await download_queue.cancel(entry_id):
+        await update.message.reply_text(config.CANCEL_DONE_MESSAGE.format(entry_id=entry_id))
+    else:
+        await update.message.reply_text(config.CANCEL_NOT_FOUND_MESSAGE.format(entry_id=entry_id))
+
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message:
         return
@@ -60,8 +89,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text(config.ERROR_MESSAGE)
         return
 
-    url = extract_url(update.message.text)
-    if not url:
+    urls = extract_urls(update.message.text)
+    if not urls:
         await update.message.reply_text(config.INVALID_URL_MESSAGE)
         return
 
@@ -70,27 +99,69 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text(config.MODE_CONFLICT_MESSAGE)
         return
 
-    queued_position = download_queue.pending_jobs() + 1
+    expand_playlists = wants_playlist(update.message.text)
+    if len(urls) > 1 or expand_playlists:
+        await start_batch(update, context, urls, mode, expand_playlists)
+        return
+    url = urls[0]
+
     entry_id = await tracker.add(
         url=url,
         user_id=update.effective_user.id if update.effective_user else None,
         username=update.effective_user.username if update.effective_user else None,
         status="in coda",
-        detail=f"In attesa (posizione {queued_position})",
+        detail="In attesa",
     )
-    await download_queue.enqueue(
-        DownloadJob(
-            entry_id=entry_id,
-            url=url,
-            chat_id=update.effective_chat.id if update.effective_chat else 0,
-            user_id=update.effective_user.id if update.effective_user else None,
-            username=update.effective_user.username if update.effective_user else None,
-            mode=mode,
-        ),
-        bot=context.bot,
+    job = DownloadJob(
+        entry_id=entry_id,
+        url=url,
+        chat_id=update.effective_chat.id if update.effective_chat else 0,
+        user_id=update.effective_user.id if update.effective_user else None,
+        username=update.effective_user.username if update.effective_user else None,
+        mode=mode,
     )
+    # Il messaggio di stato esiste prima che il job entri in coda: un job che parte (o
+    # finisce) subito lo trova già e lo modifica con l'avanzamento e l'esito.
+    status_message = await update.message.reply_text(config.DOWNLOADING_MESSAGE)
+    job.status_message_id = status_message.message_id
+    queued_position = await download_queue.enqueue(job, bot=context.bot)
+
+    entry = tracker.get(entry_id)
+    if queued_position > 0 and entry is not None and entry.status == "in coda":
+        await download_queue.show_status(
+            job, f"{config.DOWNLOADING_MESSAGE} (posizione in coda: {queued_position})", edit_only=True
+        )
+
+
+async def start_batch(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    urls: List[str],
+    mode: str,
+    expand_playlists: bool,
+) -> None:
+    """Più link (o playlist con ``PL``) in un solo batch con un unico messaggio di stato."""
 
-    reply_message = config.DOWNLOADING_MESSAGE
-    if queued_position > 1:
-        reply_message = f"{config.DOWNLOADING_MESSAGE} (posizione in coda: {queued_position})"
-    await update.message.reply_text(reply_message)
+    user = update.effective_user
+    entry_id = await tracker.add(
+        url=" ".join(urls),
+        user_id=user.id if user else None,
+        username=user.username if user else None,
+        status="in coda",
+        detail="Batch in avvio",
+    )
+    batch = Batch(
+        entry_id=entry_id,
+        chat_id=update.effective_chat.id,
+        user_id=user.id if user else None,
+        username=user.username if user else None,
+        mode=mode,
+        urls=urls,
+        expand_playlists=expand_playlists,
+    )
+    template = config.PLAYLIST_STARTED_MESSAGE if expand_playlists else config.BATCH_STARTED_MESSAGE
+    status_message = await update.message.reply_text(
+        template.format(count=len(urls), max_active=config.BATCH_MAX_ACTIVE_JOBS, entry_id=entry_id)
+    )
+    batch.status_message_id = status_message.message_id
+    batch_runner.start(batch, context.bot)
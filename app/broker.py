@@ -0,0 +1,451 @@
+"""
+Broker tra il front end (bot e web GUI) e i nodi worker (``APP_ROLE``).
+
+Il broker conserva i job affidati ai worker e un registro di eventi con cui i
+worker rimandano al front end stato, messaggi ed esito dei job. Un worker prende
+un job con ``claim`` e ne ottiene un lease di ``lease_s`` secondi che rinnova con
+``heartbeat``; se il lease scade (worker caduto o irraggiungibile)
+``requeue_expired`` rimette il job in coda per un altro worker.
+
+Due implementazioni con la stessa interfaccia:
+
+- ``SqliteBroker``: un file SQLite (modalità WAL), per nodi sullo stesso host o
+  che condividono un volume locale (non su NFS, dove i lock di SQLite non sono
+  affidabili);
+- ``RedisBroker``: qualsiasi server compatibile con Redis (Redis, Valkey, KeyDB),
+  con il pacchetto ``redis``. Le operazioni che toccano più chiavi sono script
+  Lua, quindi atomiche anche con molti worker.
+
+Stati di un job: ``queued`` → ``running`` → ``done``, oppure ``cancelled`` (annullato
+dal front end) o ``failed`` (lease scaduto troppe volte).
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from . import config
+
+# Eventi più vecchi di così vengono eliminati (il front end li legge in pochi secondi).
+_EVENT_RETENTION_S = 3600
+# Lunghezza massima (approssimativa) dello stream degli eventi su Redis.
+_REDIS_STREAM_MAXLEN = 100_000
+
+# Job il cui lease è scaduto: (job_id, nuovo stato "queued" o "failed", tentativi fatti).
+Expired = List[Tuple[str, str, int]]
+
+
+class SqliteBroker:
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS broker_jobs ("
+                "job_id TEXT PRIMARY KEY, payload TEXT NOT NULL, state TEXT NOT NULL, "
+                "worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "result TEXT, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS broker_jobs_state ON broker_jobs (state, created_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS broker_events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, event TEXT NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _transaction(self, func: Callable[..., Any], *args: Any) -> Any:
+        # BEGIN IMMEDIATE prende subito il lock di scrittura: due worker non possono
+        # prendere lo stesso job anche se girano in processi diversi.
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn, *args)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.to_thread(self._transaction, func, *args)
+
+    @staticmethod
+    def _insert_events(conn: sqlite3.Connection, events: List[dict]) -> None:
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO broker_events (created_at, event) VALUES (?, ?)",
+            [(now, json.dumps(event)) for event in events],
+        )
+
+    async def submit(self, job_id: str, payload: dict) -> None:
+        """Accoda il job; se esiste già (job ripristinato dopo un riavvio) non fa nulla."""
+
+        def submit(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "INSERT OR IGNORE INTO broker_jobs (job_id, payload, state, created_at) VALUES (?, ?, 'queued', ?)",
+                (job_id, json.dumps(payload), time.time()),
+            )
+
+        await self._run(submit)
+
+    async def claim(self, worker: str, lease_s: float) -> Optional[dict]:
+        """Prende il job in coda da più tempo; restituisce il suo payload (``None`` se non ce ne sono)."""
+
+        def claim(conn: sqlite3.Connection) -> Optional[dict]:
+            row = conn.execute(
+                "SELECT job_id, payload FROM broker_jobs WHERE state = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE broker_jobs SET state = 'running', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE job_id = ?",
+                (worker, time.time() + lease_s, row[0]),
+            )
+            return json.loads(row[1])
+
+        return await self._run(claim)
+
+    async def heartbeat(self, job_id: str, worker: str, lease_s: float) -> str:
+        """Rinnova il lease: ``"ok"``, ``"cancelled"`` o ``"lost"`` (il job non è più di ``worker``)."""
+
+        def heartbeat(conn: sqlite3.Connection) -> str:
+            row = conn.execute("SELECT state, worker FROM broker_jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is not None and row[0] == "cancelled":
+                return "cancelled"
+            if row is None or row[0] != "running" or row[1] != worker:
+                return "lost"
+            conn.execute(
+                "UPDATE broker_jobs SET lease_until = ? WHERE job_id = ?", (time.time() + lease_s, job_id)
+            )
+            return "ok"
+
+        return await self._run(heartbeat)
+
+    async def complete(self, job_id: str, worker: str, result: Optional[dict], events: List[dict]) -> bool:
+        """
+        Chiude il job con ``result`` e pubblica ``events`` nella stessa transazione.
+        False (e nessun evento) se il lease non è più di ``worker``.
+        """
+
+        def complete(conn: sqlite3.Connection) -> bool:
+            updated = conn.execute(
+                "UPDATE broker_jobs SET state = 'done', result = ?, lease_until = NULL "
+                "WHERE job_id = ? AND state = 'running' AND worker = ?",
+                (json.dumps(result), job_id, worker),
+            ).rowcount
+            if updated:
+                self._insert_events(conn, events)
+            return bool(updated)
+
+        return await self._run(complete)
+
+    async def cancel(self, job_id: str) -> None:
+        """Annulla il job: se non è ancora stato preso lo elimina, altrimenti lo segnala al worker."""
+
+        def cancel(conn: sqlite3.Connection) -> None:
+            conn.execute("DELETE FROM broker_jobs WHERE job_id = ? AND state = 'queued'", (job_id,))
+            conn.execute(
+                "UPDATE broker_jobs SET state = 'cancelled', lease_until = NULL "
+                "WHERE job_id = ? AND state = 'running'",
+                (job_id,),
+            )
+
+        await self._run(cancel)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        def get(conn: sqlite3.Connection) -> Optional[dict]:
+            row = conn.execute(
+                "SELECT state, attempts, result FROM broker_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            return {"state": row[0], "attempts": row[1], "result": json.loads(row[2]) if row[2] else None}
+
+        return await self._run(get)
+
+    async def ack(self, job_id: str) -> None:
+        """Il front end ha ricevuto l'esito: il job può essere eliminato."""
+
+        await self._run(lambda conn: conn.execute("DELETE FROM broker_jobs WHERE job_id = ?", (job_id,)))
+
+    async def requeue_expired(self, max_attempts: int) -> Expired:
+        """Rimette in coda i job con il lease scaduto, o li chiude dopo ``max_attempts`` tentativi."""
+
+        def requeue(conn: sqlite3.Connection) -> Expired:
+            now = time.time()
+            rows = conn.execute(
+                "SELECT job_id, attempts FROM broker_jobs WHERE state = 'running' AND lease_until < ?", (now,)
+            ).fetchall()
+            expired: Expired = []
+            for job_id, attempts in rows:
+                state = "failed" if attempts >= max_attempts else "queued"
+                conn.execute(
+                    "UPDATE broker_jobs SET state = ?, worker = NULL, lease_until = NULL WHERE job_id = ?",
+                    (state, job_id),
+                )
+                expired.append((job_id, state, attempts))
+            conn.execute("DELETE FROM broker_events WHERE created_at < ?", (now - _EVENT_RETENTION_S,))
+            return expired
+
+        return await self._run(requeue)
+
+    async def publish(self, events: List[dict]) -> None:
+        if events:
+            await self._run(self._insert_events, events)
+
+    async def events(self, cursor: str, limit: int) -> Tuple[List[dict], str]:
+        """Eventi successivi a ``cursor`` in ordine di pubblicazione, e il nuovo cursore."""
+
+        def read(conn: sqlite3.Connection) -> Tuple[List[dict], str]:
+            rows = conn.execute(
+                "SELECT id, event FROM broker_events WHERE id > ? ORDER BY id LIMIT ?", (int(cursor), limit)
+            ).fetchall()
+            return [json.loads(row[1]) for row in rows], str(rows[-1][0]) if rows else cursor
+
+        return await self._run(read)
+
+    async def last_event_id(self) -> str:
+        def last(conn: sqlite3.Connection) -> str:
+            return str(conn.execute("SELECT COALESCE(MAX(id), 0) FROM broker_events").fetchone()[0])
+
+        return await self._run(last)
+
+    async def counts(self) -> Dict[str, int]:
+        """Numero di job per stato."""
+
+        def counts(conn: sqlite3.Connection) -> Dict[str, int]:
+            return dict(conn.execute("SELECT state, COUNT(*) FROM broker_jobs GROUP BY state").fetchall())
+
+        return await self._run(counts)
+
+    async def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# Ora del server Redis (in secondi), così i lease non dipendono dagli orologi dei nodi.
+_LUA_NOW = "local t = redis.call('TIME') local now = tonumber(t[1]) + tonumber(t[2]) / 1000000 "
+
+# Ogni cambio di stato aggiorna anche l'hash dei contatori per stato (vedi ``counts``).
+
+# KEYS: coda, lease, contatori. ARGV: worker, lease_s, prefisso dei job.
+_LUA_CLAIM = _LUA_NOW + """
+local id = redis.call('RPOP', KEYS[1])
+while id do
+    local key = ARGV[3] .. id
+    if redis.call('HGET', key, 'state') == 'queued' then
+        redis.call('HSET', key, 'state', 'running', 'worker', ARGV[1])
+        redis.call('HINCRBY', key, 'attempts', 1)
+        redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), id)
+        redis.call('HINCRBY', KEYS[3], 'queued', -1)
+        redis.call('HINCRBY', KEYS[3], 'running', 1)
+        return redis.call('HGET', key, 'payload')
+    end
+    id = redis.call('RPOP', KEYS[1])
+end
+return false
+"""
+
+# KEYS: job, lease. ARGV: job_id, worker, lease_s.
+_LUA_HEARTBEAT = _LUA_NOW + """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'cancelled' then return 'cancelled' end
+if state ~= 'running' or redis.call('HGET', KEYS[1], 'worker') ~= ARGV[2] then return 'lost' end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[3]), ARGV[1])
+return 'ok'
+"""
+
+# KEYS: job, lease, eventi, contatori. ARGV: job_id, worker, risultato, maxlen, eventi...
+_LUA_COMPLETE = """
+if redis.call('HGET', KEYS[1], 'state') ~= 'running' or redis.call('HGET', KEYS[1], 'worker') ~= ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', 'done', 'result', ARGV[3])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HINCRBY', KEYS[4], 'running', -1)
+redis.call('HINCRBY', KEYS[4], 'done', 1)
+for i = 5, #ARGV do
+    redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[4], '*', 'e', ARGV[i])
+end
+return 1
+"""
+
+# KEYS: job, lease, coda, contatori. ARGV: job_id.
+_LUA_CANCEL = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'queued' then
+    redis.call('DEL', KEYS[1])
+    redis.call('LREM', KEYS[3], 1, ARGV[1])
+    redis.call('HINCRBY', KEYS[4], 'queued', -1)
+elseif state == 'running' then
+    redis.call('HSET', KEYS[1], 'state', 'cancelled')
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('HINCRBY', KEYS[4], 'running', -1)
+    redis.call('HINCRBY', KEYS[4], 'cancelled', 1)
+end
+return 0
+"""
+
+# KEYS: job, contatori.
+_LUA_ACK = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state then
+    redis.call('DEL', KEYS[1])
+    redis.call('HINCRBY', KEYS[2], state, -1)
+end
+return 0
+"""
+
+# KEYS: lease, coda, contatori. ARGV: tentativi massimi, prefisso dei job.
+_LUA_REQUEUE = _LUA_NOW + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now)
+local out = {}
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], id)
+    local key = ARGV[2] .. id
+    if redis.call('HGET', key, 'state') == 'running' then
+        local attempts = tonumber(redis.call('HGET', key, 'attempts'))
+        local state = 'queued'
+        if attempts >= tonumber(ARGV[1]) then
+            state = 'failed'
+        else
+            -- In fondo alla lista da cui legge ``claim``: viene ripreso per primo.
+            redis.call('RPUSH', KEYS[2], id)
+        end
+        redis.call('HSET', key, 'state', state)
+        redis.call('HDEL', key, 'worker')
+        redis.call('HINCRBY', KEYS[3], 'running', -1)
+        redis.call('HINCRBY', KEYS[3], state, 1)
+        table.insert(out, id)
+        table.insert(out, state)
+        table.insert(out, tostring(attempts))
+    end
+end
+return out
+"""
+
+
+class RedisBroker:
+    def __init__(self, url: str, prefix: str = "tgdl:") -> None:
+        try:
+            from redis import asyncio as redis_asyncio
+        except ImportError as exc:
+            raise RuntimeError("BROKER_URL redis:// richiede il pacchetto redis (pip install redis)") from exc
+        self._redis = redis_asyncio.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        self._queue = f"{prefix}queue"
+        self._leases = f"{prefix}leases"
+        self._events = f"{prefix}events"
+        self._counts = f"{prefix}counts"
+        self._claim = self._redis.register_script(_LUA_CLAIM)
+        self._heartbeat = self._redis.register_script(_LUA_HEARTBEAT)
+        self._complete = self._redis.register_script(_LUA_COMPLETE)
+        self._cancel = self._redis.register_script(_LUA_CANCEL)
+        self._ack = self._redis.register_script(_LUA_ACK)
+        self._requeue = self._redis.register_script(_LUA_REQUEUE)
+
+    def _job(self, job_id: str) -> str:
+        return f"{self._prefix}job:{job_id}"
+
+    async def submit(self, job_id: str, payload: dict) -> None:
+        created = await self._redis.hsetnx(self._job(job_id), "payload", json.dumps(payload))
+        if created:
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.hset(self._job(job_id), mapping={"state": "queued", "attempts": 0})
+                pipe.lpush(self._queue, job_id)
+                pipe.hincrby(self._counts, "queued", 1)
+                await pipe.execute()
+
+    async def claim(self, worker: str, lease_s: float) -> Optional[dict]:
+        payload = await self._claim(keys=[self._queue, self._leases, self._counts], args=[worker, lease_s, f"{self._prefix}job:"])
+        return json.loads(payload) if payload else None
+
+    async def heartbeat(self, job_id: str, worker: str, lease_s: float) -> str:
+        return await self._heartbeat(keys=[self._job(job_id), self._leases], args=[job_id, worker, lease_s])
+
+    async def complete(self, job_id: str, worker: str, result: Optional[dict], events: List[dict]) -> bool:
+        done = await self._complete(
+            keys=[self._job(job_id), self._leases, self._events, self._counts],
+            args=[job_id, worker, json.dumps(result), _REDIS_STREAM_MAXLEN, *map(json.dumps, events)],
+        )
+        return bool(done)
+
+    async def cancel(self, job_id: str) -> None:
+        await self._cancel(keys=[self._job(job_id), self._leases, self._queue, self._counts], args=[job_id])
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        fields = await self._redis.hgetall(self._job(job_id))
+        if not fields.get("state"):
+            return None
+        result = fields.get("result")
+        return {
+            "state": fields["state"],
+            "attempts": int(fields.get("attempts", 0)),
+            "result": json.loads(result) if result else None,
+        }
+
+    async def ack(self, job_id: str) -> None:
+        await self._ack(keys=[self._job(job_id), self._counts])
+
+    async def requeue_expired(self, max_attempts: int) -> Expired:
+        flat = await self._requeue(keys=[self._leases, self._queue, self._counts], args=[max_attempts, f"{self._prefix}job:"])
+        return [(flat[i], flat[i + 1], int(flat[i + 2])) for i in range(0, len(flat), 3)]
+
+    async def publish(self, events: List[dict]) -> None:
+        if not events:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for event in events:
+                pipe.xadd(self._events, {"e": json.dumps(event)}, maxlen=_REDIS_STREAM_MAXLEN, approximate=True)
+            await pipe.execute()
+
+    async def events(self, cursor: str, limit: int) -> Tuple[List[dict], str]:
+        streams = await self._redis.xread({self._events: cursor}, count=limit)
+        if not streams:
+            return [], cursor
+        entries = streams[0][1]
+        return [json.loads(fields["e"]) for _, fields in entries], entries[-1][0]
+
+    async def last_event_id(self) -> str:
+        last = await self._redis.xrevrange(self._events, count=1)
+        return last[0][0] if last else "0-0"
+
+    async def counts(self) -> Dict[str, int]:
+        """Numero di job per stato, dai contatori aggiornati a ogni cambio di stato."""
+
+        counts = await self._redis.hgetall(self._counts)
+        return {state: int(count) for state, count in counts.items() if int(count) > 0}
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+Broker = Union[SqliteBroker, RedisBroker]
+
+
+def create_broker(url: str = config.BROKER_URL) -> Broker:
+    """``redis://``/``rediss://`` → ``RedisBroker``; ``sqlite:///percorso`` o vuoto → ``SqliteBroker``."""
+
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url)
+    if url.startswith("sqlite:///"):
+        return SqliteBroker(Path(url[len("sqlite:///"):]))
+    if url:
+        raise ValueError(f"BROKER_URL non supportato: {url}")
+    return SqliteBroker(Path(config.DOWNLOAD_DIR) / ".cache" / "broker.sqlite3")
@@ -0,0 +1,304 @@
+"""
+Scale-out su più nodi (``APP_ROLE``): un front end con il bot e la web GUI e uno o
+più worker che scaricano i video, collegati da un broker (vedi ``broker``).
+
+- ``ClusterFrontend``: i job in coda sul front end vengono affidati ai worker
+  tramite il broker (al massimo ``CLUSTER_MAX_REMOTE_JOBS`` insieme). Il front end
+  legge il registro degli eventi e applica al proprio tracker e ai messaggi in chat
+  stato e avanzamento mandati dai worker; quando arriva l'esito invia il file
+  all'utente. Rimette in coda i job dei worker che hanno smesso di rinnovare il lease.
+- ``ClusterWorker``: prende i job dal broker quando ha posti liberi, li fa passare
+  dalla propria ``DownloadQueue`` (estrazione e download) e rinnova il lease finché
+  sono in lavorazione. Invece di scrivere in chat pubblica eventi per il front end
+  e alla fine consegna il file (percorso condiviso o ``file_id``).
+"""
+
+import asyncio
+import logging
+import os
+import socket
+from typing import Dict, List, Optional, Set
+
+from telegram import Bot
+
+from . import config
+from .broker import Broker
+from .download_queue import DownloadJob, download_queue
+from .metrics import CLUSTER_JOBS
+from .status_tracker import tracker
+
+logger = logging.getLogger(__name__)
+
+# Eventi letti dal broker per richiesta.
+_EVENT_BATCH = 500
+
+
+class ClusterFrontend:
+    def __init__(self, broker: Broker) -> None:
+        self._broker = broker
+        self._jobs: Dict[str, DownloadJob] = {}
+        self._results: Dict[str, "asyncio.Future[Optional[dict]]"] = {}
+        self._tasks: List["asyncio.Task[None]"] = []
+        self._cursor = "0"
+        self.counts: Dict[str, int] = {}
+        CLUSTER_JOBS.set_function(lambda: {(state,): count for state, count in self.counts.items()})
+
+    async def start(self) -> None:
+        """Avvia la lettura degli eventi (da ora in poi) e il controllo dei lease scaduti."""
+
+        self._cursor = await self._broker.last_event_id()
+        self._tasks = [asyncio.create_task(self._consume()), asyncio.create_task(self._reap())]
+
+    async def run(self, job: DownloadJob) -> Optional[dict]:
+        """Affida il job a un worker e ne attende l'esito; ``None`` se fallito o annullato."""
+
+        future: "asyncio.Future[Optional[dict]]" = asyncio.get_running_loop().create_future()
+        self._jobs[job.job_id] = job
+        self._results[job.job_id] = future
+        try:
+            await self._broker.submit(job.job_id, job.to_payload())
+            # Un job ripristinato dopo un riavvio potrebbe essere già stato completato.
+            known = await self._broker.get(job.job_id)
+            if known is not None and known["state"] not in ("queued", "running"):
+                await self._settle(job.job_id, known)
+            return await future
+        finally:
+            self._jobs.pop(job.job_id, None)
+            self._results.pop(job.job_id, None)
+
+    async def cancel(self, job: DownloadJob) -> None:
+        await self._broker.cancel(job.job_id)
+        future = self._results.get(job.job_id)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def _settle(self, job_id: str, record: dict) -> None:
+        future = self._results.get(job_id)
+        if future is not None and not future.done():
+            future.set_result(record.get("result") if record["state"] == "done" else None)
+        await self._broker.ack(job_id)
+
+    async def _consume(self) -> None:
+        while True:
+            try:
+                events, self._cursor = await self._broker.events(self._cursor, _EVENT_BATCH)
+            except Exception:
+                logger.exception("Lettura degli eventi dal broker non riuscita")
+                events = []
+            for event in events:
+                try:
+                    await self._apply(event)
+                except Exception:
+                    logger.exception("Evento del broker non applicato: %s", event.get("type"))
+            if len(events) < _EVENT_BATCH:
+                await asyncio.sleep(config.CLUSTER_POLL_INTERVAL_S)
+
+    async def _apply(self, event: dict) -> None:
+        job = self._jobs.get(event["job_id"])
+        if job is None:
+            return  # job già chiuso (o di un front end precedente)
+        kind = event["type"]
+        if kind == "tracker":
+            entry = tracker.get(job.entry_id)
+            if entry is not None and (entry.status != event["status"] or event["bytes_done"] is None):
+                await tracker.update(job.entry_id, status=event["status"], detail=event["detail"])
+            if event["bytes_done"] is not None:
+                await tracker.set_progress(
+                    job.entry_id,
+                    event["detail"],
+                    event["bytes_done"],
+                    event["bytes_total"],
+                    event["speed_bps"],
+                    event["eta_s"],
+                )
+        elif kind == "notify":
+            await download_queue.show_status(job, event["text"], event["edit_only"])
+        elif kind == "progress":
+            download_queue.show_progress(job, event["text"])
+        elif kind == "finished":
+            await self._settle(job.job_id, {"state": "done", "result": event["result"]})
+
+    async def _reap(self) -> None:
+        while True:
+            await asyncio.sleep(max(config.CLUSTER_LEASE_S / 4, 1))
+            try:
+                expired = await self._broker.requeue_expired(config.CLUSTER_MAX_ATTEMPTS)
+                self.counts = await self._broker.counts()
+            except Exception:
+                logger.exception("Controllo dei lease sul broker non riuscito")
+                continue
+            for job_id, state, attempts in expired:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    continue
+                if state == "failed":
+                    logger.error("Job %s abbandonato dopo %s tentativi sui worker", job.entry_id, attempts)
+                    await tracker.update(
+                        job.entry_id, status="errore", detail=f"Nessun worker lo ha completato ({attempts} tentativi)"
+                    )
+                    await download_queue.show_status(job, config.ERROR_MESSAGE)
+                    await self._settle(job_id, {"state": state})
+                else:
+                    logger.warning("Worker del job %s non raggiungibile: job rimesso in coda", job.entry_id)
+                    await tracker.update(
+                        job.entry_id,
+                        status="in coda",
+                        detail=f"Worker non raggiungibile: nuovo tentativo {attempts + 1}/{config.CLUSTER_MAX_ATTEMPTS}",
+                    )
+
+
+class ClusterWorker:
+    def __init__(self, broker: Broker, node_id: str = config.CLUSTER_NODE_ID) -> None:
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._broker = broker
+        self._slots = asyncio.Semaphore(max(1, config.CLUSTER_WORKER_MAX_JOBS))
+        # Job presi dal broker e ancora validi (per job_id), e job locali ancora in coda.
+        self._jobs: Dict[str, DownloadJob] = {}
+        self._claimed: Set[int] = set()
+        self._remote_ids: Dict[int, str] = {}
+        self._results: Dict[str, dict] = {}
+        self._outbox: List[dict] = []
+        self._version = 0
+        self._publish_lock = asyncio.Lock()
+        self._complete_tasks: Set["asyncio.Task[None]"] = set()
+        self._bot: Optional[Bot] = None
+        download_queue.attach_worker(self)
+        download_queue.subscribe_finished(self._on_job_finished)
+
+    async def run(self, bot: Optional[Bot]) -> None:
+        self._bot = bot
+        logger.info("Worker %s in attesa di job dal broker", self.node_id)
+        await asyncio.gather(self._claim_loop(), self._heartbeat_loop(), self._forward_loop())
+
+    def relay(self, job: DownloadJob, event: dict) -> None:
+        """Messaggio per l'utente o avanzamento da mostrare in chat: lo scrive il front end."""
+
+        if job.job_id in self._jobs:
+            self._outbox.append({**event, "job_id": job.job_id})
+
+    def set_result(self, job: DownloadJob, result: dict) -> None:
+        """Esito da consegnare al front end quando il job esce dalla coda."""
+
+        if job.job_id in self._jobs:
+            self._results[job.job_id] = result
+
+    async def _claim_loop(self) -> None:
+        while True:
+            await self._slots.acquire()
+            payload = None
+            while payload is None:
+                try:
+                    payload = await self._broker.claim(self.node_id, config.CLUSTER_LEASE_S)
+                except Exception:
+                    logger.exception("Richiesta di un job al broker non riuscita")
+                if payload is None:
+                    await asyncio.sleep(config.CLUSTER_POLL_INTERVAL_S)
+            entry_id = await tracker.add(
+                url=payload["url"],
+                user_id=payload["user_id"],
+                username=payload["username"],
+                status="in coda",
+                detail="Ricevuto dal broker",
+            )
+            job = DownloadJob(entry_id=entry_id, **payload)
+            logger.info("Job %s preso dal broker (%s)", entry_id, job.job_id)
+            self._jobs[job.job_id] = job
+            self._claimed.add(entry_id)
+            self._remote_ids[entry_id] = job.job_id
+            await download_queue.enqueue(job, self._bot)
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(max(config.CLUSTER_LEASE_S / 3, 1))
+            for job_id, job in list(self._jobs.items()):
+                try:
+                    state = await self._broker.heartbeat(job_id, self.node_id, config.CLUSTER_LEASE_S)
+                except Exception:
+                    logger.warning("Rinnovo del lease del job %s non riuscito", job.entry_id, exc_info=True)
+                    continue
+                if state == "ok" or job_id not in self._jobs:
+                    continue
+                logger.warning("Job %s %s sul broker: lavorazione interrotta", job.entry_id, state)
+                # Da qui in poi il job non manda più eventi: li gestisce il front end o un altro worker.
+                self._forget(job)
+                await download_queue.cancel(job.entry_id)
+                if state == "cancelled":
+                    try:
+                        await self._broker.ack(job_id)
+                    except Exception:
+                        logger.warning("Eliminazione del job annullato %s non riuscita", job.entry_id, exc_info=True)
+
+    async def _forward_loop(self) -> None:
+        while True:
+            await asyncio.sleep(config.CLUSTER_POLL_INTERVAL_S)
+            async with self._publish_lock:
+                await self._flush()
+
+    async def _flush(self) -> None:
+        """Pubblica i messaggi accumulati e l'ultimo stato delle voci del tracker cambiate."""
+
+        events, self._outbox = self._outbox, []
+        version = tracker.version
+        changed = tracker.changed_since(self._version, tracker.max_entries)
+        if changed is None:
+            # Troppe modifiche da elencare: si ripubblica lo stato di tutte le voci.
+            changed = tracker.query(limit=tracker.max_entries)
+        self._version = version
+        for entry in reversed(changed):
+            job_id = self._remote_ids.get(entry.id)
+            if job_id is None or job_id not in self._jobs:
+                continue
+            events.append(
+                {
+                    "type": "tracker",
+                    "job_id": job_id,
+                    "status": entry.status,
+                    "detail": entry.detail,
+                    "bytes_done": entry.bytes_done,
+                    "bytes_total": entry.bytes_total,
+                    "speed_bps": entry.speed_bps,
+                    "eta_s": entry.eta_s,
+                }
+            )
+        if not events:
+            return
+        try:
+            await self._broker.publish(events)
+        except Exception:
+            logger.exception("Pubblicazione di %s eventi sul broker non riuscita", len(events))
+
+    def _forget(self, job: DownloadJob) -> None:
+        self._jobs.pop(job.job_id, None)
+        self._results.pop(job.job_id, None)
+
+    def _on_job_finished(self, job: DownloadJob) -> None:
+        if job.entry_id not in self._claimed:
+            return
+        self._claimed.discard(job.entry_id)
+        self._slots.release()
+        if job.job_id not in self._jobs:
+            self._remote_ids.pop(job.entry_id, None)
+            return
+        task = asyncio.create_task(self._complete(job))
+        self._complete_tasks.add(task)
+        task.add_done_callback(self._complete_tasks.discard)
+
+    async def _complete(self, job: DownloadJob) -> None:
+        result = self._results.get(job.job_id)
+        async with self._publish_lock:
+            # Prima gli ultimi aggiornamenti del job, poi l'esito: il front end li riceve in ordine.
+            await self._flush()
+            self._forget(job)
+            self._remote_ids.pop(job.entry_id, None)
+            event = {"type": "finished", "job_id": job.job_id, "result": result}
+            try:
+                if await self._broker.complete(job.job_id, self.node_id, result, [event]):
+                    return
+                state = await self._broker.heartbeat(job.job_id, self.node_id, config.CLUSTER_LEASE_S)
+                if state == "cancelled":
+                    await self._broker.ack(job.job_id)
+                else:
+                    logger.warning("Esito del job %s scartato: lease non più valido", job.entry_id)
+            except Exception:
+                # Il lease scadrà e il job verrà ripreso da un altro worker.
+                logger.exception("Consegna dell'esito del job %s al broker non riuscita", job.entry_id)
@@ -14,10 +14,206 @@ LOG_LEVEL = "INFO"
 TELEGRAM_BOT_API_ENABLED = False
 TELEGRAM_BOT_API_BASE_URL = "http://127.0.0.1:8081/bot"
 TELEGRAM_BOT_API_FILE_URL = "http://127.0.0.1:8081/file/bot"
+# Se il server Bot API è avviato con --local e monta la stessa cartella dei download, il bot
+# gli passa solo il percorso del file (file://) invece di trasferirne i byte via HTTP.
+# TELEGRAM_BOT_API_DOWNLOAD_DIR è il percorso di DOWNLOAD_DIR visto dal server Bot API.
+TELEGRAM_BOT_API_LOCAL_MODE = False
+TELEGRAM_BOT_API_DOWNLOAD_DIR = "/downloads"
+# Upload in streaming verso la Bot API self-hosted: dimensione dei blocchi letti dal disco
+# e attesa massima della conferma del server dopo l'invio dell'ultimo byte.
+UPLOAD_CHUNK_SIZE_KB = 1024
+UPLOAD_RESPONSE_TIMEOUT_S = 1800
+
+# Ricezione dei messaggi: di default il bot li chiede a Telegram con il long polling. Con
+# TELEGRAM_WEBHOOK_ENABLED = True è Telegram a inviarli al server della web GUI (stessa
+# porta WEB_APP_PORT, percorso TELEGRAM_WEBHOOK_PATH); TELEGRAM_WEBHOOK_URL è l'indirizzo
+# pubblico HTTPS con cui Telegram raggiunge quel server, es. "https://bot.example.com"
+# dietro un reverse proxy. Ogni richiesta deve portare TELEGRAM_WEBHOOK_SECRET (1-256
+# caratteri tra A-Z, a-z, 0-9, _ e -); vuoto = un segreto casuale generato a ogni avvio.
+# TELEGRAM_WEBHOOK_MAX_CONNECTIONS: richieste che Telegram invia in parallelo (1-100).
+TELEGRAM_WEBHOOK_ENABLED = False
+TELEGRAM_WEBHOOK_URL = ""
+TELEGRAM_WEBHOOK_PATH = "/telegram/webhook"
+TELEGRAM_WEBHOOK_SECRET = ""
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = 40
+# Messaggi elaborati in parallelo, con il webhook e con il long polling
+# (1 = uno alla volta, nell'ordine di arrivo).
+BOT_CONCURRENT_UPDATES = 16
 
 # Controlla se eliminare i file locali dopo l'invio su Telegram
 DELETE_AFTER_SEND = False
 
+# Cache condivisa dei file scaricati: lo stesso video (anche da link con parametri di
+# condivisione diversi) viene scaricato una sola volta in DOWNLOAD_DIR/.cache/media e
+# le cartelle degli utenti contengono solo hardlink verso quella copia.
+MEDIA_CACHE_ENABLED = True
+
+# Cache dei metadati di yt-dlp (extract_info) per URL normalizzato: evita di ripetere
+# l'estrazione per retry o link condivisi. Con INFO_CACHE_PERSIST la cache sopravvive ai
+# riavvii (DOWNLOAD_DIR/.cache/info.sqlite3). Tieni il TTL basso: i link diretti ai
+# formati restituiti dai siti scadono dopo qualche ora.
+INFO_CACHE_MAX_ENTRIES = 500
+INFO_CACHE_TTL_S = 900
+INFO_CACHE_PERSIST = False
+
+# Salva la coda dei job su disco (SQLite in DOWNLOAD_DIR/.cache/jobs.sqlite3) così che
+# i download in coda o in corso riprendano dopo un riavvio del container.
+DURABLE_QUEUE_ENABLED = True
+
+# Pipeline dei job: estrazione info -> download -> invio su Telegram.
+# I job in attesa vengono distribuiti a turno tra gli utenti (una coda FIFO per utente),
+# così nessuno può monopolizzare il bot. Ogni fase ha il proprio numero di worker e le
+# fasi sono collegate da code limitate a PIPELINE_QUEUE_SIZE elementi.
+EXTRACT_WORKERS = 2
+DOWNLOAD_WORKERS = 2
+UPLOAD_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 4
+
+# Scale-out su più macchine. APP_ROLE:
+# - "all": bot, web GUI e download nello stesso processo (default);
+# - "frontend": bot e web GUI; i download vengono affidati ai worker tramite il broker,
+#   al massimo CLUSTER_MAX_REMOTE_JOBS insieme, e l'invio su Telegram resta qui;
+# - "worker": scarica i job presi dal broker (al massimo CLUSTER_WORKER_MAX_JOBS insieme)
+#   e manda stato e avanzamento al front end.
+# BROKER_URL: "redis://host:6379/0" (serve il pacchetto redis) oppure "sqlite:///percorso"
+# su un disco condiviso; vuoto = SQLite in DOWNLOAD_DIR/.cache/broker.sqlite3. Un worker
+# rinnova il lease dei suoi job ogni CLUSTER_LEASE_S/3 secondi: se smette, il job torna in
+# coda per un altro worker, al massimo CLUSTER_MAX_ATTEMPTS volte. Con
+# CLUSTER_SHARED_STORAGE i nodi condividono DOWNLOAD_DIR e il worker consegna il percorso
+# del file; altrimenti lo carica nella chat CLUSTER_STORAGE_CHAT_ID (un canale privato
+# dove il bot può scrivere) e il front end lo invia all'utente tramite file_id.
+# CLUSTER_NODE_ID vuoto = nome host e PID.
+APP_ROLE = "all"
+BROKER_URL = ""
+CLUSTER_NODE_ID = ""
+CLUSTER_MAX_REMOTE_JOBS = 16
+CLUSTER_WORKER_MAX_JOBS = 4
+CLUSTER_LEASE_S = 60
+CLUSTER_MAX_ATTEMPTS = 3
+CLUSTER_POLL_INTERVAL_S = 0.5
+CLUSTER_SHARED_STORAGE = True
+CLUSTER_STORAGE_CHAT_ID = 0
+
+# Dove eseguire yt-dlp: "thread" (executor di default) oppure "process" (pool di processi
+# figli già inizializzati, utile quando yt-dlp rallenta il bot e la web GUI).
+# Con "process" un job bloccato viene terminato dopo PROCESS_JOB_TIMEOUT_S secondi
+# (0 = nessun limite) e può essere annullato con /cancel <id>.
+EXECUTION_BACKEND = "thread"
+PROCESS_POOL_WORKERS = 2
+PROCESS_JOB_TIMEOUT_S = 3600
+# yt-dlp viene caricato al primo job, non all'avvio del bot. YTDLP_EXTRACTORS limita gli
+# estrattori registrati ai nomi indicati (anche espressioni regolari), es.
+# ["youtube.*", "instagram.*", "tiktok.*", "twitter", "generic"]: riconoscere un link costa
+# molto meno tempo e memoria, ma i siti non elencati non sono più supportati ("generic"
+# serve per i link diretti ai file). Vuoto = tutti gli estrattori di yt-dlp.
+YTDLP_EXTRACTORS = []
+
+# Se il video alla qualità migliore supera il limite di invio, prima di scaricare viene
+# scelta la coppia video+audio di qualità più alta che ci sta (in base alle dimensioni
+# indicate dal sito). Se nessun formato ci sta e TRANSCODE_TO_FIT_ENABLED è attivo, il
+# video viene ricodificato con ffmpeg a un bitrate calcolato dalla durata e inviato mentre
+# viene prodotto. La ricodifica è pesante per la CPU: al massimo TRANSCODE_WORKERS alla
+# volta, e mai sotto TRANSCODE_MIN_VIDEO_KBPS di bitrate video.
+FORMAT_PLANNER_ENABLED = True
+TRANSCODE_TO_FIT_ENABLED = False
+TRANSCODE_WORKERS = 1
+TRANSCODE_PRESET = "veryfast"
+TRANSCODE_AUDIO_KBPS = 128
+TRANSCODE_MIN_VIDEO_KBPS = 200
+
+# Ordine dei job in attesa:
+# - "fair": a turno tra gli utenti, in ordine di arrivo per ogni utente;
+# - "priority": prima le classi di priorità più alte (0 = la più alta) e, nella stessa
+#   classe, prima i video più piccoli. La classe di un job è la somma di quella
+#   dell'utente (PRIORITY_USER_CLASSES, id Telegram -> classe) e di quella della modalità
+#   (PRIORITY_MODE_CLASSES). La dimensione viene stimata con un extract_info anticipato
+#   (al massimo PREFLIGHT_WORKERS insieme, il risultato resta nella cache dei metadati);
+#   finché non è nota vale SCHEDULING_UNKNOWN_SIZE_MB. Ogni classe pesa come
+#   PRIORITY_CLASS_WEIGHT_MB MB e ogni minuto di attesa toglie SCHEDULING_AGING_MB_PER_MIN
+#   MB, così anche un video grande o di classe bassa prima o poi passa davanti.
+SCHEDULING_POLICY = "fair"
+PRIORITY_USER_CLASSES = {}
+PRIORITY_MODE_CLASSES = {"download_only": 1}
+PRIORITY_CLASS_WEIGHT_MB = 2048
+SCHEDULING_AGING_MB_PER_MIN = 100
+SCHEDULING_UNKNOWN_SIZE_MB = 100
+PREFLIGHT_WORKERS = 2
+
+# Più link nello stesso messaggio vengono scaricati come un unico batch; con il tag PL
+# ogni link di playlist o canale viene espanso in tutti i suoi video (al massimo
+# PLAYLIST_MAX_ENTRIES, 0 = nessun limite). La playlist viene letta a pagine man mano che i
+# video entrano in coda e ogni batch ha al massimo BATCH_MAX_ACTIVE_JOBS job in coda o in
+# lavorazione insieme, così non occupa tutti i worker a scapito degli altri utenti.
+BATCH_MAX_ACTIVE_JOBS = 3
+PLAYLIST_MAX_ENTRIES = 500
+
+# Download accelerato per i video grandi: se la dimensione stimata supera
+# ACCELERATED_MIN_SIZE_MB, yt-dlp scarica i frammenti DASH/HLS su più connessioni e, se
+# aria2c è installato (lo è nell'immagine Docker), i file progressivi a intervalli di byte
+# in parallelo. Ogni download usa al massimo CONNECTIONS_PER_DOWNLOAD connessioni e tutti
+# i download insieme al massimo HOST_MAX_CONNECTIONS verso lo stesso host.
+ACCELERATED_DOWNLOAD_ENABLED = True
+ACCELERATED_MIN_SIZE_MB = 100
+CONNECTIONS_PER_DOWNLOAD = 8
+HOST_MAX_CONNECTIONS = 16
+ARIA2C_ENABLED = True
+
+# Limite alle richieste verso i siti (estrazione delle info e avvio dei download), comune a
+# tutti i worker: RATE_LIMIT_PER_MIN al minuto per sito (RATE_LIMIT_HOST_PER_MIN per
+# quelli indicati), con raffiche fino a RATE_LIMIT_BURST, e RATE_LIMIT_GLOBAL_PER_MIN in
+# totale (0 = nessun limite globale). Se un sito risponde 429 o chiede di confermare di non
+# essere un bot, la sua velocità viene dimezzata e le richieste verso di lui si fermano per
+# RATE_LIMIT_BACKOFF_S secondi, raddoppiati a ogni errore consecutivo fino a
+# RATE_LIMIT_MAX_BACKOFF_S (con una variazione casuale); ogni richiesta riuscita la fa
+# risalire gradualmente. Il job torna in coda alla fine della pausa, al massimo
+# RATE_LIMIT_MAX_RETRIES volte. Un download rifiutato con 403 viene ritentato una sola volta
+# rileggendo i metadati dal sito.
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_PER_MIN = 20
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_HOST_PER_MIN = {"instagram.com": 6}
+RATE_LIMIT_GLOBAL_PER_MIN = 60
+RATE_LIMIT_BACKOFF_S = 30
+RATE_LIMIT_MAX_BACKOFF_S = 600
+RATE_LIMIT_MAX_RETRIES = 3
+
+# Come vengono uniti video e audio scaricati separatamente (bestvideo+bestaudio):
+# - "default": yt-dlp scarica le due tracce su disco e poi ffmpeg le unisce in un nuovo
+#   file, quindi ogni video viene scritto due volte;
+# - "ffmpeg": un solo processo ffmpeg legge le due tracce dalla rete e scrive direttamente
+#   il file finale (una sola scrittura, ma niente avanzamento durante il download, niente
+#   ripresa dei download interrotti e niente aria2c);
+# - "tempdir": tracce e merge vengono scritti in MERGE_TEMP_DIR e solo il file finale
+#   viene spostato in DOWNLOAD_DIR. Se MERGE_TEMP_DIR è un tmpfs (es. --tmpfs in Docker,
+#   con RAM per il doppio del video più grande) sul disco arriva una sola scrittura; sullo
+#   stesso filesystem (default: DOWNLOAD_DIR/.cache/tmp) lo spostamento è una rename.
+MERGE_MODE = "default"
+MERGE_TEMP_DIR = ""
+
+# Spazio su disco in DOWNLOAD_DIR. Quote in MB (0 = nessun limite), in totale e per ogni
+# utente: oltre la quota vengono eliminati in background i file usati meno di recente
+# ("lru") o meno spesso ("lfu"), mai quelli di job ancora in lavorazione. Servono quando
+# DELETE_AFTER_SEND = False, altrimenti i file vengono già eliminati dopo l'invio.
+STORAGE_MAX_TOTAL_MB = 0
+STORAGE_MAX_PER_USER_MB = 0
+STORAGE_EVICTION_POLICY = "lru"
+# Prima di ogni download viene riservata la dimensione stimata (il doppio se video e audio
+# vanno uniti su disco, vedi MERGE_MODE; STORAGE_UNKNOWN_SIZE_MB se il sito non la
+# indica) lasciando sempre liberi STORAGE_MIN_FREE_MB. Se lo spazio non basta il job
+# attende al massimo STORAGE_RESERVE_TIMEOUT_S secondi. La cartella viene riletta ogni
+# STORAGE_SCAN_INTERVAL_S secondi per accorgersi dei file aggiunti o rimossi a mano.
+STORAGE_MIN_FREE_MB = 1024
+STORAGE_UNKNOWN_SIZE_MB = 500
+STORAGE_RESERVE_TIMEOUT_S = 600
+STORAGE_SCAN_INTERVAL_S = 300
+
+# Avanzamento in tempo reale: il tracker e la web GUI ricevono al massimo un
+# aggiornamento ogni PROGRESS_UPDATE_INTERVAL_S secondi per job, mentre il messaggio di
+# stato in chat viene modificato al massimo ogni PROGRESS_EDIT_INTERVAL_S secondi
+# (Telegram limita le modifiche ai messaggi).
+PROGRESS_UPDATE_INTERVAL_S = 0.5
+PROGRESS_EDIT_INTERVAL_S = 5
+
 # Solo gli ID Telegram indicati qui possono usare il bot (whitelist forte)
 # Puoi ottenere il tuo ID tramite @userinfobot o simili.
 ALLOWED_USER_IDS = [123456789]
@@ -25,7 +221,10 @@ ALLOWED_USER_IDS = [123456789]
 # Configurazione web GUI locale
 WEB_APP_HOST = "0.0.0.0"
 WEB_APP_PORT = 12000
+# Numero di record di log conservati in memoria per la web GUI e per /api/logs.
 LOG_BUFFER_LIMIT = 200
+# Numero di download conservati nello storico della web GUI (le voci più vecchie vengono scartate).
+TRACKER_HISTORY_LIMIT = 20000
 
 WELCOME_MESSAGE = (
     "👋 Ciao! Inviami un link YouTube/Instagram/TikTok ecc. "
@@ -67,6 +266,36 @@ DOWNLOAD_ONLY_MESSAGE = (
     "✅ Download completato (solo download). File '{filename}' salvato (~{size_mb:.1f} MB{reuse_note})."
 )
 
+CANCEL_USAGE_MESSAGE = "Uso: /cancel <id del download> (lo trovi nella web GUI)."
+CANCEL_DONE_MESSAGE = "🛑 Download {entry_id} annullato."
+CANCEL_NOT_FOUND_MESSAGE = "Nessun download attivo o in coda con id {entry_id}."
+JOB_RESUMED_MESSAGE = "🔄 Il bot è stato riavviato: riprendo il download di {url}"
+JOB_CANCELLED_MESSAGE = "🛑 Il download è stato annullato."
+DOWNLOAD_PROGRESS_MESSAGE = "⬇️ Download in corso: {progress}"
+UPLOAD_PROGRESS_MESSAGE = "⬆️ Invio su Telegram: {progress}"
+SENT_STATUS_MESSAGE = "✅ Video inviato."
+FORMAT_PLANNED_MESSAGE = (
+    "📉 Alla qualità massima il video supera il limite di {max_mb} MB: "
+    "scarico la versione {label} (circa {size_mb:.0f} MB)."
+)
+TRANSCODING_MESSAGE = (
+    "🎞️ Il video supera il limite di {max_mb} MB: lo ricodifico a qualità ridotta per poterlo inviare."
+)
+STORAGE_FULL_MESSAGE = (
+    "❌ Spazio su disco insufficiente per scaricare il video. Riprova più tardi."
+)
+
+BATCH_STARTED_MESSAGE = (
+    "📚 Ho ricevuto {count} link: li scarico {max_active} alla volta. "
+    "Per annullarli tutti: /cancel {entry_id}"
+)
+PLAYLIST_STARTED_MESSAGE = (
+    "📚 Leggo la playlist e scarico i video {max_active} alla volta. "
+    "Per annullare: /cancel {entry_id}"
+)
+BATCH_PROGRESS_MESSAGE = "📚 Batch in corso: {summary}."
+BATCH_DONE_MESSAGE = "✅ Batch terminato: {succeeded}/{found} video completati, {failed} non riusciti."
+
 MODE_CONFLICT_MESSAGE = (
     "Per favore usa un solo tag opzionale: UO (upload only) oppure DO (download only)."
 )
@@ -1,14 +1,60 @@
 import asyncio
 import logging
-from dataclasses import dataclass
-from typing import Optional
+import time
+import uuid
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
-from telegram import Bot
-from telegram.error import TimedOut
+from telegram import Bot, Message
+from telegram.error import BadRequest, TelegramError, TimedOut
 
 from . import config
-from .downloader import DownloadOutcome, cleanup_file, download_video, file_size_mb
+from .downloader import (
+    DEFAULT_FORMAT,
+    DownloadOutcome,
+    RateLimited,
+    cleanup_file,
+    download_video,
+    extract_size_mb,
+    extract_video_info,
+    file_size_mb,
+    is_forbidden,
+    is_rate_limited,
+    resolve_target_dir,
+)
+from .executor_backend import JobCancelled, execution_backend
+from .format_planner import FormatPlan, apply_plan, plan_format
+from .hosts import host_connections, media_hosts, rate_limiter
+from .info_cache import info_cache
+from .job_store import job_store
+from .logging_utils import current_job_id
+from .media_cache import CachedMedia, link_file, media_cache
+from .metrics import (
+    CACHE_REQUESTS,
+    DOWNLOAD_SECONDS,
+    DOWNLOAD_THROUGHPUT,
+    EXTRACT_INFO_SECONDS,
+    POSTPROCESS_SECONDS,
+    QUEUE_PENDING,
+    QUEUE_WAIT_SECONDS,
+    STAGE_BUSY_WORKERS,
+    STAGE_QUEUE_DEPTH,
+    STAGE_SECONDS,
+    UPLOAD_SECONDS,
+    WORKER_BUSY_SECONDS,
+)
+from .progress import format_progress, progress_channel
+from .scheduling import PriorityScheduler, ScoredQueue, create_scheduler
 from .status_tracker import tracker
+from .storage import StorageFull, storage
+from .telegram_files import TelegramFile, content_key, telegram_files
+from .transcoder import TranscodePlan, transcoder
+from .uploader import ProgressCallback, UploadUnconfirmed, local_api_uploader
+from .url_utils import normalize_url, url_host
+
+if TYPE_CHECKING:
+    from .cluster import ClusterFrontend, ClusterWorker
 
 logger = logging.getLogger(__name__)
 
@@ -21,56 +67,771 @@ class DownloadJob:
     user_id: Optional[int]
     username: Optional[str]
     mode: str = "standard"
+    coalesced_with: Optional[int] = None
+    batch_id: Optional[int] = None
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status_message_id: Optional[int] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+    def to_payload(self) -> dict:
+        """Campi da salvare per ricreare il job dopo un riavvio."""
+
+        return {
+            "job_id": self.job_id,
+            "url": self.url,
+            "chat_id": self.chat_id,
+            "user_id": self.user_id,
+            "username": self.username,
+            "mode": self.mode,
+        }
+
+
+@dataclass
+class _StagedJob:
+    """Stato di un job mentre attraversa le fasi della pipeline."""
+
+    job: DownloadJob
+    info: Optional[dict] = None
+    outcome: Optional[DownloadOutcome] = None
+    format: str = DEFAULT_FORMAT
+    transcode: Optional[TranscodePlan] = None
+
+
+@dataclass
+class _Flight:
+    """Download in corso a cui si agganciano i job con lo stesso link e modalità."""
+
+    leader: DownloadJob
+    key: Tuple[str, str]
+    followers: List[DownloadJob] = field(default_factory=list)
+
+
+class _RetryLater(Exception):
+    """Il sito ha rifiutato il job (o è in pausa): il job torna in coda dopo ``delay_s`` secondi."""
+
+    def __init__(self, delay_s: float, detail: str) -> None:
+        super().__init__(detail)
+        self.delay_s = delay_s
+        self.detail = detail
+
+
+StageHandler = Callable[[_StagedJob], Awaitable[Optional[_StagedJob]]]
 
 
 class DownloadQueue:
-    def __init__(self) -> None:
-        self._queue: asyncio.Queue[DownloadJob] = asyncio.Queue()
-        self._worker_task: Optional[asyncio.Task[None]] = None
+    """
+    Coda dei download organizzata come pipeline a tre fasi.
+
+    I job in attesa sono ordinati dallo scheduler (vedi ``scheduling``): di default
+    a turno tra gli utenti, così un utente con tanti job pesanti non blocca i link
+    degli altri, oppure per priorità e dimensione stimata. I job passano poi alla
+    fase di download e a quella di invio tramite code limitate: mentre il job N
+    viene caricato su Telegram, il job N+1 è già in download.
+    """
+
+    def __init__(
+        self,
+        extract_workers: int = config.EXTRACT_WORKERS,
+        download_workers: int = config.DOWNLOAD_WORKERS,
+        upload_workers: int = config.UPLOAD_WORKERS,
+        stage_queue_size: int = config.PIPELINE_QUEUE_SIZE,
+    ) -> None:
+        self._stage_workers = {
+            "extract": max(1, extract_workers),
+            "download": max(1, download_workers),
+            "upload": max(1, upload_workers),
+        }
+        self._scheduler = create_scheduler()
+        self._available = asyncio.Semaphore(0)
+        self._to_download = self._stage_queue(stage_queue_size)
+        self._to_upload = self._stage_queue(stage_queue_size)
+        self._busy = {stage: 0 for stage in self._stage_workers}
+        self._idle_workers = 0
+        self._in_flight_jobs: Dict[int, DownloadJob] = {}
+        self._cancelled: Set[int] = set()
+        self._flights: Dict[Tuple[str, str], _Flight] = {}
+        self._flights_by_leader: Dict[int, _Flight] = {}
+        self._follower_tasks: Set[asyncio.Task[None]] = set()
+        # Job rifiutati dal sito in attesa di tornare in coda, con i tentativi già fatti.
+        self._deferred: Dict[int, Tuple[DownloadJob, asyncio.Task[None]]] = {}
+        self._rate_retries: Dict[int, int] = {}
+        self._forbidden_retried: Set[int] = set()
+        self._preflight_slots = asyncio.Semaphore(max(1, config.PREFLIGHT_WORKERS))
+        self._preflight_tasks: Dict[int, asyncio.Task[None]] = {}
+        self._worker_tasks: List[asyncio.Task[None]] = []
+        self._progress_phase: Dict[int, str] = {}
+        self._last_edit: Dict[int, float] = {}
+        self._edit_tasks: Dict[int, asyncio.Task[None]] = {}
         self._bot: Optional[Bot] = None
+        self._finish_listeners: List[Callable[[DownloadJob], None]] = []
+        self._frontend: Optional["ClusterFrontend"] = None
+        self._worker: Optional["ClusterWorker"] = None
+        progress_channel.subscribe(self._on_progress)
+
+    def _stage_queue(self, maxsize: int) -> "asyncio.Queue[_StagedJob]":
+        """Code tra le fasi: con lo scheduler a priorità anche qui passa prima il job più leggero."""
+
+        scheduler = self._scheduler
+        if isinstance(scheduler, PriorityScheduler):
+            return ScoredQueue(maxsize, lambda item: scheduler.score(item.job, _staged_size_mb(item)))
+        return asyncio.Queue(maxsize=maxsize)
+
+    def subscribe_finished(self, callback: Callable[[DownloadJob], None]) -> None:
+        """Registra ``callback``, chiamata quando un job esce dalla coda (con qualsiasi esito)."""
+
+        self._finish_listeners.append(callback)
+
+    def attach_frontend(self, frontend: "ClusterFrontend") -> None:
+        """
+        Nodo front end: la fase di estrazione affida i job ai worker tramite il broker
+        (fino a ``CLUSTER_MAX_REMOTE_JOBS`` insieme) e qui resta solo l'invio.
+        """
+
+        self._frontend = frontend
+        self._stage_workers["extract"] = max(1, config.CLUSTER_MAX_REMOTE_JOBS)
+
+    def attach_worker(self, worker: "ClusterWorker") -> None:
+        """Nodo worker: messaggi e file vanno al front end invece che in chat."""
+
+        self._worker = worker
 
     def pending_jobs(self) -> int:
-        return self._queue.qsize()
+        return len(self._scheduler)
+
+    def active_jobs(self) -> int:
+        return sum(self._busy.values())
+
+    def stage_depths(self) -> Dict[str, int]:
+        """Job in attesa tra una fase e la successiva."""
+
+        return {"download": self._to_download.qsize(), "upload": self._to_upload.qsize()}
+
+    def busy_workers(self) -> Dict[str, int]:
+        """Worker occupati per fase."""
+
+        return dict(self._busy)
+
+    async def enqueue(self, job: DownloadJob, bot: Bot) -> int:
+        """
+        Accoda il job e restituisce la sua posizione nella coda di attesa
+        (0 se un worker libero lo prenderà subito).
+        """
 
-    async def enqueue(self, job: DownloadJob, bot: Bot) -> None:
-        await self._queue.put(job)
         if not self._bot:
             self._bot = bot
-        await self._ensure_worker()
+        job_store.add(job.job_id, job.to_payload())
+
+        # Sul front end il download avviene sui worker: niente accorpamento né stime qui.
+        local = self._frontend is None
+        flight_key = (normalize_url(job.url), job.mode)
+        flight = self._flights.get(flight_key)
+        if flight is not None:
+            job.coalesced_with = flight.leader.entry_id
+            flight.followers.append(job)
+            self._in_flight_jobs[job.entry_id] = job
+            await tracker.update(
+                job.entry_id,
+                status="in coda",
+                detail=f"Unito al job #{flight.leader.entry_id} (stesso link)",
+            )
+            return 0
+        if local:
+            flight = _Flight(leader=job, key=flight_key)
+            self._flights[flight_key] = flight
+            self._flights_by_leader[job.entry_id] = flight
+
+        prioritized = local and config.SCHEDULING_POLICY == "priority"
+        size_mb = _cached_size_mb(job) if prioritized else None
+        order = self._scheduler.push(job, size_mb)
+
+        self._ensure_workers()
+        position = max(order - self._idle_workers, 0)
+        detail = f"In attesa (posizione {position})" if position else "In avvio"
+        await tracker.update(job.entry_id, status="in coda", detail=detail)
+        self._available.release()
+        if prioritized and size_mb is None and position:
+            task = asyncio.create_task(self._preflight(job))
+            self._preflight_tasks[job.entry_id] = task
+            task.add_done_callback(lambda _: self._preflight_tasks.pop(job.entry_id, None))
+        return position
+
+    async def _preflight(self, job: DownloadJob) -> None:
+        """
+        Stima la dimensione di un job in attesa con un ``extract_info`` anticipato e lo
+        ricolloca in coda. Il risultato resta nella cache dei metadati, quindi la fase di
+        estrazione non lo ripete.
+        """
 
-    async def _ensure_worker(self) -> None:
-        if self._worker_task and not self._worker_task.done():
+        current_job_id.set(job.entry_id)
+        async with self._preflight_slots:
+            if job.entry_id not in self._scheduler:
+                return  # già partito o annullato
+            info = info_cache.get(job.url)
+            if info is None:
+                host = url_host(job.url)
+                if config.RATE_LIMIT_ENABLED:
+                    if rate_limiter.backoff_s(host) > 0:
+                        return  # sito in pausa: la stima può aspettare l'estrazione
+                    await rate_limiter.acquire(host)
+                try:
+                    with EXTRACT_INFO_SECONDS.time():
+                        info = await execution_backend.run(
+                            ("preflight", job.entry_id),
+                            extract_video_info,
+                            job.url,
+                            config.DOWNLOAD_DIR,
+                            job.user_id,
+                            job.username,
+                        )
+                except RateLimited:
+                    # Niente nuovi tentativi: la stima è facoltativa, l'estrazione la rifarà.
+                    rate_limiter.record(host, limited=True)
+                    return
+                except Exception:
+                    logger.warning("Stima preliminare del job %s non riuscita", job.entry_id, exc_info=True)
+                    return
+                rate_limiter.record(host, limited=False)
+                if info is None:
+                    return
+                info_cache.put(job.url, info)
+            position = self._scheduler.update_estimate(job.entry_id, extract_size_mb(info))
+        if position is not None:
+            position = max(position - self._idle_workers, 0)
+            detail = f"In attesa (posizione {position})" if position else "In avvio"
+            await tracker.update(job.entry_id, status="in coda", detail=detail)
+
+    async def restore(self, bot: Bot) -> int:
+        """
+        Rimette in coda i job interrotti dall'ultimo arresto. yt-dlp riprende gli
+        eventuali file ``.part`` già scaricati invece di ricominciare da zero.
+        """
+
+        payloads = job_store.unfinished()
+        for payload in payloads:
+            entry_id = await tracker.add(
+                url=payload["url"],
+                user_id=payload["user_id"],
+                username=payload["username"],
+                status="in coda",
+                detail="Ripristinato dopo il riavvio",
+            )
+            job = DownloadJob(entry_id=entry_id, **payload)
+            try:
+                message = await bot.send_message(
+                    chat_id=job.chat_id, text=config.JOB_RESUMED_MESSAGE.format(url=job.url)
+                )
+                job.status_message_id = message.message_id
+            except Exception:
+                logger.exception("Impossibile avvisare la chat %s del job ripristinato", job.chat_id)
+            await self.enqueue(job, bot)
+        if payloads:
+            logger.info("Ripristinati %s job dalla coda persistente", len(payloads))
+        return len(payloads)
+
+    async def cancel(self, entry_id: int) -> bool:
+        """
+        Annulla un job in attesa o in lavorazione. Se yt-dlp gira nel backend a processi
+        il processo figlio viene terminato. Restituisce False se il job non è attivo.
+        """
+
+        preflight = self._preflight_tasks.pop(entry_id, None)
+        if preflight is not None:
+            # Libera il posto di PREFLIGHT_WORKERS; con il backend a processi il figlio
+            # ancora occupato nell'estrazione viene terminato e sostituito.
+            preflight.cancel()
+        job = self._scheduler.remove(entry_id)
+        if job is None and entry_id in self._deferred:
+            job, waiting = self._deferred.pop(entry_id)
+            waiting.cancel()
+        if job is not None:
+            self._finish(job, cancelled=True)
+        else:
+            job = self._in_flight_jobs.get(entry_id)
+        if job is None:
+            return False
+        if entry_id in self._in_flight_jobs:
+            self._cancelled.add(entry_id)
+            execution_backend.cancel(entry_id)
+            if self._frontend is not None:
+                await self._frontend.cancel(job)
+        await tracker.update(entry_id, status="annullato", detail="Annullato dall'utente")
+        if self._bot:
+            await self._notify(job, config.JOB_CANCELLED_MESSAGE)
+        return True
+
+    def _ensure_workers(self) -> None:
+        if any(not task.done() for task in self._worker_tasks):
             return
-        self._worker_task = asyncio.create_task(self._worker())
+        self._worker_tasks = []
+        for index in range(self._stage_workers["extract"]):
+            self._worker_tasks.append(asyncio.create_task(self._extract_worker(index)))
+        self._idle_workers = self._stage_workers["extract"]
+        for index in range(self._stage_workers["download"]):
+            self._worker_tasks.append(
+                asyncio.create_task(
+                    self._stage_worker(
+                        "download", index, self._to_download, self._download, self._to_upload
+                    )
+                )
+            )
+        for index in range(self._stage_workers["upload"]):
+            self._worker_tasks.append(
+                asyncio.create_task(
+                    self._stage_worker("upload", index, self._to_upload, self._upload, None)
+                )
+            )
+
+    @staticmethod
+    def _record_busy(stage: str, worker: int, started: float) -> None:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        WORKER_BUSY_SECONDS.inc(elapsed, stage=stage, worker=str(worker))
 
-    async def _worker(self) -> None:
+    async def _extract_worker(self, worker: int) -> None:
         while True:
-            job = await self._queue.get()
             try:
-                await self._process_job(job)
+                await self._available.acquire()
+            finally:
+                self._idle_workers -= 1
+            job = self._scheduler.pop()
+            if job is None:
+                # Permesso rimasto da un job annullato prima di essere servito.
+                self._idle_workers += 1
+                continue
+            QUEUE_WAIT_SECONDS.observe(time.monotonic() - job.enqueued_at)
+            log_context = current_job_id.set(job.entry_id)
+            self._in_flight_jobs[job.entry_id] = job
+            job_store.mark_running(job.job_id)
+            item: Optional[_StagedJob] = None
+            deferred = False
+            self._busy["extract"] += 1
+            started = time.perf_counter()
+            try:
+                if self._frontend is not None:
+                    item = await self._run_remote(job)
+                else:
+                    item = await self._extract(job)
+            except JobCancelled:
+                logger.info("Job %s annullato durante la fase extract", job.entry_id)
+            except _RetryLater as exc:
+                deferred = await self._defer(job, exc)
             except Exception:
                 logger.exception("Errore durante l'elaborazione del job %s", job.entry_id)
             finally:
-                self._queue.task_done()
+                self._busy["extract"] -= 1
+                self._record_busy("extract", worker, started)
+            if item is not None:
+                # put() si blocca se la fase successiva è piena: a crescere restano
+                # solo le code per utente e l'equità del round-robin è preservata.
+                # I file trovati in cache saltano direttamente alla fase di invio.
+                target = self._to_upload if item.outcome is not None else self._to_download
+                await target.put(item)
+            elif not deferred:
+                self._finish(job)
+            current_job_id.reset(log_context)
+            self._idle_workers += 1
 
-    async def _process_job(self, job: DownloadJob) -> None:
-        if not self._bot:
-            logger.error("Nessun bot disponibile per elaborare il job")
+    async def _stage_worker(
+        self,
+        stage: str,
+        worker: int,
+        source: "asyncio.Queue[_StagedJob]",
+        handler: StageHandler,
+        target: Optional["asyncio.Queue[_StagedJob]"],
+    ) -> None:
+        while True:
+            item = await source.get()
+            log_context = current_job_id.set(item.job.entry_id)
+            result: Optional[_StagedJob] = None
+            deferred = False
+            self._busy[stage] += 1
+            started = time.perf_counter()
+            try:
+                if item.job.entry_id not in self._cancelled:
+                    result = await handler(item)
+            except JobCancelled:
+                logger.info("Job %s annullato durante la fase %s", item.job.entry_id, stage)
+            except _RetryLater as exc:
+                deferred = await self._defer(item.job, exc)
+            except Exception:
+                logger.exception("Errore durante l'elaborazione del job %s", item.job.entry_id)
+            finally:
+                self._busy[stage] -= 1
+                self._record_busy(stage, worker, started)
+                source.task_done()
+            if result is not None and target is not None:
+                await target.put(result)
+            elif not deferred:
+                self._finish(item.job)
+            current_job_id.reset(log_context)
+
+    def _finish(self, job: DownloadJob, cancelled: bool = False) -> None:
+        cancelled = cancelled or job.entry_id in self._cancelled
+        self._in_flight_jobs.pop(job.entry_id, None)
+        self._cancelled.discard(job.entry_id)
+        self._rate_retries.pop(job.entry_id, None)
+        self._forbidden_retried.discard(job.entry_id)
+        self._progress_phase.pop(job.entry_id, None)
+        self._last_edit.pop(job.entry_id, None)
+        job_store.remove(job.job_id)
+        storage.release(job.entry_id)
+        storage.unpin(job.entry_id)
+        if cancelled:
+            self._promote_follower(job)
+        else:
+            # Se il job principale termina senza un file, i job agganciati falliscono con lui.
+            self._resolve_flight(job, None)
+        for callback in self._finish_listeners:
+            callback(job)
+
+    def _promote_follower(self, leader: DownloadJob) -> None:
+        """
+        Il job principale è stato annullato: il primo job agganciato (non annullato) ne
+        prende il posto e torna in coda, gli altri restano agganciati a lui.
+        """
+
+        flight = self._flights_by_leader.get(leader.entry_id)
+        waiting = [job for job in flight.followers if job.entry_id not in self._cancelled] if flight else []
+        if not waiting:
+            # Restano solo job annullati: _follow li chiude senza messaggi.
+            self._resolve_flight(leader, None)
             return
+        del self._flights_by_leader[leader.entry_id]
+        new_leader = waiting[0]
+        flight.leader = new_leader
+        flight.followers.remove(new_leader)
+        new_leader.coalesced_with = None
+        for follower in flight.followers:
+            follower.coalesced_with = new_leader.entry_id
+        self._flights_by_leader[new_leader.entry_id] = flight
+        self._in_flight_jobs.pop(new_leader.entry_id, None)
+
+        size_mb = _cached_size_mb(new_leader) if config.SCHEDULING_POLICY == "priority" else None
+        self._scheduler.push(new_leader, size_mb)
+        self._available.release()
+        task = asyncio.create_task(
+            tracker.update(
+                new_leader.entry_id,
+                status="in coda",
+                detail=f"Il job #{leader.entry_id} è stato annullato: di nuovo in coda",
+            )
+        )
+        self._follower_tasks.add(task)
+        task.add_done_callback(self._follower_tasks.discard)
+
+    async def _defer(self, job: DownloadJob, retry: _RetryLater) -> bool:
+        """
+        Toglie il job dal worker e lo rimette in coda dopo ``retry.delay_s`` secondi, così
+        l'attesa di un sito in pausa non occupa un worker. ``False`` se era già annullato.
+        """
+
+        if job.entry_id in self._cancelled:
+            return False
+        await tracker.update(job.entry_id, status="in coda", detail=retry.detail)
+        if job.entry_id in self._cancelled:
+            return False
+        self._in_flight_jobs.pop(job.entry_id, None)
+        task = asyncio.create_task(self._requeue_later(job, retry.delay_s))
+        self._deferred[job.entry_id] = (job, task)
+        return True
+
+    async def _requeue_later(self, job: DownloadJob, delay_s: float) -> None:
+        await asyncio.sleep(delay_s)
+        self._deferred.pop(job.entry_id, None)
+        size_mb = _cached_size_mb(job) if config.SCHEDULING_POLICY == "priority" else None
+        self._scheduler.push(job, size_mb)
+        self._available.release()
+
+    def _resolve_flight(self, leader: DownloadJob, outcome: Optional[DownloadOutcome]) -> None:
+        """
+        Consegna l'esito del download a tutti i job agganciati. Ogni job riceve subito
+        il proprio link al file, prima che il job principale possa eliminarlo.
+        """
+
+        flight = self._flights_by_leader.pop(leader.entry_id, None)
+        if flight is None:
+            return
+        del self._flights[flight.key]
+        for follower in flight.followers:
+            follower_outcome = outcome
+            if outcome is not None and outcome.path is not None and outcome.path.exists():
+                follower_outcome = replace(outcome, path=self._share_file(follower, outcome.path))
+            task = asyncio.create_task(self._follow(follower, follower_outcome))
+            self._follower_tasks.add(task)
+            task.add_done_callback(self._follower_tasks.discard)
+
+    def _share_file(self, job: DownloadJob, path: Path) -> Path:
+        target = resolve_target_dir(config.DOWNLOAD_DIR, job.user_id, job.username) / path.name
+        if target == path:
+            target = target.with_name(f"{path.stem}-{job.entry_id}{path.suffix}")
+        if config.MEDIA_CACHE_ENABLED:
+            target = media_cache.share(path, target)
+        else:
+            target = link_file(path, target)
+        storage.add(target, pin=job.entry_id)
+        return target
+
+    async def _follow(self, job: DownloadJob, outcome: Optional[DownloadOutcome]) -> None:
+        item: Optional[_StagedJob] = None
+        try:
+            if job.entry_id in self._cancelled:
+                return
+            if outcome is None:
+                await tracker.update(
+                    job.entry_id,
+                    status="errore",
+                    detail=f"Download fallito (job #{job.coalesced_with})",
+                )
+                await self._notify(job, config.ERROR_MESSAGE)
+                return
+            item = await self._check_downloaded(_StagedJob(job=job, outcome=outcome))
+        except Exception:
+            logger.exception("Errore durante l'elaborazione del job %s", job.entry_id)
+        finally:
+            if item is None:
+                self._finish(job)
+        if item is not None:
+            await self._to_upload.put(item)
+
+    async def _run_blocking(
+        self,
+        job: DownloadJob,
+        func: Callable[..., Any],
+        *args: Any,
+        progress: Optional[Callable[[dict], None]] = None,
+    ) -> Any:
+        """Esegue una funzione di yt-dlp sul backend configurato (thread o processi)."""
 
-        await tracker.update(job.entry_id, status="downloading", detail="In corso")
-
-        loop = asyncio.get_running_loop()
-        outcome: DownloadOutcome = await loop.run_in_executor(
-            None,
-            download_video,
-            job.url,
-            config.DOWNLOAD_DIR,
-            job.user_id,
-            job.username,
-            config.MAX_DOWNLOAD_SIZE_MB,
+        try:
+            result = await execution_backend.run(job.entry_id, func, *args, progress=progress)
+        except (TimeoutError, JobCancelled) as exc:
+            if job.entry_id in self._cancelled:
+                raise JobCancelled(str(exc)) from exc
+            logger.error("Job %s interrotto: %s", job.entry_id, exc)
+            await tracker.update(job.entry_id, status="errore", detail="Processo yt-dlp interrotto")
+            await self._notify(job, config.ERROR_MESSAGE)
+            raise JobCancelled(str(exc)) from exc
+        if job.entry_id in self._cancelled:
+            # Con il backend a thread il lavoro non si può interrompere: si scarta il risultato.
+            raise JobCancelled(f"Job {job.entry_id} annullato")
+        return result
+
+    async def _rate_limited(
+        self,
+        job: DownloadJob,
+        call: Callable[[], Awaitable[Any]],
+        refused: Callable[[Any], bool],
+    ) -> Any:
+        """
+        Esegue ``call`` (una richiesta verso il sito del job) rispettando il limite di
+        richieste dell'host. Se l'host è in pausa o rifiuta la richiesta (``RateLimited`` o
+        ``refused(risultato)``) solleva ``_RetryLater``: il job torna in coda alla fine del
+        backoff invece di tenere fermo il worker, al massimo ``RATE_LIMIT_MAX_RETRIES``
+        volte; poi restituisce l'ultimo risultato (``None`` se ``call`` ha sollevato
+        ``RateLimited``).
+        """
+
+        host = url_host(job.url)
+        if config.RATE_LIMIT_ENABLED:
+            backoff = rate_limiter.backoff_s(host)
+            if backoff > 0:
+                raise _RetryLater(backoff, f"{host} in pausa per troppe richieste: riprova tra {backoff:.0f}s")
+            await rate_limiter.acquire(host)
+        if job.entry_id in self._cancelled:
+            raise JobCancelled(f"Job {job.entry_id} annullato")
+        try:
+            result = await call()
+            limited = refused(result)
+        except RateLimited:
+            result, limited = None, True
+        if not config.RATE_LIMIT_ENABLED:
+            return result
+        backoff = rate_limiter.record(host, limited)
+        attempt = self._rate_retries.get(job.entry_id, 0)
+        if not limited or attempt >= config.RATE_LIMIT_MAX_RETRIES:
+            return result
+        attempt = self._rate_retries[job.entry_id] = attempt + 1
+        logger.warning(
+            "Job %s: troppe richieste a %s, nuovo tentativo %d/%d tra %.0fs",
+            job.entry_id,
+            host,
+            attempt,
+            config.RATE_LIMIT_MAX_RETRIES,
+            backoff,
         )
+        raise _RetryLater(
+            backoff,
+            f"Troppe richieste a {host}: nuovo tentativo {attempt}/{config.RATE_LIMIT_MAX_RETRIES} tra {backoff:.0f}s",
+        )
+
+    async def _run_remote(self, job: DownloadJob) -> Optional[_StagedJob]:
+        """
+        Nodo front end: il job viene estratto e scaricato da un worker. Se il worker
+        consegna un percorso nello storage condiviso il file passa alla fase di invio,
+        se consegna un ``file_id`` viene inviato subito da qui.
+        """
+
+        await tracker.update(job.entry_id, status="in coda", detail="In attesa di un worker")
+        result = await self._frontend.run(job)
+        if result is None or job.entry_id in self._cancelled:
+            return None
+        transcode = TranscodePlan(**result["transcode"]) if result.get("transcode") else None
+        if "file" not in result:
+            path = Path(config.DOWNLOAD_DIR) / result["path"]
+            storage.add(path, pin=job.entry_id)
+            outcome = DownloadOutcome(path=path, reused=result["reused"])
+            return _StagedJob(job=job, outcome=outcome, transcode=transcode)
+        telegram_files.save(result["file_key"], TelegramFile(**result["file"]))
+        caption, detail = _caption(job, result["size_mb"], result["reused"], transcode)
+        if not await self._send_known_file(job, result["file_key"], caption, detail):
+            await tracker.update(job.entry_id, status="errore", detail="Invio fallito")
+            await self._notify(job, config.ERROR_MESSAGE)
+        return None
+
+    async def _extract(self, job: DownloadJob) -> Optional[_StagedJob]:
+        if not self._bot and self._worker is None:
+            logger.error("Nessun bot disponibile per elaborare il job")
+            return None
+
+        if config.MEDIA_CACHE_ENABLED:
+            cached = media_cache.lookup_url(job.url, DEFAULT_FORMAT)
+            if cached is not None:
+                CACHE_REQUESTS.inc(cache="media", result="hit")
+                return await self._use_cached(job, None, cached)
+
+        info = info_cache.get(job.url)
+        if info is None:
+            await tracker.update(job.entry_id, status="downloading", detail="Recupero informazioni")
+
+            async def extract() -> Optional[dict]:
+                with EXTRACT_INFO_SECONDS.time():
+                    return await self._run_blocking(
+                        job,
+                        extract_video_info,
+                        job.url,
+                        config.DOWNLOAD_DIR,
+                        job.user_id,
+                        job.username,
+                    )
+
+            info = await self._rate_limited(job, extract, lambda _: False)
+            if info is None:
+                await tracker.update(job.entry_id, status="errore", detail="Download fallito")
+                await self._notify(job, config.ERROR_MESSAGE)
+                return None
+            info_cache.put(job.url, info)
+
+        video_key = _video_key(info)
+        plan = _plan_format(job, info)
+        fmt = DEFAULT_FORMAT
+        if plan is not None:
+            info, fmt = apply_plan(info, plan), plan.selector
+        if config.MEDIA_CACHE_ENABLED and video_key:
+            media_cache.remember_url(job.url, *video_key)
+            cached = media_cache.lookup(*video_key, fmt)
+            if cached is not None:
+                CACHE_REQUESTS.inc(cache="media", result="hit")
+                return await self._use_cached(job, info, cached)
+        if config.MEDIA_CACHE_ENABLED:
+            CACHE_REQUESTS.inc(cache="media", result="miss")
+
+        estimated_size_mb = extract_size_mb(info)
+        if estimated_size_mb and estimated_size_mb > config.MAX_DOWNLOAD_SIZE_MB:
+            outcome = DownloadOutcome(
+                path=None, reused=False, skipped=True, estimated_size_mb=estimated_size_mb
+            )
+            return await self._check_downloaded(_StagedJob(job=job, info=info, outcome=outcome))
+
+        if plan is not None:
+            await self._notify(
+                job,
+                config.FORMAT_PLANNED_MESSAGE.format(
+                    max_mb=config.active_upload_limit_mb(),
+                    label=plan.label,
+                    size_mb=plan.size_bytes / (1024 * 1024),
+                ),
+            )
+        await tracker.update(job.entry_id, status="in coda", detail="In attesa del download")
+        return _StagedJob(job=job, info=info, format=fmt)
+
+    async def _use_cached(
+        self, job: DownloadJob, info: Optional[dict], cached: CachedMedia
+    ) -> Optional[_StagedJob]:
+        target_dir = resolve_target_dir(config.DOWNLOAD_DIR, job.user_id, job.username)
+        path = media_cache.link_for_user(cached, target_dir)
+        storage.add(path, pin=job.entry_id)
+        logger.info("File trovato in cache per il job %s: %s", job.entry_id, cached.path)
+        outcome = DownloadOutcome(path=path, reused=True, estimated_size_mb=cached.size / (1024 * 1024))
+        return await self._check_downloaded(_StagedJob(job=job, info=info, outcome=outcome))
+
+    async def _download(self, item: _StagedJob) -> Optional[_StagedJob]:
+        job = item.job
+        target_dir = resolve_target_dir(config.DOWNLOAD_DIR, job.user_id, job.username)
+        try:
+            await storage.reserve(job.entry_id, target_dir, item.info)
+        except StorageFull as exc:
+            logger.warning("Job %s senza spazio per il download: %s", job.entry_id, exc)
+            await tracker.update(job.entry_id, status="errore", detail=str(exc))
+            await self._notify(job, config.STORAGE_FULL_MESSAGE)
+            return None
+        if job.entry_id in self._cancelled:
+            raise JobCancelled(f"Job {job.entry_id} annullato")
+
+        hosts = media_hosts(item.info, job.url)
+        self._progress_phase[job.entry_id] = "download"
+        started = time.perf_counter()
+
+        async def download() -> DownloadOutcome:
+            # Le connessioni vengono restituite durante l'eventuale backoff tra i tentativi.
+            async with host_connections.connections(hosts, _wanted_connections(item.info)) as granted:
+                detail = f"In corso ({granted} connessioni)" if granted > 1 else "In corso"
+                await tracker.update(job.entry_id, status="downloading", detail=detail)
+                return await self._run_blocking(
+                    job,
+                    download_video,
+                    job.url,
+                    config.DOWNLOAD_DIR,
+                    job.user_id,
+                    job.username,
+                    config.MAX_DOWNLOAD_SIZE_MB,
+                    item.info,
+                    granted,
+                    item.format,
+                    progress=progress_channel.hook_for(job.entry_id),
+                )
 
+        try:
+            outcome: DownloadOutcome = await self._rate_limited(
+                job, download, lambda outcome: is_rate_limited(outcome.error)
+            )
+        finally:
+            self._end_progress(job)
+            storage.release(job.entry_id)
+        if is_forbidden(outcome.error) and job.entry_id not in self._forbidden_retried:
+            # Un 403 spesso vuol dire URL dei formati scaduti: un solo nuovo tentativo con
+            # i metadati riletti dal sito.
+            logger.warning("Job %s: accesso negato (403), nuova estrazione", job.entry_id)
+            self._forbidden_retried.add(job.entry_id)
+            info_cache.invalidate(job.url)
+            raise _RetryLater(0, "Accesso negato dal sito: nuovo tentativo")
+        if outcome.path and outcome.path.exists():
+            storage.add(outcome.path, pin=job.entry_id)
+            if not outcome.reused:
+                _record_download(time.perf_counter() - started, outcome)
+
+        video_key = _video_key(item.info)
+        if config.MEDIA_CACHE_ENABLED and video_key and outcome.path and outcome.path.exists():
+            media_cache.store(*video_key, item.format, outcome.path)
+
+        item.outcome = outcome
+        return await self._check_downloaded(item)
+
+    async def _check_downloaded(self, item: _StagedJob) -> Optional[_StagedJob]:
+        """Controlli dopo il download: limiti di dimensione e modalità del job."""
+
+        job = item.job
+        outcome = item.outcome
+        self._resolve_flight(job, outcome)
         if outcome.skipped:
             estimated = (
                 f"{outcome.estimated_size_mb:.1f} MB"
@@ -81,21 +842,21 @@ class DownloadQueue:
                 f"{estimated} oltre il limite di download {config.MAX_DOWNLOAD_SIZE_MB} MB"
             )
             await tracker.update(job.entry_id, status="troppo grande", detail=detail)
-            await self._bot.send_message(
-                chat_id=job.chat_id,
-                text=config.FILE_TOO_LARGE_TO_DOWNLOAD_MESSAGE.format(
+            await self._notify(
+                job,
+                config.FILE_TOO_LARGE_TO_DOWNLOAD_MESSAGE.format(
                     size_mb=estimated, max_download_mb=config.MAX_DOWNLOAD_SIZE_MB
                 ),
             )
-            return
+            return None
 
         video_path = outcome.path
         reused = outcome.reused
 
         if not video_path or not video_path.exists():
             await tracker.update(job.entry_id, status="errore", detail="Download fallito")
-            await self._bot.send_message(chat_id=job.chat_id, text=config.ERROR_MESSAGE)
-            return
+            await self._notify(job, config.ERROR_MESSAGE)
+            return None
 
         if reused:
             await tracker.update(
@@ -103,75 +864,94 @@ class DownloadQueue:
                 status="downloading",
                 detail=f"File già presente: {video_path.name}",
             )
-            await self._bot.send_message(
-                chat_id=job.chat_id,
-                text=config.FILE_ALREADY_PRESENT_MESSAGE.format(filename=video_path.name),
+            await self._notify(
+                job,
+                config.FILE_ALREADY_PRESENT_MESSAGE.format(filename=video_path.name),
             )
 
         size_mb = file_size_mb(video_path)
         if size_mb > config.MAX_DOWNLOAD_SIZE_MB:
             detail = f"{size_mb:.1f} MB oltre il limite di download {config.MAX_DOWNLOAD_SIZE_MB} MB"
             await tracker.update(job.entry_id, status="troppo grande", detail=detail)
-            await self._bot.send_message(
-                chat_id=job.chat_id,
-                text=config.FILE_TOO_LARGE_TO_DOWNLOAD_MESSAGE.format(
-                    size_mb=f"{size_mb:.1f} MB",
-                    max_download_mb=config.MAX_DOWNLOAD_SIZE_MB,
+            await self._notify(
+                job,
+                config.FILE_TOO_LARGE_TO_DOWNLOAD_MESSAGE.format(
+                    size_mb=f"{size_mb:.1f} MB", max_download_mb=config.MAX_DOWNLOAD_SIZE_MB
                 ),
             )
-            cleanup_file(video_path)
-            return
+            _discard(video_path)
+            return None
 
         if job.mode == "download_only":
             reuse_note = " (riutilizzato)" if reused else ""
             detail = f"{size_mb:.1f} MB{reuse_note}"
             await tracker.update(job.entry_id, status="scaricato", detail=detail)
-            await self._bot.send_message(
-                chat_id=job.chat_id,
-                text=config.DOWNLOAD_ONLY_MESSAGE.format(
+            await self._notify(
+                job,
+                config.DOWNLOAD_ONLY_MESSAGE.format(
                     filename=video_path.name, reuse_note=reuse_note, size_mb=size_mb
                 ),
             )
-            return
+            return None
 
         max_upload_mb = config.active_upload_limit_mb()
+        if size_mb > max_upload_mb and config.TRANSCODE_TO_FIT_ENABLED:
+            item.transcode = await transcoder.plan(video_path, item.info, max_upload_mb)
+            if item.transcode is not None:
+                await self._notify(job, config.TRANSCODING_MESSAGE.format(max_mb=max_upload_mb))
+                await tracker.update(job.entry_id, status="in coda", detail="In attesa della ricodifica")
+                return item
         if size_mb > max_upload_mb:
             if config.TELEGRAM_BOT_API_ENABLED:
-                await self._bot.send_message(
-                    chat_id=job.chat_id,
-                    text=config.FILE_TOO_LARGE_MESSAGE.format(max_mb=max_upload_mb),
-                )
+                await self._notify(job, config.FILE_TOO_LARGE_MESSAGE.format(max_mb=max_upload_mb))
                 detail = f"{size_mb:.1f} MB (> {max_upload_mb} MB con Bot API self-hosted)"
             else:
-                await self._bot.send_message(
-                    chat_id=job.chat_id,
-                    text=config.FILE_TOO_LARGE_BOT_API_DISABLED.format(
+                await self._notify(
+                    job,
+                    config.FILE_TOO_LARGE_BOT_API_DISABLED.format(
                         size_gb=size_mb / 1024, max_mb=max_upload_mb
                     ),
                 )
                 detail = f"{size_mb:.1f} MB scaricati, limite {max_upload_mb} MB"
             if config.DELETE_AFTER_SEND:
-                cleanup_file(video_path)
+                _discard(video_path)
             else:
                 logger.info("File conservato perché DELETE_AFTER_SEND=False: %s", video_path)
             await tracker.update(job.entry_id, status="troppo grande", detail=detail)
+            return None
+
+        await tracker.update(job.entry_id, status="in coda", detail="In attesa dell'invio")
+        return item
+
+    async def _upload(self, item: _StagedJob) -> None:
+        if self._worker is not None:
+            await self._hand_over(item)
             return
+        job = item.job
+        video_path = item.outcome.path
+        size_mb = file_size_mb(video_path)
 
-        caption = f"Ecco il tuo video (circa {size_mb:.1f} MB)"
-        detail_suffix = f"{size_mb:.1f} MB" + (" (riutilizzato)" if reused else "")
-        send_timeouts = {}
-        if config.TELEGRAM_BOT_API_ENABLED:
-            send_timeouts = {"read_timeout": 120, "write_timeout": 120, "connect_timeout": 30}
+        await tracker.update(job.entry_id, status="uploading", detail="Invio su Telegram")
 
+        caption, detail_suffix = _caption(job, size_mb, item.outcome.reused, item.transcode)
+        file_key: Optional[str] = None
         try:
-            with video_path.open("rb") as file:
-                await self._bot.send_video(
-                    chat_id=job.chat_id,
-                    video=file,
-                    caption=caption,
-                    **send_timeouts,
-                )
+            file_key = await asyncio.to_thread(content_key, video_path)
+            if await self._send_known_file(job, file_key, caption, detail_suffix):
+                return
+            message = await self._send_file("video", job, video_path, caption, item.transcode)
+            _remember_sent_file(file_key, message)
             await tracker.update(job.entry_id, status="inviato", detail=detail_suffix)
+            await self._notify(job, config.SENT_STATUS_MESSAGE, edit_only=True)
+        except UploadUnconfirmed as exc:
+            logger.warning("Invio del job %s non confermato dalla Bot API: %s", job.entry_id, exc)
+            await tracker.update(
+                job.entry_id,
+                status="non confermato",
+                detail=f"{detail_suffix} (nessuna conferma dalla Bot API)",
+            )
+            await self._notify(job, config.SELF_HOSTED_TIMEOUT_MESSAGE)
+            return
         except TimedOut:
             logger.warning(
                 "Timeout durante l'invio del video con Bot API self-hosted: il file potrebbe "
@@ -183,38 +963,402 @@ class DownloadQueue:
                 detail=f"{detail_suffix} (timeout lato client)",
             )
             if config.TELEGRAM_BOT_API_ENABLED:
-                await self._bot.send_message(
-                    chat_id=job.chat_id,
-                    text=config.SELF_HOSTED_TIMEOUT_MESSAGE,
-                )
+                await self._notify(job, config.SELF_HOSTED_TIMEOUT_MESSAGE)
             return
-        except Exception:
+        except BadRequest:
+            # Telegram ha rifiutato il video (formato, dimensioni...): come documento può passare.
             logger.exception("Invio video fallito, provo come documento")
             try:
-                with video_path.open("rb") as file:
-                    await self._bot.send_document(
-                        chat_id=job.chat_id,
-                        document=file,
-                        caption=caption,
-                        **send_timeouts,
-                    )
+                message = await self._send_file(
+                    "document", job, video_path, caption, item.transcode
+                )
+                _remember_sent_file(file_key, message)
                 await tracker.update(
                     job.entry_id, status="inviato come documento", detail=detail_suffix
                 )
+                await self._notify(job, config.SENT_STATUS_MESSAGE, edit_only=True)
+                return
             except Exception:
                 logger.exception("Errore durante l'invio del file")
-                await self._bot.send_message(chat_id=job.chat_id, text=config.ERROR_MESSAGE)
+                await self._notify(job, config.ERROR_MESSAGE)
             await tracker.update(job.entry_id, status="errore", detail="Invio fallito")
             return
+        except Exception:
+            # Errore di rete o del server: reinviare lo stesso file come documento non aiuterebbe.
+            logger.exception("Errore durante l'invio del file")
+            await tracker.update(job.entry_id, status="errore", detail="Invio fallito")
+            await self._notify(job, config.ERROR_MESSAGE)
+            return
         finally:
             delete_after_send = config.DELETE_AFTER_SEND or job.mode == "upload_only"
             if delete_after_send:
-                cleanup_file(video_path)
+                _discard(video_path)
             else:
                 logger.info(
                     "File conservato dopo il download perché DELETE_AFTER_SEND=False: %s",
                     video_path,
                 )
 
+    async def _hand_over(self, item: _StagedJob) -> None:
+        """
+        Nodo worker: consegna il file al front end, che lo invierà all'utente. Con
+        ``CLUSTER_SHARED_STORAGE`` basta il percorso relativo a ``DOWNLOAD_DIR``;
+        altrimenti il file viene caricato nella chat ``CLUSTER_STORAGE_CHAT_ID`` e al
+        front end arriva il ``file_id``.
+        """
+
+        job = item.job
+        path = item.outcome.path
+        result: Dict[str, Any] = {
+            "size_mb": file_size_mb(path),
+            "reused": item.outcome.reused,
+            "transcode": asdict(item.transcode) if item.transcode is not None else None,
+        }
+        if config.CLUSTER_SHARED_STORAGE:
+            result["path"] = str(path.resolve().relative_to(Path(config.DOWNLOAD_DIR).resolve()))
+            await tracker.update(job.entry_id, status="uploading", detail="Consegnato al front end")
+            self._worker.set_result(job, result)
+            return
+
+        await tracker.update(job.entry_id, status="uploading", detail="Caricamento nella chat di archivio")
+        archive_job = replace(job, chat_id=config.CLUSTER_STORAGE_CHAT_ID)
+        try:
+            result["file_key"] = await asyncio.to_thread(content_key, path)
+            for kind in ("video", "document"):
+                try:
+                    message = await self._send_file(kind, archive_job, path, f"#{job.job_id}", item.transcode)
+                except Exception:
+                    logger.exception("Caricamento come %s nella chat di archivio non riuscito", kind)
+                    continue
+                sent = _sent_file(message)
+                if sent is not None:
+                    result["file"] = asdict(sent)
+                    await tracker.update(job.entry_id, status="uploading", detail="Consegnato al front end")
+                    self._worker.set_result(job, result)
+                    return
+            await tracker.update(job.entry_id, status="errore", detail="Invio fallito")
+            await self._notify(job, config.ERROR_MESSAGE)
+        finally:
+            if config.DELETE_AFTER_SEND or job.mode == "upload_only":
+                _discard(path)
+
+    async def _send_file(
+        self,
+        kind: str,
+        job: DownloadJob,
+        path: Path,
+        caption: str,
+        transcode: Optional[TranscodePlan] = None,
+    ) -> Optional[Message]:
+        with UPLOAD_SECONDS.time(method=f"send_{kind}"):
+            if transcode is not None:
+                return await self._send_transcoded(kind, job, path, caption, transcode)
+            return await self._transmit_file(kind, job, path, caption)
+
+    async def _send_transcoded(
+        self, kind: str, job: DownloadJob, path: Path, caption: str, plan: TranscodePlan
+    ) -> Optional[Message]:
+        """Ricodifica ``path`` e invia i byte prodotti da ffmpeg man mano che arrivano."""
+
+        filename = f"{path.stem}.mp4"
+        await tracker.update(job.entry_id, status="uploading", detail="In attesa della ricodifica")
+        async with transcoder.open(path, plan, config.UPLOAD_CHUNK_SIZE_KB * 1024) as chunks:
+            await tracker.update(job.entry_id, status="uploading", detail="Ricodifica e invio su Telegram")
+            if config.TELEGRAM_BOT_API_ENABLED:
+                self._progress_phase[job.entry_id] = "upload"
+                try:
+                    return await local_api_uploader.send_stream(
+                        self._bot,
+                        kind,
+                        job.chat_id,
+                        filename,
+                        chunks,
+                        None,
+                        caption,
+                        progress=self._upload_progress(job),
+                    )
+                finally:
+                    self._end_progress(job)
+            # Senza Bot API self-hosted il limite è di 50 MB: il risultato sta in memoria.
+            data = b"".join([chunk async for chunk in chunks])
+        if kind == "video":
+            return await self._bot.send_video(
+                chat_id=job.chat_id, video=data, filename=filename, caption=caption
+            )
+        return await self._bot.send_document(
+            chat_id=job.chat_id, document=data, filename=filename, caption=caption
+        )
+
+    async def _transmit_file(
+        self, kind: str, job: DownloadJob, path: Path, caption: str
+    ) -> Optional[Message]:
+        if config.TELEGRAM_BOT_API_ENABLED:
+            self._progress_phase[job.entry_id] = "upload"
+            try:
+                return await local_api_uploader.send(
+                    self._bot, kind, job.chat_id, path, caption, progress=self._upload_progress(job)
+                )
+            finally:
+                self._end_progress(job)
+        with path.open("rb") as file:
+            if kind == "video":
+                return await self._bot.send_video(chat_id=job.chat_id, video=file, caption=caption)
+            return await self._bot.send_document(chat_id=job.chat_id, document=file, caption=caption)
+
+    def _upload_progress(self, job: DownloadJob) -> ProgressCallback:
+        publish = progress_channel.hook_for(job.entry_id)
+
+        async def report(sent: int, total: Optional[int], rate: float) -> None:
+            publish(
+                {
+                    "phase": "upload",
+                    "bytes_done": sent,
+                    "bytes_total": total,
+                    "speed_bps": rate,
+                    "eta_s": (total - sent) / rate if total and rate else None,
+                }
+            )
+
+        return report
+
+    def _end_progress(self, job: DownloadJob) -> None:
+        self._progress_phase.pop(job.entry_id, None)
+        progress_channel.discard(job.entry_id)
+
+    async def _on_progress(self, batch: Dict[int, dict]) -> None:
+        """Riceve dal canale l'ultimo avanzamento di ogni job, già accorpato."""
+
+        for entry_id, data in batch.items():
+            job = self._in_flight_jobs.get(entry_id)
+            if job is None or self._progress_phase.get(entry_id) != data["phase"]:
+                continue  # aggiornamento arrivato dopo la fine della fase
+            text = format_progress(data)
+            jobs = [job]
+            flight = self._flights_by_leader.get(entry_id)
+            if data["phase"] == "download" and flight is not None:
+                jobs.extend(flight.followers)
+            template = (
+                config.DOWNLOAD_PROGRESS_MESSAGE
+                if data["phase"] == "download"
+                else config.UPLOAD_PROGRESS_MESSAGE
+            )
+            for target in jobs:
+                await tracker.set_progress(
+                    target.entry_id,
+                    text,
+                    data["bytes_done"],
+                    data.get("bytes_total"),
+                    data.get("speed_bps"),
+                    data.get("eta_s"),
+                )
+                self._schedule_status_edit(target, template.format(progress=text))
+
+    def _schedule_status_edit(self, job: DownloadJob, text: str) -> None:
+        """Modifica il messaggio di stato senza attendere, al massimo ogni PROGRESS_EDIT_INTERVAL_S."""
+
+        if (job.status_message_id is None and self._worker is None) or job.entry_id in self._edit_tasks:
+            return
+        now = time.monotonic()
+        if now - self._last_edit.get(job.entry_id, 0.0) < config.PROGRESS_EDIT_INTERVAL_S:
+            return
+        self._last_edit[job.entry_id] = now
+        if self._worker is not None:
+            self._worker.relay(job, {"type": "progress", "text": text})
+            return
+        task = asyncio.create_task(self._edit_status(job, text))
+        self._edit_tasks[job.entry_id] = task
+        task.add_done_callback(lambda _: self._edit_tasks.pop(job.entry_id, None))
+
+    async def _edit_status(self, job: DownloadJob, text: str) -> None:
+        try:
+            await self._bot.edit_message_text(
+                text, chat_id=job.chat_id, message_id=job.status_message_id
+            )
+        except TelegramError as exc:
+            logger.debug("Aggiornamento del messaggio di stato del job %s saltato: %s", job.entry_id, exc)
+
+    async def _notify(self, job: DownloadJob, text: str, edit_only: bool = False) -> None:
+        """
+        Mostra ``text`` nel messaggio di stato del job; se il job non ne ha uno (o non
+        si può modificare) invia un nuovo messaggio, a meno di ``edit_only``. I job di un
+        batch non scrivono in chat: il loro esito compare nel messaggio del batch.
+        """
+
+        if job.batch_id is not None:
+            return
+        if self._worker is not None:
+            self._worker.relay(job, {"type": "notify", "text": text, "edit_only": edit_only})
+            return
+
+        pending = self._edit_tasks.get(job.entry_id)
+        if pending is not None:
+            # Evita che un aggiornamento di avanzamento in volo sovrascriva questo testo.
+            await asyncio.wait([pending])
+        if job.status_message_id is not None:
+            try:
+                await self._bot.edit_message_text(
+                    text, chat_id=job.chat_id, message_id=job.status_message_id
+                )
+                return
+            except TelegramError as exc:
+                # Un errore sul messaggio di stato non deve far fallire (o ripetere) il job.
+                if isinstance(exc, BadRequest) and "not modified" in str(exc).lower():
+                    return
+                logger.warning(
+                    "Impossibile modificare il messaggio di stato del job %s: %s", job.entry_id, exc
+                )
+        if not edit_only:
+            await self._bot.send_message(chat_id=job.chat_id, text=text)
+
+    async def show_status(self, job: DownloadJob, text: str, edit_only: bool = False) -> None:
+        """Mostra ``text`` nel messaggio di stato del job (anche per conto di un worker, vedi ``cluster``)."""
+
+        await self._notify(job, text, edit_only)
+
+    def show_progress(self, job: DownloadJob, text: str) -> None:
+        """Avanzamento arrivato da un worker (vedi ``cluster``)."""
+
+        self._schedule_status_edit(job, text)
+
+    async def _send_known_file(
+        self, job: DownloadJob, file_key: str, caption: str, detail: str
+    ) -> bool:
+        """Invia il file usando un ``file_id`` già noto; False se va caricato di nuovo."""
+
+        known = telegram_files.get(file_key)
+        if known is None:
+            CACHE_REQUESTS.inc(cache="file_id", result="miss")
+            return False
+        try:
+            with UPLOAD_SECONDS.time(method="file_id"):
+                if known.kind == "video":
+                    await self._bot.send_video(
+                        chat_id=job.chat_id, video=known.file_id, caption=caption
+                    )
+                else:
+                    await self._bot.send_document(
+                        chat_id=job.chat_id, document=known.file_id, caption=caption
+                    )
+        except BadRequest:
+            logger.warning("file_id non più valido per il job %s, ricarico il file", job.entry_id)
+            telegram_files.forget(file_key)
+            CACHE_REQUESTS.inc(cache="file_id", result="miss")
+            return False
+        CACHE_REQUESTS.inc(cache="file_id", result="hit")
+        status = "inviato" if known.kind == "video" else "inviato come documento"
+        await tracker.update(job.entry_id, status=status, detail=f"{detail} (file_id riutilizzato)")
+        await self._notify(job, config.SENT_STATUS_MESSAGE, edit_only=True)
+        return True
+
+
+def _caption(
+    job: DownloadJob, size_mb: float, reused: bool, transcode: Optional[TranscodePlan]
+) -> Tuple[str, str]:
+    """Didascalia del video e dettaglio per il tracker."""
+
+    caption = f"Ecco il tuo video (circa {size_mb:.1f} MB)"
+    detail = f"{size_mb:.1f} MB" + (" (riutilizzato)" if reused else "")
+    if transcode is not None:
+        caption = f"Ecco il tuo video (ricodificato sotto {config.active_upload_limit_mb()} MB)"
+        detail += " (ricodificato)"
+    if job.coalesced_with is not None:
+        detail += f" (unito al job #{job.coalesced_with})"
+    return caption, detail
+
+
+def _sent_file(message: Optional[Message]) -> Optional[TelegramFile]:
+    if message is None:
+        return None
+    if message.video:
+        return TelegramFile("video", message.video.file_id, message.video.file_unique_id)
+    if message.document:
+        return TelegramFile("document", message.document.file_id, message.document.file_unique_id)
+    return None
+
+
+def _remember_sent_file(file_key: Optional[str], message: Optional[Message]) -> None:
+    sent = _sent_file(message)
+    if file_key is not None and sent is not None:
+        telegram_files.save(file_key, sent)
+
+
+def _record_download(elapsed_s: float, outcome: DownloadOutcome) -> None:
+    """Separa il tempo di download vero e proprio da quello di merge/remux."""
+
+    postprocess_s = outcome.postprocess_s or 0.0
+    download_s = max(elapsed_s - postprocess_s, 1e-6)
+    DOWNLOAD_SECONDS.observe(download_s)
+    DOWNLOAD_THROUGHPUT.observe(file_size_mb(outcome.path) / download_s)
+    POSTPROCESS_SECONDS.observe(postprocess_s)
+
+
+def _plan_format(job: DownloadJob, info: dict) -> Optional[FormatPlan]:
+    """Formato ridotto da scaricare se quello predefinito supera il limite di invio."""
+
+    if job.mode == "download_only" or not config.FORMAT_PLANNER_ENABLED:
+        return None
+    estimated_size_mb = extract_size_mb(info)
+    max_upload_mb = config.active_upload_limit_mb()
+    if estimated_size_mb is None or estimated_size_mb <= max_upload_mb:
+        return None
+    plan = plan_format(info, max_upload_mb)
+    if plan is None:
+        logger.info("Nessun formato del job %s sta sotto %s MB", job.entry_id, max_upload_mb)
+    else:
+        logger.info(
+            "Job %s: formato %s (%.1f MB stimati) invece di %.1f MB",
+            job.entry_id,
+            plan.selector,
+            plan.size_bytes / (1024 * 1024),
+            estimated_size_mb,
+        )
+    return plan
+
+
+def _cached_size_mb(job: DownloadJob) -> Optional[float]:
+    """Dimensione attesa del job dalle sole cache (0 se il file è già in cache), ``None`` se ignota."""
+
+    if config.MEDIA_CACHE_ENABLED and media_cache.lookup_url(job.url, DEFAULT_FORMAT) is not None:
+        return 0.0
+    return info_cache.estimated_size_mb(job.url)
+
+
+def _staged_size_mb(item: _StagedJob) -> Optional[float]:
+    if item.outcome is not None and item.outcome.path is not None and item.outcome.path.exists():
+        return file_size_mb(item.outcome.path)
+    return extract_size_mb(item.info) if item.info else None
+
+
+def _wanted_connections(info: Optional[dict]) -> int:
+    """Connessioni da chiedere per il download: più di una solo per i file grandi."""
+
+    if not config.ACCELERATED_DOWNLOAD_ENABLED or not info:
+        return 1
+    estimated_size_mb = extract_size_mb(info)
+    if estimated_size_mb is None or estimated_size_mb < config.ACCELERATED_MIN_SIZE_MB:
+        return 1
+    return max(1, config.CONNECTIONS_PER_DOWNLOAD)
+
+
+def _video_key(info: Optional[dict]) -> Optional[Tuple[str, str]]:
+    if info and info.get("extractor_key") and info.get("id"):
+        return info["extractor_key"], str(info["id"])
+    return None
+
+
+def _discard(path: Path) -> None:
+    if config.MEDIA_CACHE_ENABLED:
+        media_cache.discard(path)
+    else:
+        cleanup_file(path)
+    storage.forget(path)
+
 
 download_queue = DownloadQueue()
+QUEUE_PENDING.set_function(download_queue.pending_jobs)
+STAGE_QUEUE_DEPTH.set_function(
+    lambda: {(stage,): depth for stage, depth in download_queue.stage_depths().items()}
+)
+STAGE_BUSY_WORKERS.set_function(
+    lambda: {(stage,): busy for stage, busy in download_queue.busy_workers().items()}
+)
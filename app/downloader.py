@@ -1,13 +1,50 @@
 import logging
+import os
 import re
+import shutil
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional
 
-from yt_dlp import YoutubeDL
+from . import config
+
+if TYPE_CHECKING:
+    from yt_dlp import YoutubeDL as _YoutubeDL
 
 logger = logging.getLogger(__name__)
 
+# Classe di yt-dlp, importata al primo job da ``_youtube_dl`` (i benchmark la sostituiscono).
+YoutubeDL: Any = None
+
+DEFAULT_FORMAT = "bestvideo+bestaudio/best"
+
+# yt-dlp chiama gli hook a ogni blocco ricevuto: ne inoltriamo al massimo uno ogni
+# _PROGRESS_MIN_INTERVAL_S secondi, così anche la pipe del backend a processi resta leggera.
+_PROGRESS_MIN_INTERVAL_S = 0.25
+
+ProgressHook = Callable[[dict], None]
+
+# Errori con cui i siti segnalano troppe richieste (o un blocco anti-bot che ne deriva).
+_RATE_LIMIT_RE = re.compile(
+    r"\b429\b|too many requests|rate.?limit|sign in to confirm|not a bot",
+    re.IGNORECASE,
+)
+# Un 403 da solo di solito indica un URL del formato scaduto o legato a un'altra sessione.
+_FORBIDDEN_RE = re.compile(r"\b403\b|forbidden", re.IGNORECASE)
+
+
+class RateLimited(Exception):
+    """Il sito ha rifiutato la richiesta per troppe richieste (429, verifica anti-bot)."""
+
+
+def is_rate_limited(message: Optional[str]) -> bool:
+    return bool(message) and _RATE_LIMIT_RE.search(message) is not None
+
+
+def is_forbidden(message: Optional[str]) -> bool:
+    return bool(message) and _FORBIDDEN_RE.search(message) is not None
+
 
 @dataclass
 class DownloadOutcome:
@@ -15,6 +52,8 @@ class DownloadOutcome:
     reused: bool
     skipped: bool = False
     estimated_size_mb: Optional[float] = None
+    postprocess_s: Optional[float] = None
+    error: Optional[str] = None
 
 
 def ensure_download_dir(path: str) -> Path:
@@ -29,39 +68,259 @@ def user_download_dir(base_dir: str, user_id: Optional[int], username: Optional[
     return Path(base_dir) / safe_label
 
 
-def download_video(
+def _youtube_dl(params: dict) -> "_YoutubeDL":
+    """
+    Crea ``YoutubeDL``. yt-dlp viene importato solo qui, quindi avviare il bot (o un
+    processo che non scarica) non ne paga il costo; con ``YTDLP_EXTRACTORS`` vengono
+    registrati solo gli estrattori indicati.
+    """
+
+    global YoutubeDL
+    if YoutubeDL is None:
+        from yt_dlp import YoutubeDL as youtube_dl
+
+        YoutubeDL = youtube_dl
+    if config.YTDLP_EXTRACTORS:
+        params = {**params, "allowed_extractors": config.YTDLP_EXTRACTORS}
+    return YoutubeDL(params)
+
+
+def warm_up() -> None:
+    """
+    Inizializza yt-dlp nel processo corrente: importa e registra gli estrattori
+    una sola volta, così i job successivi creano ``YoutubeDL`` senza questo costo.
+    """
+
+    with _youtube_dl({"quiet": True, "no_warnings": True, "logger": logger}):
+        pass
+    logger.info("yt-dlp inizializzato")
+
+
+def resolve_target_dir(download_dir: str, user_id: Optional[int], username: Optional[str]) -> Path:
+    if user_id is None and username is None:
+        return ensure_download_dir(download_dir)
+    return ensure_download_dir(user_download_dir(download_dir, user_id, username))
+
+
+def build_ydl_opts(target_dir: Path, format_selector: str = DEFAULT_FORMAT) -> dict:
+    # Un formato ridotto ha un nome diverso, per non confondersi con la versione completa.
+    name = "%(title).80s" if format_selector == DEFAULT_FORMAT else "%(title).80s [%(format_id)s]"
+    return {
+        "outtmpl": str(target_dir / f"{name}.%(ext)s"),
+        "format": format_selector,
+        "merge_output_format": "mp4",
+        "noplaylist": True,
+        # Riprende i file .part lasciati da un download interrotto (es. riavvio del container).
+        "continuedl": True,
+        "quiet": True,
+        "no_warnings": True,
+        "logger": logger,
+    }
+
+
+def apply_connections(ydl_opts: dict, connections: int) -> None:
+    """
+    Configura yt-dlp per usare ``connections`` connessioni: frammenti DASH/HLS in
+    parallelo e, se disponibile, aria2c per i file progressivi (HTTP a intervalli).
+    """
+
+    if connections <= 1:
+        return
+    ydl_opts["concurrent_fragment_downloads"] = connections
+    if config.ARIA2C_ENABLED and shutil.which("aria2c"):
+        ydl_opts["external_downloader"] = {"http": "aria2c"}
+        ydl_opts["external_downloader_args"] = {
+            "aria2c": ["-x", str(connections), "-s", str(connections), "-k", "1M"]
+        }
+
+
+def merge_temp_dir(download_dir: str) -> Path:
+    """Cartella dei file intermedi del merge in modalità ``tempdir``."""
+
+    return Path(config.MERGE_TEMP_DIR) if config.MERGE_TEMP_DIR else Path(download_dir) / ".cache" / "tmp"
+
+
+def merge_disk_copies(download_dir: str) -> int:
+    """
+    Quante volte un video con tracce separate viene scritto in ``download_dir``:
+    due (tracce scaricate + file unito) tranne con ``ffmpeg``, che unisce in rete, e
+    con ``tempdir`` su un altro filesystem, dove in download_dir arriva solo il risultato.
+    """
+
+    if config.MERGE_MODE == "ffmpeg":
+        return 1
+    if config.MERGE_MODE == "tempdir":
+        temp_dir = ensure_download_dir(str(merge_temp_dir(download_dir)))
+        if os.stat(temp_dir).st_dev != os.stat(download_dir).st_dev:
+            return 1
+    return 2
+
+
+def apply_merge_mode(ydl_opts: dict, info: Optional[dict], target_dir: Path, download_dir: str) -> None:
+    """
+    Configura come vengono uniti video e audio separati (vedi ``MERGE_MODE``):
+
+    - ``ffmpeg``: un solo processo ffmpeg legge entrambe le tracce dalla rete e scrive
+      direttamente il file finale, senza tracce intermedie su disco;
+    - ``tempdir``: tracce e file unito vengono scritti in ``merge_temp_dir`` e solo il
+      risultato viene spostato in ``target_dir`` (una rename sullo stesso filesystem).
+    """
+
+    if not info or len(info.get("requested_formats") or []) < 2:
+        return
+    if config.MERGE_MODE == "ffmpeg":
+        # Sostituisce anche aria2c: yt-dlp unisce in un passaggio solo se tutti i formati
+        # vanno a ffmpeg.
+        ydl_opts["external_downloader"] = {"default": "ffmpeg"}
+        ydl_opts.pop("external_downloader_args", None)
+    elif config.MERGE_MODE == "tempdir":
+        temp_dir = ensure_download_dir(str(merge_temp_dir(download_dir) / target_dir.name))
+        # Con un outtmpl assoluto yt-dlp ignorerebbe "paths".
+        ydl_opts["outtmpl"] = Path(ydl_opts["outtmpl"]).name
+        ydl_opts["paths"] = {"home": str(target_dir), "temp": str(temp_dir)}
+
+
+def _progress_hooks(callback: ProgressHook) -> List[Callable[[dict], None]]:
+    """Riduce i dizionari di yt-dlp a pochi campi serializzabili e ne limita la frequenza."""
+
+    last_sent = 0.0
+
+    def hook(data: dict) -> None:
+        nonlocal last_sent
+        now = time.monotonic()
+        if data.get("status") == "downloading" and now - last_sent < _PROGRESS_MIN_INTERVAL_S:
+            return
+        last_sent = now
+        total = data.get("total_bytes") or data.get("total_bytes_estimate")
+        callback(
+            {
+                "phase": "download",
+                "bytes_done": data.get("downloaded_bytes") or 0,
+                "bytes_total": int(total) if total else None,
+                "speed_bps": data.get("speed"),
+                "eta_s": data.get("eta"),
+            }
+        )
+
+    return [hook]
+
+
+class _PostprocessTimer:
+    """Somma la durata dei postprocessor di yt-dlp (merge audio/video, remux)."""
+
+    def __init__(self) -> None:
+        self.total_s = 0.0
+        self._started: Dict[str, float] = {}
+
+    def hook(self, data: dict) -> None:
+        name = data.get("postprocessor") or ""
+        if data.get("status") == "started":
+            self._started[name] = time.monotonic()
+        elif data.get("status") == "finished" and name in self._started:
+            self.total_s += time.monotonic() - self._started.pop(name)
+
+
+def extract_video_info(
     url: str,
     download_dir: str,
     user_id: Optional[int] = None,
     username: Optional[str] = None,
-    max_download_mb: Optional[int] = None,
-) -> DownloadOutcome:
+) -> Optional[dict]:
     """
-    Scarica il video dall'URL usando yt-dlp nella cartella download_dir.
-    Restituisce un ``DownloadOutcome`` che indica se il file è stato scaricato,
-    riutilizzato, oppure saltato prima del download perché supera il limite.
+    Recupera i metadati del video senza scaricarlo.
+    Restituisce il dizionario già sanificato (serializzabile) oppure ``None`` in caso di errore.
+    Solleva ``RateLimited`` se il sito rifiuta la richiesta per troppe richieste.
     """
 
-    if user_id is None and username is None:
-        target_dir = ensure_download_dir(download_dir)
-    else:
-        target_dir = ensure_download_dir(user_download_dir(download_dir, user_id, username))
-    output_template = str(target_dir / "%(title).80s.%(ext)s")
+    target_dir = resolve_target_dir(download_dir, user_id, username)
+    try:
+        with _youtube_dl(build_ydl_opts(target_dir)) as ydl:
+            info = ydl.extract_info(url, download=False)
+            if info is None:
+                return None
+            return ydl.sanitize_info(info)
+    except Exception as exc:
+        if is_rate_limited(str(exc)):
+            logger.warning("Richiesta limitata dal sito durante l'estrazione: %s", exc)
+            raise RateLimited(str(exc)) from None
+        logger.exception("Errore durante il recupero delle informazioni del video")
+        return None
+
+
+def iter_playlist_urls(url: str, max_entries: int = 0) -> Iterator[str]:
+    """
+    Link dei video di una playlist o di un canale, letti a pagine man mano che vengono
+    richiesti (``extract_flat``): i singoli video non vengono risolti qui ma dai job che
+    li scaricano. Un link che non è una playlist viene restituito così com'è.
+    """
 
     ydl_opts = {
-        "outtmpl": output_template,
-        "format": "bestvideo+bestaudio/best",
-        "merge_output_format": "mp4",
-        "noplaylist": True,
+        "extract_flat": "in_playlist",
         "quiet": True,
         "no_warnings": True,
         "logger": logger,
     }
+    with _youtube_dl(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        # Alcuni estrattori rimandano a un altro URL (es. la scheda "Video" di un canale).
+        for _ in range(3):
+            if not info or info.get("_type") not in ("url", "url_transparent"):
+                break
+            info = ydl.extract_info(info["url"], download=False, process=False, ie_key=info.get("ie_key"))
+        if not info:
+            return
+        if info.get("_type") not in ("playlist", "multi_video"):
+            yield url
+            return
+        count = 0
+        for entry in info.get("entries") or []:
+            if not entry:
+                continue
+            flat = entry.get("_type") in ("url", "url_transparent")
+            link = entry.get("url") if flat else entry.get("webpage_url")
+            if not link:
+                continue
+            yield link
+            count += 1
+            if max_entries and count >= max_entries:
+                return
+
+
+def download_video(
+    url: str,
+    download_dir: str,
+    user_id: Optional[int] = None,
+    username: Optional[str] = None,
+    max_download_mb: Optional[int] = None,
+    info: Optional[dict] = None,
+    connections: int = 1,
+    format_selector: str = DEFAULT_FORMAT,
+    progress_hook: Optional[ProgressHook] = None,
+) -> DownloadOutcome:
+    """
+    Scarica il video dall'URL usando yt-dlp nella cartella download_dir.
+    Se ``info`` è già stato ottenuto con ``extract_video_info`` non viene ripetuta l'estrazione.
+    Restituisce un ``DownloadOutcome`` che indica se il file è stato scaricato,
+    riutilizzato, oppure saltato prima del download perché supera il limite.
+    ``progress_hook`` riceve l'avanzamento (byte, velocità, ETA) dal thread di download.
+    ``connections`` è il numero di connessioni concesse al download (vedi ``hosts``);
+    ``format_selector`` sostituisce il formato predefinito (vedi ``format_planner``).
+    """
+
+    target_dir = resolve_target_dir(download_dir, user_id, username)
+    ydl_opts = build_ydl_opts(target_dir, format_selector)
+    apply_connections(ydl_opts, connections)
+    apply_merge_mode(ydl_opts, info, target_dir, download_dir)
+    if progress_hook is not None:
+        ydl_opts["progress_hooks"] = _progress_hooks(progress_hook)
+    postprocess_timer = _PostprocessTimer()
+    ydl_opts["postprocessor_hooks"] = [postprocess_timer.hook]
 
     try:
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            estimated_size_mb = _extract_size_mb(info)
+        with _youtube_dl(ydl_opts) as ydl:
+            if info is None:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            estimated_size_mb = extract_size_mb(info)
 
             if max_download_mb and estimated_size_mb and estimated_size_mb > max_download_mb:
                 logger.warning(
@@ -76,11 +335,7 @@ def download_video(
                     estimated_size_mb=estimated_size_mb,
                 )
 
-            downloaded_path = ydl.prepare_filename(info)
-            final_path = Path(downloaded_path)
-            if final_path.suffix != ".mp4" and final_path.with_suffix(".mp4").exists():
-                final_path = final_path.with_suffix(".mp4")
-
+            final_path = _final_path(ydl, info)
             if final_path.exists():
                 logger.info("File già presente, salto il download: %s", final_path)
                 return DownloadOutcome(
@@ -89,24 +344,32 @@ def download_video(
                     estimated_size_mb=estimated_size_mb,
                 )
 
-            processed_info = ydl.process_info(info)
-            final_info = processed_info or info
+            final_info = ydl.process_ie_result(info, download=True)
             if final_info is None:
-                logger.error("Informazioni sul download non disponibili dopo process_info")
+                logger.error("Informazioni sul download non disponibili dopo il download")
                 return DownloadOutcome(path=None, reused=False, skipped=False)
 
-            final_path = Path(ydl.prepare_filename(final_info))
-            if final_path.suffix != ".mp4" and final_path.with_suffix(".mp4").exists():
-                final_path = final_path.with_suffix(".mp4")
+            final_path = _final_path(ydl, final_info)
             logger.info("Video scaricato: %s", final_path)
             return DownloadOutcome(
                 path=final_path,
                 reused=False,
                 estimated_size_mb=file_size_mb(final_path),
+                postprocess_s=postprocess_timer.total_s,
             )
-    except Exception:
+    except Exception as exc:
         logger.exception("Errore durante il download del video")
-        return DownloadOutcome(path=None, reused=False, skipped=False)
+        return DownloadOutcome(path=None, reused=False, skipped=False, error=str(exc))
+
+
+def _final_path(ydl: "_YoutubeDL", info: dict) -> Path:
+    requested = info.get("requested_downloads") or []
+    if requested and requested[0].get("filepath"):
+        return Path(requested[0]["filepath"])
+    final_path = Path(ydl.prepare_filename(info))
+    if final_path.suffix != ".mp4" and final_path.with_suffix(".mp4").exists():
+        final_path = final_path.with_suffix(".mp4")
+    return final_path
 
 
 def file_size_mb(path: Path) -> float:
@@ -114,7 +377,14 @@ def file_size_mb(path: Path) -> float:
     return size_bytes / (1024 * 1024)
 
 
-def _extract_size_mb(info: dict) -> Optional[float]:
+def extract_size_mb(info: dict) -> Optional[float]:
+    """Stima la dimensione del file finale dai metadati, sommando video e audio se separati."""
+
+    requested = info.get("requested_formats")
+    if requested:
+        sizes = [fmt.get("filesize") or fmt.get("filesize_approx") for fmt in requested]
+        if all(sizes):
+            return sum(sizes) / (1024 * 1024)
     for key in ("filesize", "filesize_approx"):
         if info.get(key):
             return info[key] / (1024 * 1024)
@@ -0,0 +1,250 @@
+"""
+Backend di esecuzione per le funzioni bloccanti di yt-dlp.
+
+Il backend ``thread`` usa l'executor di default del loop asyncio. Il backend
+``process`` tiene un pool di processi figli già inizializzati (yt-dlp importato
+e estrattori caricati una sola volta per processo), così le regex, il parsing
+JSON e il post-processing di yt-dlp non trattengono il GIL del processo che
+serve il bot e la web GUI. Un figlio bloccato può essere terminato senza
+riavviare il bot: viene sostituito da un nuovo processo. I log dei figli tornano al
+processo principale, quindi compaiono anche nella web GUI.
+"""
+
+import asyncio
+import contextvars
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+from logging.handlers import QueueHandler
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """Il job è stato annullato o il processo figlio è stato terminato."""
+
+
+ProgressHook = Callable[[dict], None]
+
+
+class ThreadBackend:
+    async def run(
+        self,
+        key: Hashable,
+        func: Callable[..., Any],
+        *args: Any,
+        progress: Optional[ProgressHook] = None,
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        if progress is not None:
+            func = functools.partial(func, progress_hook=progress)
+        # Come asyncio.to_thread: i log di yt-dlp nel thread restano legati al job.
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(None, functools.partial(context.run, func, *args))
+
+    def cancel(self, key: Hashable) -> bool:
+        # Un thread non può essere interrotto dall'esterno.
+        return False
+
+    def shutdown(self) -> None:
+        pass
+
+
+class _PipeLogHandler(QueueHandler):
+    """
+    Nel processo figlio: manda i record al processo principale sulla pipe dei risultati,
+    già formattati (``QueueHandler.prepare``) così da poterli serializzare.
+    """
+
+    def __init__(self, send: Callable[[tuple], None]) -> None:
+        super().__init__(None)
+        self._send = send
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self._send(("log", record))
+
+
+def _child_main(conn: Connection, log_level: str) -> None:
+    send_lock = threading.Lock()
+
+    def send(message: tuple) -> None:
+        # yt-dlp può chiamare gli hook da più thread (download dei frammenti).
+        with send_lock:
+            conn.send(message)
+
+    # I log del figlio finiscono nella console e nel buffer della web GUI del processo principale.
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, log_level.upper(), logging.INFO))
+    root.addHandler(_PipeLogHandler(send))
+    from .downloader import warm_up
+
+    warm_up()
+
+    while True:
+        try:
+            func, args, with_progress = conn.recv()
+        except (EOFError, OSError):
+            return
+        kwargs = {"progress_hook": lambda data: send(("progress", data))} if with_progress else {}
+        try:
+            send(("result", True, func(*args, **kwargs)))
+        except Exception as exc:
+            logger.exception("Errore nel processo di download")
+            try:
+                # Il tipo dell'eccezione serve al chiamante (es. ``RateLimited``).
+                send(("result", False, exc))
+            except Exception:
+                send(("result", False, RuntimeError(repr(exc))))
+
+
+class _Child:
+    def __init__(self, ctx: multiprocessing.context.BaseContext, index: int) -> None:
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_child_main,
+            args=(child_conn, config.LOG_LEVEL),
+            name=f"yt-dlp-{index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def call(
+        self,
+        func: Callable[..., Any],
+        args: tuple,
+        timeout: Optional[float],
+        progress: Optional[ProgressHook],
+    ) -> Any:
+        """
+        Eseguito in un thread: invia il lavoro al figlio, inoltra gli aggiornamenti
+        di avanzamento e ne attende il risultato.
+        """
+
+        try:
+            self.conn.send((func, args, progress is not None))
+        except OSError as exc:
+            self.kill()
+            raise JobCancelled(f"Processo {self.process.name} non raggiungibile") from exc
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            remaining = max(deadline - time.monotonic(), 0) if deadline else None
+            if not self.conn.poll(remaining):
+                self.kill()
+                raise TimeoutError(f"Nessuna risposta dal processo {self.process.name} in {timeout}s")
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError) as exc:
+                self.kill()
+                raise JobCancelled(f"Processo {self.process.name} terminato") from exc
+            if message[0] == "progress":
+                progress(message[1])
+                continue
+            if message[0] == "log":
+                record = message[1]
+                logging.getLogger(record.name).handle(record)
+                continue
+            _, ok, result = message
+            if not ok:
+                raise result
+            return result
+
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def kill(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class ProcessBackend:
+    def __init__(self, workers: int, timeout_s: float) -> None:
+        self._ctx = multiprocessing.get_context("spawn")
+        self._workers = max(1, workers)
+        self._timeout = timeout_s or None
+        self._children: List[_Child] = []
+        self._idle: Optional[asyncio.Queue[_Child]] = None
+        self._running: Dict[Hashable, _Child] = {}
+        self._spawned = 0
+
+    def _spawn(self) -> _Child:
+        self._spawned += 1
+        child = _Child(self._ctx, self._spawned)
+        self._children.append(child)
+        return child
+
+    def _replace(self, child: _Child) -> _Child:
+        self._children.remove(child)
+        return self._spawn()
+
+    def _idle_children(self) -> "asyncio.Queue[_Child]":
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self._workers):
+                self._idle.put_nowait(self._spawn())
+        return self._idle
+
+    async def run(
+        self,
+        key: Hashable,
+        func: Callable[..., Any],
+        *args: Any,
+        progress: Optional[ProgressHook] = None,
+    ) -> Any:
+        idle = self._idle_children()
+        child = await idle.get()
+        self._running[key] = child
+        loop = asyncio.get_running_loop()
+        # I log inoltrati dal figlio vengono scritti nel thread di call(): restano legati al job.
+        context = contextvars.copy_context()
+        call = loop.run_in_executor(
+            None, functools.partial(context.run, child.call, func, args, self._timeout, progress)
+        )
+        try:
+            return await call
+        finally:
+            self._running.pop(key, None)
+            if call.cancelled():
+                # Chi attendeva è stato annullato ma il figlio sta ancora lavorando: la sua
+                # risposta arriverebbe al job successivo, quindi il processo va sostituito.
+                # La connessione la chiude il thread di call() quando riceve EOF.
+                logger.warning(
+                    "Processo %s ancora occupato dopo l'annullamento, ne avvio uno nuovo", child.process.name
+                )
+                child.process.kill()
+                child = self._replace(child)
+            elif not child.alive():
+                logger.warning("Processo %s terminato, ne avvio uno nuovo", child.process.name)
+                child.kill()
+                child = self._replace(child)
+            idle.put_nowait(child)
+
+    def cancel(self, key: Hashable) -> bool:
+        child = self._running.get(key)
+        if child is None:
+            return False
+        logger.warning("Termino il processo %s del job %s", child.process.name, key)
+        child.process.kill()
+        return True
+
+    def shutdown(self) -> None:
+        for child in self._children:
+            child.kill()
+        self._children.clear()
+
+
+def create_backend() -> Union[ThreadBackend, ProcessBackend]:
+    if config.EXECUTION_BACKEND == "process":
+        return ProcessBackend(config.PROCESS_POOL_WORKERS, config.PROCESS_JOB_TIMEOUT_S)
+    return ThreadBackend()
+
+
+execution_backend = create_backend()
@@ -0,0 +1,92 @@
+"""
+Scelta del formato in base al limite di invio.
+
+Se il formato predefinito (miglior video + miglior audio) supera il limite di
+upload attivo, il planner esamina la lista ``formats`` restituita da
+``extract_info`` e sceglie, prima di scaricare qualsiasi byte, la coppia
+video+audio (o il formato unico) di qualità più alta la cui dimensione stimata
+sta sotto il limite.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+# Margine per il container MP4 e per le dimensioni approssimate indicate dai siti.
+_SIZE_MARGIN = 0.95
+
+
+@dataclass
+class FormatPlan:
+    selector: str
+    formats: List[dict]
+    size_bytes: float
+    height: Optional[int]
+
+    @property
+    def label(self) -> str:
+        return f"{self.height}p" if self.height else self.selector
+
+
+def format_size(fmt: dict, duration: Optional[float]) -> Optional[float]:
+    """Dimensione del formato in byte, stimata dal bitrate se il sito non la indica."""
+
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return float(size)
+    if fmt.get("tbr") and duration:
+        return fmt["tbr"] * 1000 / 8 * duration
+    return None
+
+
+def _has(fmt: dict, codec: str) -> bool:
+    # yt-dlp usa "none" per una traccia assente e None quando il codec non è noto.
+    return fmt.get(codec) != "none"
+
+
+def _quality(formats: List[dict]) -> Tuple[int, float]:
+    height = max((fmt.get("height") or 0 for fmt in formats), default=0)
+    bitrate = sum(fmt.get("tbr") or fmt.get("abr") or 0 for fmt in formats)
+    return height, bitrate
+
+
+def plan_format(info: dict, limit_mb: float) -> Optional[FormatPlan]:
+    """Miglior formato che sta in ``limit_mb``; ``None`` se nessuno ci sta (o dimensioni ignote)."""
+
+    duration = info.get("duration")
+    budget = limit_mb * 1024 * 1024 * _SIZE_MARGIN
+    sized = []
+    for fmt in info.get("formats") or []:
+        size = format_size(fmt, duration)
+        if size is not None and fmt.get("format_id") and fmt.get("ext") != "mhtml":
+            sized.append((fmt, size))
+
+    videos = [(fmt, size) for fmt, size in sized if _has(fmt, "vcodec") and fmt.get("acodec") == "none"]
+    audios = [(fmt, size) for fmt, size in sized if _has(fmt, "acodec") and fmt.get("vcodec") == "none"]
+    combined = [(fmt, size) for fmt, size in sized if _has(fmt, "vcodec") and _has(fmt, "acodec")]
+
+    candidates: List[Tuple[List[dict], float]] = [([fmt], size) for fmt, size in combined if size <= budget]
+    audios.sort(key=lambda item: _quality([item[0]]), reverse=True)
+    for video, video_size in videos:
+        for audio, audio_size in audios:
+            if video_size + audio_size <= budget:
+                candidates.append(([video, audio], video_size + audio_size))
+                break  # gli audio sono ordinati: il primo che ci sta è il migliore
+
+    if not candidates:
+        return None
+    formats, size = max(candidates, key=lambda item: (_quality(item[0]), -item[1]))
+    return FormatPlan(
+        selector="+".join(fmt["format_id"] for fmt in formats),
+        formats=formats,
+        size_bytes=size,
+        height=_quality(formats)[0] or None,
+    )
+
+
+def apply_plan(info: dict, plan: FormatPlan) -> dict:
+    """Copia di ``info`` con i formati scelti, così stime e controlli usano il nuovo formato."""
+
+    planned = dict(info, requested_formats=plan.formats, format_id=plan.selector)
+    for key in ("filesize", "filesize_approx", "url"):
+        planned.pop(key, None)
+    return planned
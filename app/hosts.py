@@ -0,0 +1,190 @@
+"""
+Limiti per host remoto.
+
+``HostConnectionBudget`` distribuisce un numero massimo di connessioni verso ogni
+host tra i download in corso. Vive nel processo principale anche quando yt-dlp
+gira nel backend a processi: ogni download riceve prima di partire il numero di
+connessioni che può aprire, così più worker insieme non aprono centinaia di
+socket verso la stessa CDN.
+
+``HostRateLimiter`` limita invece la frequenza delle richieste verso ogni sito
+(estrazione e avvio dei download) con un token bucket per host più uno globale,
+e rallenta da solo un sito che risponde con 429 o con una verifica anti-bot.
+"""
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, FrozenSet, Iterable, List, Optional
+from urllib.parse import urlparse
+
+from . import config
+from .metrics import HOST_CONNECTIONS, RATE_LIMIT_BACKOFF_SECONDS, RATE_LIMIT_PER_MIN, RATE_LIMITED
+
+
+def media_hosts(info: Optional[dict], fallback_url: str) -> FrozenSet[str]:
+    """Host da cui verranno scaricati i formati scelti (quello del link se non noti)."""
+
+    formats = (info or {}).get("requested_formats") or [info or {}]
+    hosts = {urlparse(fmt["url"]).hostname for fmt in formats if fmt.get("url")}
+    hosts.discard(None)
+    return frozenset(hosts) or frozenset({urlparse(fallback_url).hostname or ""})
+
+
+class HostConnectionBudget:
+    def __init__(self, max_per_host: int = config.HOST_MAX_CONNECTIONS) -> None:
+        self._max = max(1, max_per_host)
+        self._in_use: Dict[str, int] = {}
+        self._released = asyncio.Event()
+
+    def in_use(self) -> Dict[str, int]:
+        return dict(self._in_use)
+
+    @asynccontextmanager
+    async def connections(self, hosts: Iterable[str], wanted: int) -> AsyncIterator[int]:
+        """
+        Riserva fino a ``wanted`` connessioni verso ciascuno degli ``hosts`` e restituisce
+        quante ne sono state concesse (almeno una; se non ce n'è nessuna libera attende).
+        """
+
+        hosts = frozenset(hosts)
+        while any(self._in_use.get(host, 0) >= self._max for host in hosts):
+            await self._released.wait()
+        granted = min([max(1, wanted)] + [self._max - self._in_use.get(host, 0) for host in hosts])
+        for host in hosts:
+            self._in_use[host] = self._in_use.get(host, 0) + granted
+        try:
+            yield granted
+        finally:
+            for host in hosts:
+                remaining = self._in_use[host] - granted
+                if remaining:
+                    self._in_use[host] = remaining
+                else:
+                    del self._in_use[host]
+            self._released.set()
+            self._released = asyncio.Event()
+
+
+@dataclass(slots=True)
+class _Bucket:
+    max_per_s: float
+    per_s: float
+    tokens: float
+    updated: float
+    blocked_until: float = 0.0
+    failures: int = 0
+    limited: int = 0
+
+    def refill(self, now: float, burst: float) -> None:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * self.per_s)
+        self.updated = now
+
+    def wait_s(self, now: float) -> float:
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.per_s
+
+
+class HostRateLimiter:
+    """
+    Token bucket per host condiviso da tutti i worker, più uno globale.
+
+    La velocità di ogni host si adatta alle risposte (AIMD): a ogni richiesta
+    limitata dal sito (429, "sign in to confirm") viene dimezzata e l'host
+    resta fermo per un backoff esponenziale con jitter; a ogni richiesta riuscita
+    risale di un decimo del massimo configurato. Così più worker insieme restano
+    appena sotto la soglia del sito invece di farsi bloccare a vicenda.
+    """
+
+    def __init__(
+        self,
+        per_min: float = config.RATE_LIMIT_PER_MIN,
+        burst: int = config.RATE_LIMIT_BURST,
+        global_per_min: float = config.RATE_LIMIT_GLOBAL_PER_MIN,
+        host_per_min: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self._per_min = per_min
+        self._burst = max(1, burst)
+        self._host_per_min = dict(config.RATE_LIMIT_HOST_PER_MIN if host_per_min is None else host_per_min)
+        self._buckets: Dict[str, _Bucket] = {}
+        self._global = self._new_bucket(global_per_min) if global_per_min else None
+
+    def _new_bucket(self, per_min: float) -> _Bucket:
+        per_s = max(per_min, 0.1) / 60
+        return _Bucket(max_per_s=per_s, per_s=per_s, tokens=self._burst, updated=time.monotonic())
+
+    def _bucket(self, host: str) -> _Bucket:
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = self._new_bucket(self._host_per_min.get(host, self._per_min))
+        return bucket
+
+    async def acquire(self, host: str) -> None:
+        """Attende un gettone per ``host`` (e uno globale), rispettando l'eventuale backoff."""
+
+        bucket = self._bucket(host)
+        buckets = [bucket] if self._global is None else [bucket, self._global]
+        while True:
+            now = time.monotonic()
+            for item in buckets:
+                item.refill(now, self._burst)
+            wait = max(item.wait_s(now) for item in buckets)
+            if wait <= 0:
+                for item in buckets:
+                    item.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    def backoff_s(self, host: str) -> float:
+        """Secondi di pausa che restano a ``host`` dopo l'ultima richiesta rifiutata."""
+
+        bucket = self._buckets.get(host)
+        return max(bucket.blocked_until - time.monotonic(), 0.0) if bucket is not None else 0.0
+
+    def record(self, host: str, limited: bool) -> float:
+        """Registra l'esito di una richiesta; restituisce il backoff applicato (0 se riuscita)."""
+
+        bucket = self._bucket(host)
+        if not limited:
+            bucket.failures = 0
+            bucket.per_s = min(bucket.max_per_s, bucket.per_s + bucket.max_per_s / 10)
+            return 0.0
+        bucket.failures += 1
+        bucket.limited += 1
+        bucket.per_s = max(bucket.per_s / 2, bucket.max_per_s / 20)
+        bucket.tokens = 0
+        backoff = min(config.RATE_LIMIT_BACKOFF_S * 2 ** (bucket.failures - 1), config.RATE_LIMIT_MAX_BACKOFF_S)
+        # Jitter: i worker fermi sullo stesso host non ripartono tutti nello stesso istante.
+        backoff *= random.uniform(0.5, 1.5)
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + backoff)
+        return backoff
+
+    def state(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "host": host,
+                "per_min": round(bucket.per_s * 60, 2),
+                "max_per_min": round(bucket.max_per_s * 60, 2),
+                "backoff_s": round(max(bucket.blocked_until - now, 0.0), 1),
+                "consecutive_errors": bucket.failures,
+                "limited_total": bucket.limited,
+            }
+            for host, bucket in sorted(self._buckets.items())
+        ]
+
+
+host_connections = HostConnectionBudget()
+HOST_CONNECTIONS.set_function(
+    lambda: {(host,): count for host, count in host_connections.in_use().items()}
+)
+
+rate_limiter = HostRateLimiter()
+RATE_LIMIT_PER_MIN.set_function(lambda: {(row["host"],): row["per_min"] for row in rate_limiter.state()})
+RATE_LIMIT_BACKOFF_SECONDS.set_function(
+    lambda: {(row["host"],): row["backoff_s"] for row in rate_limiter.state()}
+)
+RATE_LIMITED.set_function(lambda: {(row["host"],): row["limited_total"] for row in rate_limiter.state()})
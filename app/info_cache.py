@@ -0,0 +1,110 @@
+"""
+Cache LRU con scadenza dei metadati restituiti da ``extract_info``.
+
+Le voci sono indicizzate per URL normalizzato, quindi un retry, un ``DO`` seguito
+da ``UO`` o più utenti che condividono lo stesso link non ripetono l'estrazione
+(1-3 s su YouTube, con rischio di rate limit). Facoltativamente la cache viene
+salvata su SQLite e ricaricata al riavvio.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+from . import config
+from .downloader import extract_size_mb
+from .metrics import CACHE_REQUESTS
+from .url_utils import normalize_url
+
+logger = logging.getLogger(__name__)
+
+
+class InfoCache:
+    def __init__(self, max_entries: int, ttl_s: float, persist_path: Optional[Path] = None) -> None:
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._persist_path = persist_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        if persist_path is not None:
+            self._load()
+
+    def get(self, url: str) -> Optional[dict]:
+        key = normalize_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl_s:
+                if entry is not None:
+                    self._delete(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, url: str, info: dict) -> None:
+        key = normalize_url(url)
+        stored_at = time.time()
+        with self._lock:
+            self._entries[key] = (stored_at, info)
+            self._entries.move_to_end(key)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO info (url, stored_at, info) VALUES (?, ?, ?)",
+                    (key, stored_at, json.dumps(info)),
+                )
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._delete(oldest)
+
+    def invalidate(self, url: str) -> None:
+        """Scarta i metadati di ``url`` (es. URL dei formati scaduti): la prossima richiesta li rilegge."""
+
+        with self._lock:
+            self._delete(normalize_url(url))
+
+    def estimated_size_mb(self, url: str) -> Optional[float]:
+        """Dimensione stimata del video usando solo i metadati in cache."""
+
+        info = self.get(url)
+        return extract_size_mb(info) if info else None
+
+    def _delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM info WHERE url = ?", (key,))
+
+    def _load(self) -> None:
+        self._persist_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self._persist_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS info (url TEXT PRIMARY KEY, stored_at REAL NOT NULL, info TEXT NOT NULL)"
+        )
+        self._conn.execute("DELETE FROM info WHERE stored_at < ?", (time.time() - self.ttl_s,))
+        rows = self._conn.execute(
+            "SELECT url, stored_at, info FROM info ORDER BY stored_at DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for url, stored_at, raw in reversed(rows):
+            self._entries[url] = (stored_at, json.loads(raw))
+        logger.info("Cache metadati: %s voci ricaricate", len(rows))
+
+
+info_cache = InfoCache(
+    max_entries=config.INFO_CACHE_MAX_ENTRIES,
+    ttl_s=config.INFO_CACHE_TTL_S,
+    persist_path=(
+        Path(config.DOWNLOAD_DIR) / ".cache" / "info.sqlite3" if config.INFO_CACHE_PERSIST else None
+    ),
+)
+CACHE_REQUESTS.set_function(
+    lambda: {("info", "hit"): info_cache.hits, ("info", "miss"): info_cache.misses}
+)
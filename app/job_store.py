@@ -0,0 +1,168 @@
+"""
+Persistenza dei job in coda o in lavorazione, per riprenderli dopo un riavvio.
+
+I job vengono salvati in SQLite (modalità WAL) sotto ``DOWNLOAD_DIR``. Le scritture
+non avvengono nel loop asyncio: ``add``/``mark_running``/``remove`` accodano
+l'operazione in memoria (pochi microsecondi) e un thread dedicato le applica a
+blocchi in un'unica transazione. In caso di crash si perdono al massimo le
+operazioni degli ultimi ``flush_interval_s`` secondi.
+"""
+
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from . import config
+from .metrics import JOB_STORE_ENQUEUE_SECONDS, JOB_STORE_ENQUEUED
+
+logger = logging.getLogger(__name__)
+
+_STOP = None
+
+
+class JobStore:
+    def __init__(
+        self,
+        db_path: Path,
+        enabled: bool = True,
+        flush_interval_s: float = 0.05,
+        batch_size: int = 200,
+    ) -> None:
+        self.db_path = db_path
+        self.enabled = enabled
+        self.flush_interval_s = flush_interval_s
+        self.batch_size = batch_size
+        self._ops: "queue.SimpleQueue[Optional[tuple]]" = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.enqueue_count = 0
+        self.enqueue_total_s = 0.0
+        self.enqueue_max_s = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, payload TEXT NOT NULL, state TEXT NOT NULL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        return conn
+
+    def _submit(self, op: tuple) -> None:
+        if self._writer is None:
+            with self._start_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name="job-store", daemon=True)
+                    self._writer.start()
+        self._ops.put(op)
+
+    def add(self, job_id: str, payload: dict) -> None:
+        if not self.enabled:
+            return
+        started = time.perf_counter()
+        now = time.time()
+        self._submit(("add", job_id, json.dumps(payload), now))
+        elapsed = time.perf_counter() - started
+        self.enqueue_count += 1
+        self.enqueue_total_s += elapsed
+        self.enqueue_max_s = max(self.enqueue_max_s, elapsed)
+
+    def mark_running(self, job_id: str) -> None:
+        if self.enabled:
+            self._submit(("running", job_id, time.time()))
+
+    def remove(self, job_id: str) -> None:
+        if self.enabled:
+            self._submit(("remove", job_id))
+
+    def unfinished(self) -> List[dict]:
+        """Job rimasti in coda o in lavorazione all'ultimo arresto, in ordine di arrivo."""
+
+        if not self.enabled:
+            return []
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT payload FROM jobs ORDER BY created_at").fetchall()
+        finally:
+            conn.close()
+        return [json.loads(row[0]) for row in rows]
+
+    def stats(self) -> dict:
+        average = self.enqueue_total_s / self.enqueue_count if self.enqueue_count else 0.0
+        return {
+            "enqueued": self.enqueue_count,
+            "enqueue_avg_ms": average * 1000,
+            "enqueue_max_ms": self.enqueue_max_s * 1000,
+        }
+
+    def close(self) -> None:
+        """Applica le operazioni ancora in memoria e ferma il thread di scrittura."""
+
+        if self._writer is not None:
+            self._ops.put(_STOP)
+            self._writer.join(timeout=5)
+            self._writer = None
+
+    def _run(self) -> None:
+        conn = self._connect()
+        while True:
+            batch = [self._ops.get()]
+            deadline = time.monotonic() + self.flush_interval_s
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._ops.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    for op in batch:
+                        if op is not _STOP:
+                            self._apply(conn, op)
+            except sqlite3.Error:
+                logger.exception("Errore durante il salvataggio della coda dei job")
+            if batch[-1] is _STOP:
+                conn.close()
+                return
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, op: tuple) -> None:
+        kind = op[0]
+        if kind == "add":
+            _, job_id, payload, now = op
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, payload, state, created_at, updated_at) "
+                "VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, payload, now, now),
+            )
+        elif kind == "running":
+            _, job_id, now = op
+            conn.execute(
+                "UPDATE jobs SET state = 'running', updated_at = ? WHERE job_id = ?", (now, job_id)
+            )
+        elif kind == "remove":
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (op[1],))
+
+
+job_store = JobStore(
+    Path(config.DOWNLOAD_DIR) / ".cache" / "jobs.sqlite3",
+    # Sui worker i job in corso li conserva il broker.
+    enabled=config.DURABLE_QUEUE_ENABLED and config.APP_ROLE != "worker",
+)
+JOB_STORE_ENQUEUED.set_function(lambda: job_store.stats()["enqueued"])
+JOB_STORE_ENQUEUE_SECONDS.set_function(
+    lambda: {
+        ("avg",): job_store.stats()["enqueue_avg_ms"] / 1000,
+        ("max",): job_store.stats()["enqueue_max_ms"] / 1000,
+    }
+)
@@ -1,21 +1,166 @@
+"""
+Pipeline dei log: i logger dell'app (e yt-dlp nei thread dell'executor) mettono i
+record in una coda con ``QueueHandler`` senza formattarli; un ``QueueListener`` in
+un thread dedicato li passa alla console e al buffer circolare della web GUI, che li
+formatta solo quando qualcuno li legge.
+"""
+
 import logging
-from collections import deque
-from typing import Deque, List
+import queue
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Iterator, List, Optional, Sequence, Tuple
 
 from . import config
 
+# Job in lavorazione nel task (o nel thread dell'executor) che scrive il log.
+current_job_id: ContextVar[Optional[int]] = ContextVar("current_job_id", default=None)
+
+
+class JobContextFilter(logging.Filter):
+    """Aggiunge ``job_id`` ai record; gira nel thread che scrive il log, dove il contesto è noto."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id = current_job_id.get()
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    ``QueueHandler`` che non formatta il messaggio: messaggio e argomenti restano
+    separati fino alla lettura. Solo il traceback viene convertito subito in testo,
+    per non tenere in vita i frame.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _Slot:
+    __slots__ = ("seq", "record", "line")
+
+    def __init__(self) -> None:
+        self.seq = 0
+        self.record: Optional[logging.LogRecord] = None
+        self.line: Optional[str] = None
+
 
 class InMemoryLogHandler(logging.Handler):
+    """
+    Buffer circolare degli ultimi ``max_records`` record, con un numero progressivo.
+    Gli slot sono allocati una volta sola; la riga di testo viene prodotta (e
+    ricordata) alla prima lettura.
+    """
+
     def __init__(self, max_records: int):
         super().__init__()
-        self.records: Deque[str] = deque(maxlen=max_records)
+        self._slots = [_Slot() for _ in range(max(1, max_records))]
+        self.last_seq = 0
 
     def emit(self, record: logging.LogRecord) -> None:
-        msg = self.format(record)
-        self.records.append(msg)
+        # emit() è chiamato con il lock dell'handler: il numero progressivo è univoco.
+        seq = self.last_seq + 1
+        slot = self._slots[seq % len(self._slots)]
+        slot.seq, slot.record, slot.line = seq, record, None
+        self.last_seq = seq
+
+    def _line(self, slot: _Slot) -> str:
+        if slot.line is None:
+            try:
+                slot.line = self.format(slot.record)
+            except Exception:
+                slot.line = f"{slot.record.levelname} {slot.record.name}: {slot.record.msg!r}"
+        return slot.line
+
+    @staticmethod
+    def _message(record: logging.LogRecord) -> str:
+        try:
+            return record.getMessage()
+        except Exception:
+            return str(record.msg)
+
+    def _matching(
+        self,
+        seq: int,
+        limit: int,
+        level: int = logging.NOTSET,
+        logger: Optional[str] = None,
+        job_id: Optional[int] = None,
+    ) -> Iterator[_Slot]:
+        """Slot successivi a ``seq`` che passano i filtri, dal più recente (da chiamare con il lock)."""
+
+        found = 0
+        oldest = max(seq, self.last_seq - len(self._slots)) + 1
+        for current in range(self.last_seq, oldest - 1, -1):
+            if found >= limit:
+                return
+            slot = self._slots[current % len(self._slots)]
+            record = slot.record
+            if record.levelno < level or (job_id is not None and getattr(record, "job_id", None) != job_id):
+                continue
+            if logger and record.name != logger and not record.name.startswith(logger + "."):
+                continue
+            found += 1
+            yield slot
 
     def list_logs(self) -> List[str]:
-        return list(self.records)[::-1]
+        return [line for _, line in self.logs_since(0, len(self._slots))]
+
+    def logs_since(self, seq: int, limit: int) -> List[Tuple[int, str]]:
+        """Righe con numero progressivo maggiore di ``seq``, dalla più recente."""
+
+        with self.lock:
+            return [(slot.seq, self._line(slot)) for slot in self._matching(seq, limit)]
+
+    def records_since(
+        self,
+        seq: int,
+        limit: int,
+        level: int = logging.NOTSET,
+        logger: Optional[str] = None,
+        job_id: Optional[int] = None,
+    ) -> List[dict]:
+        """
+        Record strutturati con numero progressivo maggiore di ``seq``, dal più recente.
+        Filtri opzionali: livello minimo, logger (compresi i suoi figli) e job.
+        """
+
+        with self.lock:
+            return [
+                {
+                    "seq": slot.seq,
+                    "time": slot.record.created,
+                    "level": slot.record.levelname,
+                    "logger": slot.record.name,
+                    "job_id": getattr(slot.record, "job_id", None),
+                    "message": self._message(slot.record),
+                    "line": self._line(slot),
+                }
+                for slot in self._matching(seq, limit, level, logger, job_id)
+            ]
+
+
+def start_queue_logging(level: int, handlers: Sequence[logging.Handler]) -> QueueListener:
+    """
+    Collega il logger radice alla coda e avvia il thread che inoltra i record a
+    ``handlers``. Va fermato con ``stop()`` per scrivere gli ultimi record.
+    """
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records)
+    queue_handler.addFilter(JobContextFilter())
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
 
 
 log_buffer = InMemoryLogHandler(max_records=config.LOG_BUFFER_LIMIT)
@@ -3,53 +3,114 @@
 
 import asyncio
 import logging
+import secrets
+from logging.handlers import QueueListener
+from typing import Optional
 
 import uvicorn
-from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+from telegram import Bot, Update
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, filters
 
 from . import config
-from .bot_handlers import handle_start, handle_text
-from .logging_utils import log_buffer
+from .bot_handlers import handle_cancel, handle_start, handle_text
+from .broker import Broker, create_broker
+from .cluster import ClusterFrontend, ClusterWorker
+from .download_queue import download_queue
+from .executor_backend import execution_backend
+from .job_store import job_store
+from .logging_utils import log_buffer, start_queue_logging
+from .uploader import local_api_uploader
 from .web import create_web_app
 
 
-def setup_logging() -> None:
+def setup_logging() -> QueueListener:
     log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.INFO)
     formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
-    logging.basicConfig(level=log_level, handlers=[stream_handler])
-
     log_buffer.setFormatter(formatter)
-    logging.getLogger().addHandler(log_buffer)
+    # Console e buffer della web GUI girano nel thread del listener, non in chi scrive il log.
+    return start_queue_logging(log_level, [stream_handler, log_buffer])
 
 
-async def run_bot() -> None:
+def build_application() -> Application:
     builder = ApplicationBuilder().token(config.BOT_TOKEN)
+    builder = builder.concurrent_updates(max(1, config.BOT_CONCURRENT_UPDATES))
+    if config.TELEGRAM_WEBHOOK_ENABLED:
+        # Gli update arrivano dalla web GUI: niente Updater né long polling.
+        builder = builder.updater(None)
 
     if config.TELEGRAM_BOT_API_ENABLED:
         builder = builder.base_url(config.TELEGRAM_BOT_API_BASE_URL).base_file_url(
             config.TELEGRAM_BOT_API_FILE_URL
         )
+        if config.TELEGRAM_BOT_API_LOCAL_MODE:
+            builder = builder.local_mode(True)
 
     application = builder.build()
     application.add_handler(CommandHandler("start", handle_start))
+    application.add_handler(CommandHandler("cancel", handle_cancel))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    return application
+
 
+async def run_bot(application: Application, webhook_secret: str = "") -> None:
     await application.initialize()
     await application.start()
-    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    broker: Optional[Broker] = None
+    if config.APP_ROLE == "frontend":
+        broker = create_broker()
+        frontend = ClusterFrontend(broker)
+        download_queue.attach_frontend(frontend)
+        await frontend.start()
+    await download_queue.restore(application.bot)
+    if application.updater is not None:
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        webhook_url = config.TELEGRAM_WEBHOOK_URL.rstrip("/") + config.TELEGRAM_WEBHOOK_PATH
+        await application.bot.set_webhook(
+            webhook_url,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=config.TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+            secret_token=webhook_secret,
+        )
+        logging.info("Webhook Telegram impostato su %s", webhook_url)
     try:
         await asyncio.Event().wait()
     finally:
-        await application.updater.stop()
+        if application.updater is not None:
+            await application.updater.stop()
         await application.stop()
         await application.shutdown()
+        if broker is not None:
+            await broker.close()
+
+
+async def run_worker() -> None:
+    # Il bot serve solo per caricare i file nella chat di archivio.
+    bot: Optional[Bot] = None
+    if not config.CLUSTER_SHARED_STORAGE:
+        if config.TELEGRAM_BOT_API_ENABLED:
+            bot = Bot(
+                config.BOT_TOKEN,
+                base_url=config.TELEGRAM_BOT_API_BASE_URL,
+                base_file_url=config.TELEGRAM_BOT_API_FILE_URL,
+                local_mode=config.TELEGRAM_BOT_API_LOCAL_MODE,
+            )
+        else:
+            bot = Bot(config.BOT_TOKEN)
+        await bot.initialize()
+    broker = create_broker()
+    try:
+        await ClusterWorker(broker).run(bot)
+    finally:
+        await broker.close()
+        if bot is not None:
+            await bot.shutdown()
 
 
-async def run_web() -> None:
-    app = create_web_app()
+async def run_web(telegram_app: Optional[Application] = None, webhook_secret: str = "") -> None:
+    app = create_web_app(telegram_app, webhook_secret)
     config_uvicorn = uvicorn.Config(
         app,
         host=config.WEB_APP_HOST,
@@ -62,9 +123,26 @@ async def run_web() -> None:
 
 
 async def main_async() -> None:
-    setup_logging()
-    logging.info("Avvio bot e web GUI")
-    await asyncio.gather(run_bot(), run_web())
+    listener = setup_logging()
+    try:
+        if config.APP_ROLE == "worker":
+            logging.info("Avvio worker e web GUI")
+            await asyncio.gather(run_worker(), run_web())
+        elif config.TELEGRAM_WEBHOOK_ENABLED:
+            if not config.TELEGRAM_WEBHOOK_URL:
+                raise RuntimeError("TELEGRAM_WEBHOOK_ENABLED richiede TELEGRAM_WEBHOOK_URL")
+            logging.info("Avvio bot (webhook) e web GUI sullo stesso server")
+            application = build_application()
+            webhook_secret = config.TELEGRAM_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+            await asyncio.gather(run_bot(application, webhook_secret), run_web(application, webhook_secret))
+        else:
+            logging.info("Avvio bot e web GUI")
+            await asyncio.gather(run_bot(build_application()), run_web())
+    finally:
+        execution_backend.shutdown()
+        job_store.close()
+        await local_api_uploader.close()
+        listener.stop()
 
 
 def main() -> None:
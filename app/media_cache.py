@@ -0,0 +1,240 @@
+"""
+Cache dei file scaricati indicizzata per contenuto.
+
+Ogni video è identificato da ``(extractor, video_id, formato)`` e conservato una
+sola volta sotto ``<DOWNLOAD_DIR>/.cache/media``; le cartelle dei singoli utenti
+contengono solo hardlink (o symlink) verso la copia in cache. L'indice SQLite
+associa anche gli URL normalizzati già visti alla loro chiave, così una richiesta
+ripetuta trova il file prima ancora di contattare il sito.
+"""
+
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from . import config
+from .downloader import cleanup_file
+from .url_utils import normalize_url, video_key_from_url
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    extractor TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    format TEXT NOT NULL,
+    path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (extractor, video_id, format)
+);
+CREATE TABLE IF NOT EXISTS url_aliases (
+    url TEXT PRIMARY KEY,
+    extractor TEXT NOT NULL,
+    video_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS links (
+    path TEXT PRIMARY KEY,
+    extractor TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    format TEXT NOT NULL
+);
+"""
+
+
+@dataclass
+class CachedMedia:
+    extractor: str
+    video_id: str
+    format: str
+    path: Path
+    filename: str
+    size: int
+
+
+def _safe_name(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]", "_", value) or "_"
+
+
+def link_file(source: Path, target: Path) -> Path:
+    """Crea ``target`` come hardlink di ``source`` (symlink o copia se non possibile)."""
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists():
+        if target.samefile(source):
+            return target
+        target = target.with_name(f"{target.stem}-{int(time.time())}{target.suffix}")
+    try:
+        os.link(source, target)
+    except OSError:
+        try:
+            target.symlink_to(source.resolve())
+        except OSError:
+            shutil.copy2(source, target)
+    return target
+
+
+class MediaCache:
+    def __init__(self, base_dir: str) -> None:
+        self.root = Path(base_dir) / ".cache"
+        self.media_dir = self.root / "media"
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.media_dir.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(
+                self.root / "index.sqlite3", check_same_thread=False, isolation_level=None
+            )
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def lookup_url(self, url: str, fmt: str) -> Optional[CachedMedia]:
+        """Cerca il file partendo solo dall'URL, senza alcuna richiesta di rete."""
+
+        key = video_key_from_url(url)
+        with self._lock:
+            if key is None:
+                row = (
+                    self._db()
+                    .execute(
+                        "SELECT extractor, video_id FROM url_aliases WHERE url = ?",
+                        (normalize_url(url),),
+                    )
+                    .fetchone()
+                )
+                if row is None:
+                    return None
+                key = (row[0], row[1])
+        return self.lookup(key[0], key[1], fmt)
+
+    def lookup(self, extractor: str, video_id: str, fmt: str) -> Optional[CachedMedia]:
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT path, filename, size FROM media "
+                "WHERE extractor = ? AND video_id = ? AND format = ?",
+                (extractor, video_id, fmt),
+            ).fetchone()
+            if row is None:
+                return None
+            path = Path(row[0])
+            if not path.exists():
+                db.execute(
+                    "DELETE FROM media WHERE extractor = ? AND video_id = ? AND format = ?",
+                    (extractor, video_id, fmt),
+                )
+                return None
+            db.execute(
+                "UPDATE media SET last_used = ? "
+                "WHERE extractor = ? AND video_id = ? AND format = ?",
+                (time.time(), extractor, video_id, fmt),
+            )
+        return CachedMedia(extractor, video_id, fmt, path, row[1], row[2])
+
+    def remember_url(self, url: str, extractor: str, video_id: str) -> None:
+        if video_key_from_url(url) is not None:
+            return
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO url_aliases (url, extractor, video_id) VALUES (?, ?, ?)",
+                (normalize_url(url), extractor, video_id),
+            )
+
+    def store(self, extractor: str, video_id: str, fmt: str, path: Path) -> CachedMedia:
+        """
+        Sposta il file appena scaricato nella cache e lascia al suo posto un link,
+        così la cartella dell'utente resta invariata.
+        """
+
+        cached_path = (
+            self.media_dir / _safe_name(extractor) / f"{_safe_name(video_id)}-{_safe_name(fmt)}{path.suffix}"
+        )
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+        if not cached_path.exists() or not cached_path.samefile(path):
+            os.replace(path, cached_path)
+            link_file(cached_path, path)
+        size = cached_path.stat().st_size
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO media "
+                "(extractor, video_id, format, path, filename, size, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (extractor, video_id, fmt, str(cached_path), path.name, size, now, now),
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO links (path, extractor, video_id, format) VALUES (?, ?, ?, ?)",
+                (str(path), extractor, video_id, fmt),
+            )
+        logger.info("File aggiunto alla cache: %s", cached_path)
+        return CachedMedia(extractor, video_id, fmt, cached_path, path.name, size)
+
+    def link_for_user(self, media: CachedMedia, target_dir: Path) -> Path:
+        target = link_file(media.path, target_dir / media.filename)
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO links (path, extractor, video_id, format) VALUES (?, ?, ?, ?)",
+                (str(target), media.extractor, media.video_id, media.format),
+            )
+        return target
+
+    def share(self, path: Path, target: Path) -> Path:
+        """Crea un altro link al file ``path`` (già in cache o meno) e lo registra."""
+
+        target = link_file(path, target)
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT extractor, video_id, format FROM links WHERE path = ?", (str(path),)
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO links (path, extractor, video_id, format) VALUES (?, ?, ?, ?)",
+                    (str(target), *row),
+                )
+        return target
+
+    def discard(self, path: Path) -> None:
+        """
+        Rimuove il file dalla cartella dell'utente; se era l'ultimo riferimento
+        alla copia in cache, elimina anche quella.
+        """
+
+        cleanup_file(path)
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT extractor, video_id, format FROM links WHERE path = ?", (str(path),)
+            ).fetchone()
+            if row is None:
+                return
+            db.execute("DELETE FROM links WHERE path = ?", (str(path),))
+            remaining = db.execute(
+                "SELECT COUNT(*) FROM links WHERE extractor = ? AND video_id = ? AND format = ?",
+                row,
+            ).fetchone()[0]
+            if remaining:
+                return
+            media = db.execute(
+                "SELECT path FROM media WHERE extractor = ? AND video_id = ? AND format = ?", row
+            ).fetchone()
+            db.execute(
+                "DELETE FROM media WHERE extractor = ? AND video_id = ? AND format = ?", row
+            )
+        if media:
+            cleanup_file(Path(media[0]))
+
+
+media_cache = MediaCache(config.DOWNLOAD_DIR)
@@ -0,0 +1,240 @@
+"""
+Metriche in formato testo di Prometheus, senza dipendenze esterne.
+
+Contatori e istogrammi costano un lock e qualche somma per osservazione, quindi
+si possono usare nei punti caldi della pipeline. I valori che esistono già in
+altri oggetti (code, cache, tracker) non vengono duplicati: la metrica riceve
+una funzione che li legge al momento dell'esportazione su ``/metrics``.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+LabelValues = Tuple[str, ...]
+SampleFunction = Callable[[], Union[float, Dict[LabelValues, float]]]
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+THROUGHPUT_BUCKETS_MBPS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._function: Optional[SampleFunction] = None
+
+    def set_function(self, function: SampleFunction) -> None:
+        """Legge i valori da ``function`` a ogni esportazione invece di memorizzarli."""
+
+        self._function = function
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _function_samples(self) -> Dict[LabelValues, float]:
+        if self._function is None:
+            return {}
+        values = self._function()
+        return values if isinstance(values, dict) else {(): values}
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        values.update(self._function_samples())
+        lines = super().render()
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per ogni combinazione di etichette: conteggi per bucket (non cumulativi), somma, totale.
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = {key: (list(counts), total[0]) for key, (counts, total) in self._series.items()}
+        lines = super().render()
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+QUEUE_PENDING = registry.gauge("tgdl_queue_pending_jobs", "Job in attesa nelle code per utente")
+STAGE_QUEUE_DEPTH = registry.gauge(
+    "tgdl_stage_queue_depth", "Job in attesa tra una fase e la successiva", ["stage"]
+)
+STAGE_BUSY_WORKERS = registry.gauge("tgdl_stage_busy_workers", "Worker occupati per fase", ["stage"])
+WORKER_BUSY_SECONDS = registry.counter(
+    "tgdl_worker_busy_seconds_total", "Tempo passato da ogni worker a elaborare job", ["stage", "worker"]
+)
+QUEUE_WAIT_SECONDS = registry.histogram(
+    "tgdl_queue_wait_seconds", "Attesa dall'accodamento all'inizio dell'estrazione"
+)
+STAGE_SECONDS = registry.histogram("tgdl_stage_seconds", "Durata di ogni fase della pipeline", ["stage"])
+EXTRACT_INFO_SECONDS = registry.histogram(
+    "tgdl_extract_info_seconds", "Durata di extract_info (solo richieste non in cache)"
+)
+DOWNLOAD_SECONDS = registry.histogram(
+    "tgdl_download_seconds", "Durata del download escluso il post-processing"
+)
+DOWNLOAD_THROUGHPUT = registry.histogram(
+    "tgdl_download_throughput_mbps", "Velocità media dei download in MB/s", buckets=THROUGHPUT_BUCKETS_MBPS
+)
+POSTPROCESS_SECONDS = registry.histogram(
+    "tgdl_postprocess_seconds", "Durata del post-processing di yt-dlp (merge, remux)"
+)
+UPLOAD_SECONDS = registry.histogram(
+    "tgdl_upload_seconds", "Durata dell'invio su Telegram", ["method"]
+)
+CACHE_REQUESTS = registry.counter(
+    "tgdl_cache_requests_total", "Ricerche nelle cache per esito", ["cache", "result"]
+)
+STORAGE_USED_BYTES = registry.gauge("tgdl_storage_used_bytes", "Byte occupati dai file in DOWNLOAD_DIR")
+STORAGE_RESERVED_BYTES = registry.gauge(
+    "tgdl_storage_reserved_bytes", "Byte riservati dai download in corso"
+)
+STORAGE_EVICTIONS = registry.counter(
+    "tgdl_storage_evictions_total", "File eliminati per liberare spazio, per motivo", ["reason"]
+)
+HOST_CONNECTIONS = registry.gauge(
+    "tgdl_host_connections", "Connessioni concesse ai download in corso per host", ["host"]
+)
+RATE_LIMIT_PER_MIN = registry.gauge(
+    "tgdl_rate_limit_per_min", "Richieste al minuto concesse per host (si adatta ai 429)", ["host"]
+)
+RATE_LIMIT_BACKOFF_SECONDS = registry.gauge(
+    "tgdl_rate_limit_backoff_seconds", "Secondi di pausa rimanenti per host dopo un 429", ["host"]
+)
+RATE_LIMITED = registry.counter(
+    "tgdl_rate_limited_total", "Richieste rifiutate dai siti per troppe richieste, per host", ["host"]
+)
+JOB_STORE_ENQUEUED = registry.counter(
+    "tgdl_job_store_enqueued_total", "Job salvati nella coda persistente"
+)
+JOB_STORE_ENQUEUE_SECONDS = registry.gauge(
+    "tgdl_job_store_enqueue_seconds", "Tempo per accodare un salvataggio nella coda persistente", ["stat"]
+)
+CLUSTER_JOBS = registry.gauge(
+    "tgdl_cluster_jobs", "Job sul broker per stato (solo sul front end)", ["state"]
+)
+JOBS_BY_STATUS = registry.gauge("tgdl_jobs", "Download nello storico per stato attuale", ["status"])
+STATUS_TRANSITIONS = registry.counter(
+    "tgdl_status_transitions_total", "Passaggi dei job a ciascuno stato", ["status"]
+)
@@ -0,0 +1,103 @@
+"""
+Avanzamento dei job in tempo reale.
+
+Gli hook di yt-dlp e l'uploader pubblicano lo stato dal thread (o dal processo
+figlio, tramite la pipe del backend) in cui girano. ``ProgressChannel`` conserva
+solo l'ultimo valore per ogni job e lo consegna al loop asyncio al massimo una
+volta ogni ``interval_s`` secondi, qualunque sia la frequenza degli hook.
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+ProgressSubscriber = Callable[[Dict[int, dict]], Awaitable[None]]
+
+
+def _format_mb(value: float) -> str:
+    return f"{value / (1024 * 1024):.1f}"
+
+
+def _format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+def format_progress(data: dict) -> str:
+    """Testo leggibile, ad esempio ``45% · 12.3/27.0 MB · 3.1 MB/s · ETA 0:05``."""
+
+    done = data.get("bytes_done") or 0
+    total = data.get("bytes_total")
+    parts = []
+    if total:
+        parts.append(f"{min(done * 100 / total, 100):.0f}%")
+        parts.append(f"{_format_mb(done)}/{_format_mb(total)} MB")
+    else:
+        parts.append(f"{_format_mb(done)} MB")
+    if data.get("speed_bps"):
+        parts.append(f"{_format_mb(data['speed_bps'])} MB/s")
+    if data.get("eta_s") is not None:
+        parts.append(f"ETA {_format_eta(data['eta_s'])}")
+    return " · ".join(parts)
+
+
+class ProgressChannel:
+    def __init__(self, interval_s: float) -> None:
+        self.interval_s = interval_s
+        self._latest: Dict[int, dict] = {}
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: List[ProgressSubscriber] = []
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def subscribe(self, callback: ProgressSubscriber) -> None:
+        self._subscribers.append(callback)
+
+    def hook_for(self, entry_id: int) -> Callable[[dict], None]:
+        """Hook da passare a yt-dlp o all'uploader; va creato dal loop asyncio."""
+
+        self._loop = asyncio.get_running_loop()
+        return lambda data: self.publish(entry_id, data)
+
+    def publish(self, entry_id: int, data: dict) -> None:
+        """Chiamabile da qualsiasi thread: sovrascrive il valore precedente non ancora consegnato."""
+
+        with self._lock:
+            self._latest[entry_id] = data
+            if self._flush_scheduled or self._loop is None:
+                return
+            self._flush_scheduled = True
+        self._loop.call_soon_threadsafe(self._loop.call_later, self.interval_s, self._start_flush)
+
+    def discard(self, entry_id: int) -> None:
+        """Scarta l'avanzamento non ancora consegnato, ad esempio quando la fase è finita."""
+
+        with self._lock:
+            self._latest.pop(entry_id, None)
+
+    def _start_flush(self) -> None:
+        task = asyncio.create_task(self._flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self) -> None:
+        with self._lock:
+            batch, self._latest = self._latest, {}
+            self._flush_scheduled = False
+        if not batch:
+            return
+        for callback in self._subscribers:
+            try:
+                await callback(batch)
+            except Exception:
+                logger.exception("Errore durante l'aggiornamento dell'avanzamento")
+
+
+progress_channel = ProgressChannel(config.PROGRESS_UPDATE_INTERVAL_S)
@@ -0,0 +1,196 @@
+"""
+Ordine in cui la coda serve i job in attesa (``SCHEDULING_POLICY``).
+
+- ``FairScheduler`` (``"fair"``): a turno tra gli utenti e, per ogni utente, in
+  ordine di arrivo.
+- ``PriorityScheduler`` (``"priority"``): per classe di priorità e, a parità di
+  classe, prima i video più piccoli (shortest job first), con un invecchiamento
+  che fa avanzare i job che attendono da tempo.
+"""
+
+import asyncio
+import heapq
+from collections import deque
+from itertools import count
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from . import config
+
+if TYPE_CHECKING:
+    from .download_queue import DownloadJob
+
+
+class FairScheduler:
+    """Round-robin tra gli utenti: un utente con tanti job pesanti non blocca gli altri."""
+
+    def __init__(self) -> None:
+        self._user_queues: Dict[Optional[int], Deque["DownloadJob"]] = {}
+        self._rotation: Deque[Optional[int]] = deque()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, entry_id: int) -> bool:
+        return any(job.entry_id == entry_id for queue in self._user_queues.values() for job in queue)
+
+    def push(self, job: "DownloadJob", size_mb: Optional[float] = None) -> int:
+        """Accoda il job e restituisce la posizione (1-based) in cui verrà servito."""
+
+        user_queue = self._user_queues.get(job.user_id)
+        if user_queue is None:
+            user_queue = self._user_queues[job.user_id] = deque()
+            self._rotation.append(job.user_id)
+        user_queue.append(job)
+        self._size += 1
+        return self._dispatch_order(job.user_id, len(user_queue))
+
+    def update_estimate(self, entry_id: int, size_mb: Optional[float]) -> Optional[int]:
+        """La dimensione non cambia l'ordine: nessuna nuova posizione."""
+
+        return None
+
+    def pop(self) -> Optional["DownloadJob"]:
+        if not self._rotation:
+            return None
+        user_key = self._rotation.popleft()
+        user_queue = self._user_queues[user_key]
+        job = user_queue.popleft()
+        if user_queue:
+            self._rotation.append(user_key)
+        else:
+            del self._user_queues[user_key]
+        self._size -= 1
+        return job
+
+    def remove(self, entry_id: int) -> Optional["DownloadJob"]:
+        for user_key, user_queue in self._user_queues.items():
+            for job in user_queue:
+                if job.entry_id != entry_id:
+                    continue
+                user_queue.remove(job)
+                if not user_queue:
+                    del self._user_queues[user_key]
+                    self._rotation.remove(user_key)
+                self._size -= 1
+                return job
+        return None
+
+    def _dispatch_order(self, user_key: Optional[int], depth: int) -> int:
+        """Posizione (1-based) in cui verrà servito il ``depth``-esimo job dell'utente."""
+
+        ahead = depth - 1
+        before_user = True
+        for other in self._rotation:
+            if other == user_key:
+                before_user = False
+                continue
+            turns = depth if before_user else depth - 1
+            ahead += min(len(self._user_queues[other]), turns)
+        return ahead + 1
+
+
+def priority_class(job: "DownloadJob") -> int:
+    """Classe del job (0 = la più alta): somma di quella dell'utente e di quella della modalità."""
+
+    return config.PRIORITY_USER_CLASSES.get(job.user_id, 0) + config.PRIORITY_MODE_CLASSES.get(job.mode, 0)
+
+
+class PriorityScheduler:
+    """
+    Serve per primo il job con il punteggio più basso:
+    ``classe * PRIORITY_CLASS_WEIGHT_MB + MB stimati - MB di invecchiamento``.
+
+    L'invecchiamento toglie a tutti i job in attesa lo stesso punteggio al secondo,
+    quindi l'ordine tra due job non cambia nel tempo: la chiave del heap si calcola
+    una volta all'arrivo (e di nuovo quando si scopre la dimensione) usando l'orario
+    di arrivo al posto dell'attesa. Le chiavi superate restano nel heap e vengono
+    scartate quando emergono.
+    """
+
+    def __init__(
+        self,
+        class_weight_mb: float = config.PRIORITY_CLASS_WEIGHT_MB,
+        aging_mb_per_min: float = config.SCHEDULING_AGING_MB_PER_MIN,
+        unknown_size_mb: float = config.SCHEDULING_UNKNOWN_SIZE_MB,
+    ) -> None:
+        self._class_weight = class_weight_mb
+        self._aging_per_s = aging_mb_per_min / 60
+        self._unknown_size = unknown_size_mb
+        self._heap: List[Tuple[float, int, int]] = []
+        self._jobs: Dict[int, Tuple[float, int, "DownloadJob"]] = {}
+        self._sequence = count()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def __contains__(self, entry_id: int) -> bool:
+        return entry_id in self._jobs
+
+    def score(self, job: "DownloadJob", size_mb: Optional[float]) -> float:
+        size = self._unknown_size if size_mb is None else size_mb
+        return priority_class(job) * self._class_weight + size + self._aging_per_s * job.enqueued_at
+
+    def _insert(self, job: "DownloadJob", size_mb: Optional[float]) -> None:
+        key, sequence = self.score(job, size_mb), next(self._sequence)
+        self._jobs[job.entry_id] = (key, sequence, job)
+        heapq.heappush(self._heap, (key, sequence, job.entry_id))
+
+    def push(self, job: "DownloadJob", size_mb: Optional[float] = None) -> int:
+        self._insert(job, size_mb)
+        return self.position(job.entry_id)
+
+    def update_estimate(self, entry_id: int, size_mb: Optional[float]) -> Optional[int]:
+        """Ricolloca un job in attesa con la dimensione scoperta; restituisce la nuova posizione."""
+
+        current = self._jobs.get(entry_id)
+        if current is None:
+            return None
+        self._insert(current[2], size_mb)
+        return self.position(entry_id)
+
+    def position(self, entry_id: int) -> int:
+        key, sequence, _ = self._jobs[entry_id]
+        return 1 + sum(1 for other_key, other_seq, _ in self._jobs.values() if (other_key, other_seq) < (key, sequence))
+
+    def pop(self) -> Optional["DownloadJob"]:
+        while self._heap:
+            key, sequence, entry_id = heapq.heappop(self._heap)
+            current = self._jobs.get(entry_id)
+            if current is not None and current[:2] == (key, sequence):
+                del self._jobs[entry_id]
+                return current[2]
+        return None
+
+    def remove(self, entry_id: int) -> Optional["DownloadJob"]:
+        current = self._jobs.pop(entry_id, None)
+        if current is None:
+            return None
+        # La sua voce nel heap viene scartata quando emerge (vedi ``pop``).
+        if not self._jobs:
+            self._heap.clear()
+        return current[2]
+
+
+class ScoredQueue(asyncio.PriorityQueue):
+    """
+    Coda tra le fasi della pipeline che fa uscire per primo l'elemento con il punteggio
+    più basso (a parità, il primo arrivato). Si usa come una ``asyncio.Queue``.
+    """
+
+    def __init__(self, maxsize: int, score: Callable[[Any], float]) -> None:
+        super().__init__(maxsize)
+        self._score = score
+        self._sequence = count()
+
+    def _put(self, item: Any) -> None:
+        super()._put((self._score(item), next(self._sequence), item))
+
+    def _get(self) -> Any:
+        return super()._get()[2]
+
+
+def create_scheduler(policy: str = config.SCHEDULING_POLICY) -> Union[FairScheduler, PriorityScheduler]:
+    if policy == "priority":
+        return PriorityScheduler()
+    return FairScheduler()
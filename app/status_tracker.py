@@ -1,11 +1,14 @@
 import asyncio
-from collections import deque
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Deque, List, Optional
+from typing import Deque, Dict, Iterable, List, Optional
 
+from . import config
+from .metrics import JOBS_BY_STATUS, STATUS_TRANSITIONS
 
-@dataclass
+
+@dataclass(slots=True)
 class DownloadEntry:
     id: int
     url: str
@@ -15,41 +18,195 @@ class DownloadEntry:
     detail: str
     created_at: datetime = field(default_factory=datetime.utcnow)
     updated_at: datetime = field(default_factory=datetime.utcnow)
+    bytes_done: Optional[int] = None
+    bytes_total: Optional[int] = None
+    speed_bps: Optional[float] = None
+    eta_s: Optional[float] = None
+    version: int = 0
 
 
 class DownloadTracker:
-    def __init__(self, max_entries: int = 100):
+    """
+    Storico dei download indicizzato per id.
+
+    Gli id sono progressivi e le voci vengono eliminate dalla più vecchia, quindi
+    l'indice è un semplice dizionario ``id -> voce`` più l'id della voce più vecchia
+    ancora presente: aggiornamenti, letture ed eliminazioni costano O(1) e una
+    pagina di risultati costa quanto la pagina stessa. Tutte le operazioni girano
+    nel loop asyncio senza mai cedere il controllo, per cui non serve alcun lock
+    e chi legge non blocca i worker che aggiornano lo stato.
+
+    Ogni modifica incrementa ``version`` e la registra sulla voce: ``changed_since``
+    restituisce solo le voci modificate dopo una certa versione, in tempo
+    proporzionale al numero di modifiche.
+    """
+
+    def __init__(self, max_entries: int = config.TRACKER_HISTORY_LIMIT):
         self.max_entries = max_entries
-        self._entries: Deque[DownloadEntry] = deque(maxlen=max_entries)
-        self._lock = asyncio.Lock()
+        self._entries: Dict[int, DownloadEntry] = {}
+        self._by_user: Dict[Optional[int], Deque[int]] = {}
+        self._changes: "OrderedDict[int, None]" = OrderedDict()
+        # Voci nello storico per stato attuale e passaggi totali a ciascuno stato.
+        self.status_counts: Dict[str, int] = {}
+        self.status_totals: Dict[str, int] = {}
+        self._oldest_id = 1
         self._counter = 0
+        self.version = 0
+        self._changed = asyncio.Event()
+
+    def _touch(self, entry: DownloadEntry) -> None:
+        """Registra la modifica di ``entry`` e la segnala a chi attende con ``wait_for_change``."""
+
+        self.version += 1
+        entry.version = self.version
+        self._changes[entry.id] = None
+        self._changes.move_to_end(entry.id)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self, version: int, timeout: float) -> bool:
+        """Attende una versione diversa da ``version``; False se scade il timeout."""
+
+        if self.version != version:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
 
     async def add(self, url: str, user_id: Optional[int], username: Optional[str], status: str, detail: str = "") -> int:
-        async with self._lock:
-            self._counter += 1
-            entry = DownloadEntry(
-                id=self._counter,
-                url=url,
-                user_id=user_id,
-                username=username,
-                status=status,
-                detail=detail,
-            )
-            self._entries.appendleft(entry)
-            return entry.id
+        self._counter += 1
+        entry = DownloadEntry(
+            id=self._counter,
+            url=url,
+            user_id=user_id,
+            username=username,
+            status=status,
+            detail=detail,
+        )
+        self._entries[entry.id] = entry
+        self._by_user.setdefault(user_id, deque()).append(entry.id)
+        self._count_status(None, status)
+        while len(self._entries) > self.max_entries:
+            self._evict_oldest()
+        self._touch(entry)
+        return entry.id
+
+    def _evict_oldest(self) -> None:
+        oldest = self._entries.pop(self._oldest_id)
+        self._oldest_id += 1
+        self._changes.pop(oldest.id, None)
+        self.status_counts[oldest.status] -= 1
+        user_ids = self._by_user[oldest.user_id]
+        user_ids.popleft()
+        if not user_ids:
+            del self._by_user[oldest.user_id]
 
     async def update(self, entry_id: int, status: str, detail: str = "") -> None:
-        async with self._lock:
-            for entry in self._entries:
-                if entry.id == entry_id:
-                    entry.status = status
-                    entry.detail = detail
-                    entry.updated_at = datetime.utcnow()
-                    break
+        entry = self._entries.get(entry_id)
+        if entry is None:
+            return
+        if entry.status != status:
+            self._count_status(entry.status, status)
+        entry.status = status
+        entry.detail = detail
+        entry.updated_at = datetime.utcnow()
+        entry.bytes_done = entry.bytes_total = None
+        entry.speed_bps = entry.eta_s = None
+        self._touch(entry)
+
+    async def set_progress(
+        self,
+        entry_id: int,
+        detail: str,
+        bytes_done: int,
+        bytes_total: Optional[int] = None,
+        speed_bps: Optional[float] = None,
+        eta_s: Optional[float] = None,
+    ) -> None:
+        """Aggiorna l'avanzamento del download o dell'invio senza cambiare lo stato."""
+
+        entry = self._entries.get(entry_id)
+        if entry is None:
+            return
+        entry.detail = detail
+        entry.bytes_done = bytes_done
+        entry.bytes_total = bytes_total
+        entry.speed_bps = speed_bps
+        entry.eta_s = eta_s
+        entry.updated_at = datetime.utcnow()
+        self._touch(entry)
+
+    def _count_status(self, old: Optional[str], new: str) -> None:
+        if old is not None:
+            self.status_counts[old] -= 1
+        self.status_counts[new] = self.status_counts.get(new, 0) + 1
+        self.status_totals[new] = self.status_totals.get(new, 0) + 1
+
+    def get(self, entry_id: int) -> Optional[DownloadEntry]:
+        return self._entries.get(entry_id)
+
+    def query(
+        self,
+        user_id: Optional[int] = None,
+        status: Optional[str] = None,
+        created_after: Optional[datetime] = None,
+        created_before: Optional[datetime] = None,
+        before_id: Optional[int] = None,
+        limit: int = 100,
+    ) -> List[DownloadEntry]:
+        """
+        Voci dalla più recente alla più vecchia, filtrate per utente, stato e
+        intervallo di creazione. ``before_id`` è il cursore della pagina: si passa
+        l'id dell'ultima voce ricevuta per ottenere la pagina successiva.
+        """
+
+        start = self._counter if before_id is None else min(before_id - 1, self._counter)
+        if user_id is not None:
+            candidates: Iterable[int] = (
+                entry_id
+                for entry_id in reversed(self._by_user.get(user_id, ()))
+                if entry_id <= start
+            )
+        else:
+            candidates = range(start, self._oldest_id - 1, -1)
+
+        results: List[DownloadEntry] = []
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            # Gli id crescono con l'orario di creazione: quelle che seguono sono tutte più vecchie.
+            if created_after is not None and entry.created_at < created_after:
+                break
+            if created_before is not None and entry.created_at > created_before:
+                continue
+            if status is not None and entry.status != status:
+                continue
+            results.append(entry)
+            if len(results) >= limit:
+                break
+        return results
+
+    def changed_since(self, version: int, limit: int) -> Optional[List[DownloadEntry]]:
+        """
+        Voci modificate dopo ``version``, dalla modifica più recente. Restituisce
+        ``None`` se sono più di ``limit``: conviene allora ricaricare tutto.
+        """
+
+        results: List[DownloadEntry] = []
+        for entry_id in reversed(self._changes):
+            entry = self._entries[entry_id]
+            if entry.version <= version:
+                break
+            if len(results) >= limit:
+                return None
+            results.append(entry)
+        return results
 
     async def list_entries(self) -> List[DownloadEntry]:
-        async with self._lock:
-            return list(self._entries)
+        return self.query(limit=self.max_entries)
 
 
 tracker = DownloadTracker()
+JOBS_BY_STATUS.set_function(lambda: {(status,): n for status, n in tracker.status_counts.items()})
+STATUS_TRANSITIONS.set_function(lambda: {(status,): n for status, n in tracker.status_totals.items()})
@@ -0,0 +1,375 @@
+"""
+Gestione dello spazio su disco in ``DOWNLOAD_DIR``.
+
+Tiene un indice dei file scaricati (dimensione, ultimo utilizzo, utente) e fa
+rispettare le quote globali e per utente eliminando in background i file usati
+meno di recente (``lru``) o meno spesso (``lfu``). Prima di ogni download il job
+riserva lo spazio stimato, così più download in parallelo non possono riempire
+il disco.
+
+I file dei job ancora in lavorazione sono bloccati e non vengono mai eliminati.
+Gli hardlink della cache dei media verso lo stesso file contano una sola volta
+nel totale, ma per intero nella quota di ogni utente che li possiede.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from . import config
+from .downloader import cleanup_file, extract_size_mb, merge_disk_copies
+from .media_cache import media_cache
+from .metrics import STORAGE_EVICTIONS, STORAGE_RESERVED_BYTES, STORAGE_USED_BYTES
+
+logger = logging.getLogger(__name__)
+
+_MB = 1024 * 1024
+# File temporanei di yt-dlp, che appartengono a un download ancora in corso.
+_TEMP_SUFFIXES = (".part", ".ytdl", ".temp")
+
+
+class StorageFull(Exception):
+    """Non c'è spazio (o quota) sufficiente per il download, nemmeno eliminando file."""
+
+
+@dataclass(slots=True)
+class StoredFile:
+    path: Path
+    owner: str
+    size: int
+    inode: Tuple[int, int]
+    last_access: float
+    hits: int = 1
+
+
+@dataclass(slots=True)
+class _Reservation:
+    owner: str
+    # Dimensione stimata del file finale (conta per le quote) e occupazione massima
+    # durante il download (conta per lo spazio libero: durante il merge le tracce
+    # separate e il file unito coesistono).
+    size: int
+    peak: int
+
+
+def _is_temporary(name: str) -> bool:
+    return name.endswith(_TEMP_SUFFIXES) or ".part-Frag" in name
+
+
+def _remove_file(path: Path) -> None:
+    if config.MEDIA_CACHE_ENABLED:
+        media_cache.discard(path)
+    else:
+        cleanup_file(path)
+
+
+class StorageManager:
+    def __init__(
+        self,
+        base_dir: str,
+        max_total_mb: float = config.STORAGE_MAX_TOTAL_MB,
+        max_user_mb: float = config.STORAGE_MAX_PER_USER_MB,
+        min_free_mb: float = config.STORAGE_MIN_FREE_MB,
+        policy: str = config.STORAGE_EVICTION_POLICY,
+    ) -> None:
+        self.root = Path(base_dir)
+        self._max_total = int(max_total_mb * _MB)
+        self._max_user = int(max_user_mb * _MB)
+        self._min_free = int(min_free_mb * _MB)
+        self._policy = policy
+        self._files: Dict[Path, StoredFile] = {}
+        self._pins: Dict[int, Set[Path]] = {}
+        self._reservations: Dict[int, _Reservation] = {}
+        self._waiting: Dict[int, _Reservation] = {}
+        self._wake = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._scanned = asyncio.Event()
+        self._exhausted = False
+        self._last_scan: Optional[float] = None
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def owner_of(self, path: Path) -> str:
+        """Cartella utente che contiene ``path`` ("" per i file nella radice)."""
+
+        try:
+            parts = path.relative_to(self.root).parts
+        except ValueError:
+            return ""
+        return parts[0] if len(parts) > 1 else ""
+
+    def used_bytes(self) -> int:
+        return self._usage()[0]
+
+    def reserved_bytes(self) -> int:
+        return sum(reservation.peak for reservation in self._reservations.values())
+
+    def add(self, path: Path, pin: Optional[int] = None) -> None:
+        """
+        Registra un file appena scaricato o riutilizzato (ne aggiorna l'ultimo utilizzo).
+        Con ``pin`` il file resta bloccato finché il job ``pin`` non chiama ``unpin``.
+        """
+
+        try:
+            stat = path.stat()
+        except OSError:
+            return
+        inode = (stat.st_dev, stat.st_ino)
+        entry = self._files.get(path)
+        if entry is None:
+            self._files[path] = StoredFile(path, self.owner_of(path), stat.st_size, inode, time.time())
+        else:
+            entry.size, entry.inode, entry.last_access = stat.st_size, inode, time.time()
+            entry.hits += 1
+        if pin is not None:
+            self._pins.setdefault(pin, set()).add(path)
+        self._start()
+        self._wake.set()
+
+    def forget(self, path: Path) -> None:
+        """Toglie dall'indice un file eliminato da altri (es. dopo l'invio)."""
+
+        self._files.pop(path, None)
+
+    def unpin(self, entry_id: int) -> None:
+        if self._pins.pop(entry_id, None):
+            self._wake.set()
+
+    def release(self, entry_id: int) -> None:
+        """Libera lo spazio riservato dal job (il file scaricato va registrato con ``add``)."""
+
+        if self._reservations.pop(entry_id, None) is not None:
+            self._wake.set()
+
+    async def reserve(self, entry_id: int, target_dir: Path, info: Optional[dict]) -> None:
+        """
+        Riserva lo spazio stimato per scaricare ``info`` in ``target_dir``. Se non basta
+        chiede all'evictor di liberarne e attende, fino a ``STORAGE_RESERVE_TIMEOUT_S``.
+        Solleva ``StorageFull`` se il file non può starci in nessun caso.
+        """
+
+        estimated_mb = extract_size_mb(info) if info else None
+        size = int((estimated_mb or config.STORAGE_UNKNOWN_SIZE_MB) * _MB)
+        merged = info and len(info.get("requested_formats") or []) > 1
+        peak = size * merge_disk_copies(str(self.root)) if merged else size
+        request = _Reservation(self.owner_of(target_dir / "_"), size, peak)
+        if self._max_user and size > self._max_user:
+            raise StorageFull("File più grande della quota per utente")
+        if self._max_total and size > self._max_total:
+            raise StorageFull("File più grande della quota totale")
+
+        self._start()
+        await self._scanned.wait()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.STORAGE_RESERVE_TIMEOUT_S
+        self._waiting[entry_id] = request
+        evicted = False
+        try:
+            while True:
+                changed = self._changed
+                if self._fits(request):
+                    self._reservations[entry_id] = request
+                    return
+                if evicted and self._exhausted and not self._reservations and not self._pins:
+                    # Niente da eliminare e nessun altro job che possa liberare spazio.
+                    raise StorageFull("Spazio su disco insufficiente")
+                if not evicted:
+                    # Le passate successive partono da sole quando un job libera spazio.
+                    self._wake.set()
+                try:
+                    await asyncio.wait_for(changed.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    raise StorageFull("Spazio su disco insufficiente (attesa scaduta)") from None
+                evicted = True
+        finally:
+            self._waiting.pop(entry_id, None)
+
+    def _usage(self) -> Tuple[int, Dict[str, int]]:
+        """Byte occupati in totale (ogni inode una volta) e per utente."""
+
+        seen: Set[Tuple[int, int]] = set()
+        total = 0
+        per_owner: Dict[str, int] = {}
+        for entry in self._files.values():
+            per_owner[entry.owner] = per_owner.get(entry.owner, 0) + entry.size
+            if entry.inode not in seen:
+                seen.add(entry.inode)
+                total += entry.size
+        return total, per_owner
+
+    def _demand(self, reservations: List[_Reservation]) -> Tuple[int, int, Dict[str, int]]:
+        size = peak = 0
+        per_owner: Dict[str, int] = {}
+        for reservation in reservations:
+            size += reservation.size
+            peak += reservation.peak
+            per_owner[reservation.owner] = per_owner.get(reservation.owner, 0) + reservation.size
+        return size, peak, per_owner
+
+    def _fits(self, request: _Reservation) -> bool:
+        total, per_owner = self._usage()
+        reserved, reserved_peak, reserved_by_owner = self._demand(list(self._reservations.values()))
+        if self._max_user:
+            owner_total = per_owner.get(request.owner, 0) + reserved_by_owner.get(request.owner, 0)
+            if owner_total + request.size > self._max_user:
+                return False
+        if self._max_total and total + reserved + request.size > self._max_total:
+            return False
+        # Stima prudente: lo spazio riservato da un download in corso resta contato per
+        # intero anche quando una parte è già stata scritta su disco.
+        free = shutil.disk_usage(self.root).free
+        return free - reserved_peak - request.peak >= self._min_free
+
+    def _pinned(self) -> Set[Path]:
+        return set().union(*self._pins.values()) if self._pins else set()
+
+    def _order_key(self, entries: List[StoredFile]) -> Tuple[float, ...]:
+        last_access = max(entry.last_access for entry in entries)
+        if self._policy == "lfu":
+            return (sum(entry.hits for entry in entries), last_access)
+        return (last_access,)
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                now = time.monotonic()
+                if self._last_scan is None or now - self._last_scan >= config.STORAGE_SCAN_INTERVAL_S:
+                    self._merge_scan(await asyncio.to_thread(self._scan))
+                    self._last_scan = now
+                    self._scanned.set()
+                self._exhausted = not await self._evict()
+            except Exception:
+                logger.exception("Errore durante la pulizia di %s", self.root)
+            self._changed.set()
+            self._changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._wake.wait(), config.STORAGE_SCAN_INTERVAL_S)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _scan(self) -> Dict[Path, os.stat_result]:
+        """Elenca i file scaricati (gira in un thread: su dischi lenti può durare)."""
+
+        found: Dict[Path, os.stat_result] = {}
+        self.root.mkdir(parents=True, exist_ok=True)
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # .cache contiene la cache dei media (raggiunta tramite i link) e i database.
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            for name in filenames:
+                if name.startswith(".") or _is_temporary(name):
+                    continue
+                path = Path(dirpath) / name
+                try:
+                    found[path] = path.stat()
+                except OSError:
+                    continue
+        return found
+
+    def _merge_scan(self, found: Dict[Path, os.stat_result]) -> None:
+        pinned = self._pinned()
+        for path in [path for path in self._files if path not in found and path not in pinned]:
+            del self._files[path]
+        # Nelle cartelle con un download in corso un file nuovo può essere una traccia
+        # non ancora unita: verrà registrato con ``add`` a download finito.
+        busy_owners = {reservation.owner for reservation in self._reservations.values()}
+        for path, stat in found.items():
+            inode = (stat.st_dev, stat.st_ino)
+            entry = self._files.get(path)
+            if entry is not None:
+                entry.size, entry.inode = stat.st_size, inode
+                continue
+            owner = self.owner_of(path)
+            if owner not in busy_owners:
+                last_access = max(stat.st_atime, stat.st_mtime)
+                self._files[path] = StoredFile(path, owner, stat.st_size, inode, last_access)
+
+    async def _evict(self) -> bool:
+        """Elimina i file necessari a rispettare quote e spazio libero; False se non basta."""
+
+        waiting_size, waiting_peak, waiting_by_owner = self._demand(list(self._waiting.values()))
+        reserved, reserved_peak, reserved_by_owner = self._demand(list(self._reservations.values()))
+        satisfied = True
+
+        if self._max_user:
+            _, per_owner = self._usage()
+            for owner, used in per_owner.items():
+                excess = (
+                    used
+                    + reserved_by_owner.get(owner, 0)
+                    + waiting_by_owner.get(owner, 0)
+                    - self._max_user
+                )
+                if excess > 0:
+                    candidates = [[entry] for entry in self._files.values() if entry.owner == owner]
+                    satisfied &= await self._remove_until(
+                        excess, candidates, "user_quota", partial=owner not in waiting_by_owner
+                    )
+
+        total, _ = self._usage()
+        free = shutil.disk_usage(self.root).free
+        excesses = {
+            # Lo spazio libero si recupera solo per un download in attesa: se il disco è
+            # pieno per altri motivi non serve svuotare la cartella.
+            "free_space": (
+                reserved_peak + waiting_peak + self._min_free - free if self._waiting else 0
+            ),
+            "total_quota": (
+                total + reserved + waiting_size - self._max_total if self._max_total else 0
+            ),
+        }
+        reason = max(excesses, key=excesses.get)
+        if excesses[reason] > 0:
+            by_inode: Dict[Tuple[int, int], List[StoredFile]] = {}
+            for entry in self._files.values():
+                by_inode.setdefault(entry.inode, []).append(entry)
+            satisfied &= await self._remove_until(
+                excesses[reason], list(by_inode.values()), reason, partial=not self._waiting
+            )
+        return satisfied
+
+    async def _remove_until(
+        self, excess: int, groups: List[List[StoredFile]], reason: str, partial: bool
+    ) -> bool:
+        """
+        Elimina gruppi di link allo stesso file, in ordine di politica, finché serve.
+        Senza ``partial`` non elimina nulla se anche svuotando tutto non si arriva a
+        ``excess``: un download in attesa non ne trarrebbe comunque vantaggio.
+        """
+
+        pinned = self._pinned()
+        groups = [group for group in groups if not any(entry.path in pinned for entry in group)]
+        if not partial and sum(group[0].size for group in groups) < excess:
+            return False
+        freed = 0
+        for group in sorted(groups, key=self._order_key):
+            if freed >= excess:
+                break
+            # I blocchi possono cambiare mentre i file vengono eliminati in un thread.
+            if any(entry.path in self._pinned() for entry in group):
+                continue
+            for entry in group:
+                self._files.pop(entry.path, None)
+                await asyncio.to_thread(_remove_file, entry.path)
+            freed += group[0].size
+            STORAGE_EVICTIONS.inc(len(group), reason=reason)
+            logger.info(
+                "Spazio liberato (%s): %s (%.1f MB)",
+                reason,
+                ", ".join(str(entry.path) for entry in group),
+                group[0].size / _MB,
+            )
+        return freed >= excess
+
+
+storage = StorageManager(config.DOWNLOAD_DIR)
+STORAGE_USED_BYTES.set_function(storage.used_bytes)
+STORAGE_RESERVED_BYTES.set_function(storage.reserved_bytes)
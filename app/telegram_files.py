@@ -0,0 +1,86 @@
+"""
+Archivio dei ``file_id`` restituiti da Telegram dopo un invio riuscito.
+
+I file sono identificati dal contenuto (dimensione più hash dell'inizio e della
+fine del file), quindi lo stesso video scaricato da utenti diversi o riutilizzato
+dalla cache viene inviato con il ``file_id`` già noto: niente nuovo upload.
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+_SAMPLE_BYTES = 1024 * 1024
+
+
+@dataclass
+class TelegramFile:
+    kind: str
+    file_id: str
+    file_unique_id: str
+
+
+def content_key(path: Path) -> str:
+    """Impronta del contenuto: legge solo il primo e l'ultimo MB anche per file da 2 GB."""
+
+    size = path.stat().st_size
+    digest = hashlib.sha256(str(size).encode())
+    with path.open("rb") as file:
+        digest.update(file.read(_SAMPLE_BYTES))
+        if size > 2 * _SAMPLE_BYTES:
+            file.seek(-_SAMPLE_BYTES, 2)
+            digest.update(file.read(_SAMPLE_BYTES))
+        else:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+class TelegramFileStore:
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "content_key TEXT PRIMARY KEY, kind TEXT NOT NULL, file_id TEXT NOT NULL, "
+                "file_unique_id TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    def get(self, key: str) -> Optional[TelegramFile]:
+        with self._lock:
+            row = (
+                self._db()
+                .execute("SELECT kind, file_id, file_unique_id FROM files WHERE content_key = ?", (key,))
+                .fetchone()
+            )
+        return TelegramFile(*row) if row else None
+
+    def save(self, key: str, file: TelegramFile) -> None:
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO files (content_key, kind, file_id, file_unique_id, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, file.kind, file.file_id, file.file_unique_id, time.time()),
+            )
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            self._db().execute("DELETE FROM files WHERE content_key = ?", (key,))
+
+
+telegram_files = TelegramFileStore(Path(config.DOWNLOAD_DIR) / ".cache" / "telegram_files.sqlite3")
@@ -0,0 +1,152 @@
+"""
+Ricodifica con ffmpeg dei video che superano il limite di invio.
+
+Il bitrate è calcolato dalla durata in modo che il file stia sotto il limite;
+al massimo ``TRANSCODE_WORKERS`` processi ffmpeg girano insieme. L'uscita è un
+MP4 frammentato scritto su stdout: i byte passano direttamente all'upload,
+senza scrivere una seconda copia del video su disco.
+"""
+
+import asyncio
+import logging
+import shutil
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# Margine per l'overhead del container e le oscillazioni del bitrate.
+_SIZE_MARGIN = 0.92
+# Altezza massima in base al bitrate video disponibile (kbit/s).
+_HEIGHT_BY_KBPS = ((2500, None), (1200, 720), (600, 480), (300, 360), (0, 240))
+
+
+class TranscodeError(Exception):
+    """ffmpeg è terminato con un errore."""
+
+
+@dataclass
+class TranscodePlan:
+    duration_s: float
+    video_kbps: int
+    audio_kbps: int
+    max_height: Optional[int]
+    limit_bytes: int
+
+
+def plan_transcode(duration_s: float, limit_mb: float) -> Optional[TranscodePlan]:
+    """Bitrate e risoluzione per stare in ``limit_mb``; ``None`` se la qualità sarebbe inaccettabile."""
+
+    limit_bytes = int(limit_mb * 1024 * 1024)
+    total_kbps = limit_bytes * 8 * _SIZE_MARGIN / duration_s / 1000
+    audio_kbps = config.TRANSCODE_AUDIO_KBPS
+    if total_kbps < audio_kbps * 4:
+        audio_kbps = min(audio_kbps, 64)
+    video_kbps = int(total_kbps - audio_kbps)
+    if video_kbps < config.TRANSCODE_MIN_VIDEO_KBPS:
+        return None
+    max_height = next(height for threshold, height in _HEIGHT_BY_KBPS if video_kbps >= threshold)
+    return TranscodePlan(duration_s, video_kbps, audio_kbps, max_height, limit_bytes)
+
+
+class Transcoder:
+    def __init__(self, workers: int = config.TRANSCODE_WORKERS) -> None:
+        self._slots = asyncio.Semaphore(max(1, workers))
+
+    @staticmethod
+    def available() -> bool:
+        return shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+    async def probe_duration(self, path: Path) -> Optional[float]:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "csv=p=0",
+                str(path),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except OSError:
+            return None
+        stdout, _ = await process.communicate()
+        try:
+            return float(stdout.decode().strip())
+        except ValueError:
+            return None
+
+    async def plan(self, path: Path, info: Optional[dict], limit_mb: float) -> Optional[TranscodePlan]:
+        if not self.available():
+            logger.warning("ffmpeg/ffprobe non disponibili: ricodifica impossibile")
+            return None
+        duration = (info or {}).get("duration") or await self.probe_duration(path)
+        if not duration:
+            return None
+        return plan_transcode(float(duration), limit_mb)
+
+    def _command(self, path: Path, plan: TranscodePlan) -> List[str]:
+        video = f"{plan.video_kbps}k"
+        command = ["ffmpeg", "-nostdin", "-v", "error", "-i", str(path), "-map", "0:v:0", "-map", "0:a:0?"]
+        if plan.max_height:
+            command += ["-vf", f"scale=-2:'min(ih,{plan.max_height})'"]
+        command += [
+            "-c:v", "libx264", "-preset", config.TRANSCODE_PRESET,
+            "-b:v", video, "-maxrate", video, "-bufsize", f"{plan.video_kbps * 2}k",
+            "-c:a", "aac", "-b:a", f"{plan.audio_kbps}k",
+            # Limite rigido: anche se il bitrate sfora, il file non supera il limite di invio.
+            "-fs", str(plan.limit_bytes),
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-f", "mp4", "pipe:1",
+        ]
+        return command
+
+    @asynccontextmanager
+    async def open(
+        self, path: Path, plan: TranscodePlan, chunk_size: int
+    ) -> AsyncIterator[AsyncIterator[bytes]]:
+        """
+        Attende un posto libero, avvia ffmpeg e restituisce il flusso dei byte ricodificati.
+        Il flusso solleva ``TranscodeError`` alla fine se ffmpeg non termina correttamente,
+        così un upload parziale non viene mai confermato.
+        """
+
+        async with self._slots:
+            process = await asyncio.create_subprocess_exec(
+                *self._command(path, plan),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            logger.info(
+                "Ricodifica di %s a %s kbit/s (altezza massima: %s)",
+                path.name,
+                plan.video_kbps + plan.audio_kbps,
+                plan.max_height or "originale",
+            )
+
+            async def chunks() -> AsyncIterator[bytes]:
+                while True:
+                    chunk = await process.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                stderr = await process.stderr.read()
+                if await process.wait() != 0:
+                    raise TranscodeError(stderr.decode(errors="replace").strip()[-500:])
+
+            try:
+                yield chunks()
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+
+transcoder = Transcoder()
@@ -0,0 +1,249 @@
+"""
+Invio dei file tramite la Telegram Bot API self-hosted.
+
+Se il server Bot API gira con ``--local`` e vede la stessa cartella dei download,
+il bot passa solo il percorso ``file://`` e il server legge il file dal disco.
+Altrimenti il file viene inviato in streaming, a blocchi, senza caricarlo in
+memoria, riportando l'avanzamento al tracker. In entrambi i casi la consegna è
+confermata solo dalla risposta del server: un timeout non viene più considerato
+un successo.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import httpx
+from telegram import Bot, Message
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+ProgressCallback = Callable[[int, Optional[int], float], Awaitable[None]]
+
+_PROGRESS_INTERVAL_S = 1.0
+
+
+class UploadUnconfirmed(Exception):
+    """Il file è stato trasmesso ma il server non ha confermato la consegna in tempo."""
+
+
+def local_file_uri(path: Path) -> Optional[str]:
+    """
+    Traduce un percorso sotto ``DOWNLOAD_DIR`` nel percorso visto dal server Bot API.
+    Restituisce ``None`` se il file non si trova nella cartella condivisa.
+    """
+
+    try:
+        relative = path.resolve().relative_to(Path(config.DOWNLOAD_DIR).resolve())
+    except ValueError:
+        return None
+    remote = PurePosixPath(config.TELEGRAM_BOT_API_DOWNLOAD_DIR) / relative.as_posix()
+    return f"file://{remote}"
+
+
+async def file_chunks(path: Path, chunk_size: int) -> AsyncIterator[bytes]:
+    """Legge il file a blocchi in un thread, senza bloccare il loop asyncio."""
+
+    with path.open("rb") as file:
+        while True:
+            chunk = await asyncio.to_thread(file.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class _MultipartBody:
+    """Corpo ``multipart/form-data`` generato al volo a partire da un flusso di byte."""
+
+    def __init__(
+        self,
+        fields: Dict[str, str],
+        file_field: str,
+        filename: str,
+        chunks: AsyncIterator[bytes],
+        file_size: Optional[int],
+        progress: Optional[ProgressCallback],
+    ) -> None:
+        self.boundary = uuid.uuid4().hex
+        safe_name = filename.replace('"', "_").replace("\r", "_").replace("\n", "_")
+        head = "".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+            f'filename="{safe_name}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+        )
+        self._head = head.encode()
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._chunks = chunks
+        self.file_size = file_size
+        self._progress = progress
+        self.sent = 0
+
+    @property
+    def content_length(self) -> Optional[int]:
+        if self.file_size is None:
+            return None
+        return len(self._head) + self.file_size + len(self._tail)
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        started = time.monotonic()
+        last_report = started
+        yield self._head
+        async for chunk in self._chunks:
+            self.sent += len(chunk)
+            yield chunk
+            now = time.monotonic()
+            if self._progress and now - last_report >= _PROGRESS_INTERVAL_S:
+                last_report = now
+                await self._progress(self.sent, self.file_size, self.sent / (now - started))
+        yield self._tail
+
+
+class LocalApiUploader:
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    connect=30,
+                    write=60,
+                    read=config.UPLOAD_RESPONSE_TIMEOUT_S,
+                    pool=30,
+                )
+            )
+        return self._client
+
+    async def send(
+        self,
+        bot: Bot,
+        kind: str,
+        chat_id: int,
+        path: Path,
+        caption: str,
+        progress: Optional[ProgressCallback] = None,
+    ) -> Message:
+        """Invia ``path`` come ``video`` o ``document`` e restituisce il messaggio confermato."""
+
+        if config.TELEGRAM_BOT_API_LOCAL_MODE:
+            file_uri = local_file_uri(path)
+            if file_uri is not None:
+                return await self._send_local_path(bot, kind, chat_id, file_uri, caption)
+            logger.warning("%s non è nella cartella condivisa con la Bot API, lo invio in streaming", path)
+
+        chunks = file_chunks(path, config.UPLOAD_CHUNK_SIZE_KB * 1024)
+        return await self.send_stream(
+            bot, kind, chat_id, path.name, chunks, path.stat().st_size, caption, progress
+        )
+
+    async def _send_local_path(
+        self, bot: Bot, kind: str, chat_id: int, file_uri: str, caption: str
+    ) -> Message:
+        logger.info("Invio tramite percorso locale della Bot API: %s", file_uri)
+        send = bot.send_video if kind == "video" else bot.send_document
+        try:
+            return await send(
+                chat_id,
+                file_uri,
+                caption=caption,
+                read_timeout=config.UPLOAD_RESPONSE_TIMEOUT_S,
+                write_timeout=60,
+                connect_timeout=30,
+            )
+        except TimedOut as exc:
+            raise UploadUnconfirmed(str(exc)) from exc
+
+    async def send_stream(
+        self,
+        bot: Bot,
+        kind: str,
+        chat_id: int,
+        filename: str,
+        chunks: AsyncIterator[bytes],
+        file_size: Optional[int],
+        caption: str,
+        progress: Optional[ProgressCallback] = None,
+    ) -> Message:
+        """Invia un flusso di byte in multipart; ``file_size`` ``None`` usa il chunked encoding."""
+
+        method = "sendVideo" if kind == "video" else "sendDocument"
+        body = _MultipartBody(
+            {"chat_id": str(chat_id), "caption": caption},
+            kind,
+            filename,
+            chunks,
+            file_size,
+            progress,
+        )
+        headers = {"Content-Type": f"multipart/form-data; boundary={body.boundary}"}
+        if body.content_length is not None:
+            headers["Content-Length"] = str(body.content_length)
+
+        url = f"{config.TELEGRAM_BOT_API_BASE_URL}{bot.token}/{method}"
+        started = time.monotonic()
+        try:
+            response = await self._http().post(url, content=body, headers=headers)
+        except httpx.ReadTimeout as exc:
+            # Il corpo è stato trasmesso tutto ma la risposta non è arrivata: esito ignoto.
+            raise UploadUnconfirmed(
+                f"Nessuna conferma dopo {config.UPLOAD_RESPONSE_TIMEOUT_S}s ({body.sent} byte inviati)"
+            ) from exc
+
+        payload = _parse_reply(response)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(
+            "Upload di %s completato: %.1f MB in %.1fs (%.1f MB/s)",
+            filename,
+            body.sent / (1024 * 1024),
+            elapsed,
+            body.sent / (1024 * 1024) / elapsed,
+        )
+        return Message.de_json(payload["result"], bot)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def _parse_reply(response: httpx.Response) -> dict:
+    """
+    Risposta della Bot API a un upload. Gli errori diventano le eccezioni di
+    python-telegram-bot: 429 → ``RetryAfter``, 400 → ``BadRequest``; una risposta non
+    JSON (es. pagina 413/502 di un proxy davanti alla Bot API) → ``NetworkError``.
+    """
+
+    payload = None
+    if "json" in response.headers.get("content-type", ""):
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = None
+    if isinstance(payload, dict) and payload.get("ok"):
+        return payload
+    description = (
+        payload.get("description", f"HTTP {response.status_code}")
+        if isinstance(payload, dict)
+        else f"HTTP {response.status_code}"
+    )
+    if response.status_code == 429:
+        parameters = (payload.get("parameters") or {}) if isinstance(payload, dict) else {}
+        retry_after = parameters.get("retry_after") or response.headers.get("retry-after") or 1
+        raise RetryAfter(int(retry_after))
+    if response.status_code == 400:
+        raise BadRequest(description)
+    if not isinstance(payload, dict):
+        raise NetworkError(f"Risposta non valida dalla Bot API: HTTP {response.status_code}")
+    raise TelegramError(description)
+
+
+local_api_uploader = LocalApiUploader()
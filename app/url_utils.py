@@ -0,0 +1,94 @@
+import re
+from typing import Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Parametri di tracciamento comuni a tutti i siti (oltre ai ``utm_*``).
+TRACKING_PARAMS = {"fbclid", "gclid"}
+
+# Parametri che identificano chi ha condiviso il link, non il contenuto, per host canonico.
+# Su altri siti gli stessi nomi (``s``, ``t``, ``ref``...) possono far parte del link.
+HOST_TRACKING_PARAMS = {
+    "youtube.com": {"si", "feature", "pp"},
+    "instagram.com": {"igsh", "igshid"},
+    "tiktok.com": {"is_from_webapp", "sender_device", "share_id"},
+    "twitter.com": {"s", "t", "ref", "ref_src"},
+}
+
+_HOST_ALIASES = {
+    "youtu.be": "youtube.com",
+    "m.youtube.com": "youtube.com",
+    "music.youtube.com": "youtube.com",
+    "youtube-nocookie.com": "youtube.com",
+    "x.com": "twitter.com",
+    "mobile.twitter.com": "twitter.com",
+    "vm.tiktok.com": "tiktok.com",
+    "m.tiktok.com": "tiktok.com",
+}
+
+_KNOWN_IDS = (
+    ("youtube.com", re.compile(r"^/(?:shorts|live|embed)/([A-Za-z0-9_-]{11})"), "Youtube"),
+    ("tiktok.com", re.compile(r"/video/(\d+)"), "TikTok"),
+    ("instagram.com", re.compile(r"^/(?:[^/]+/)?(?:p|reels?|tv)/([A-Za-z0-9_-]+)"), "Instagram"),
+    ("twitter.com", re.compile(r"/status/(\d+)"), "Twitter"),
+    ("vimeo.com", re.compile(r"^/(\d+)"), "Vimeo"),
+)
+
+
+def url_host(url: str) -> str:
+    """Host canonico di un URL (senza ``www.`` e con gli alias noti risolti)."""
+
+    host = (urlsplit(url).hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return _HOST_ALIASES.get(host, host)
+
+
+def normalize_url(url: str) -> str:
+    """
+    Riduce un link condiviso alla sua forma canonica: host senza alias,
+    niente frammento né parametri di tracciamento, parametri ordinati.
+    Così ``youtu.be/ID?si=...`` e ``youtube.com/watch?v=ID&feature=share`` coincidono.
+    """
+
+    parts = urlsplit(url.strip())
+    raw_host = (parts.hostname or "").lower()
+    host = url_host(url)
+    path = parts.path.rstrip("/") or "/"
+    stripped = TRACKING_PARAMS | HOST_TRACKING_PARAMS.get(host, set())
+    query = [
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=False)
+        if key.lower() not in stripped and not key.lower().startswith("utm_")
+    ]
+
+    if raw_host.endswith("youtu.be") and path != "/":
+        query.append(("v", path.lstrip("/")))
+        path = "/watch"
+    if host == "youtube.com":
+        match = _KNOWN_IDS[0][1].match(path)
+        if match:
+            query.append(("v", match.group(1)))
+            path = "/watch"
+
+    return urlunsplit(("https", host, path, urlencode(sorted(query)), ""))
+
+
+def video_key_from_url(url: str) -> Optional[Tuple[str, str]]:
+    """
+    Ricava ``(extractor_key, video_id)`` di yt-dlp direttamente dall'URL, senza
+    contattare il sito. Restituisce ``None`` per i siti non riconosciuti.
+    """
+
+    normalized = normalize_url(url)
+    parts = urlsplit(normalized)
+    if parts.hostname == "youtube.com" and parts.path == "/watch":
+        video_id = dict(parse_qsl(parts.query)).get("v")
+        if video_id and re.fullmatch(r"[A-Za-z0-9_-]{11}", video_id):
+            return "Youtube", video_id
+        return None
+    for host, pattern, extractor in _KNOWN_IDS[1:]:
+        if parts.hostname == host:
+            match = pattern.search(parts.path)
+            if match:
+                return extractor, match.group(1)
+    return None
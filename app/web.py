@@ -1,25 +1,100 @@
-from datetime import datetime
-from typing import List
+import asyncio
+import hmac
+import json
+import logging
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Optional
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from telegram import Update
+from telegram.ext import Application
 
+from . import config
+from .batch import batch_runner
+from .download_queue import download_queue
+from .hosts import rate_limiter
 from .logging_utils import log_buffer
+from .metrics import registry
 from .status_tracker import DownloadEntry, tracker
 
+logger = logging.getLogger(__name__)
 
-def _format_time(dt: datetime) -> str:
-    return dt.strftime("%Y-%m-%d %H:%M:%S")
+# Intervallo minimo tra due eventi SSE e tra due keepalive, in secondi.
+_EVENT_MIN_INTERVAL_S = 0.5
+_KEEPALIVE_S = 15
+# Voci per pagina di /api/status (la pagina HTML le carica a blocchi di _PAGE_SIZE).
+_PAGE_SIZE = 100
+_MAX_PAGE_SIZE = 1000
+# Cambia a ogni avvio: un ETag di un processo precedente non è mai valido.
+_BOOT_ID = uuid.uuid4().hex[:8]
 
 
-def build_html(entries: List[DownloadEntry], logs: List[str]) -> str:
-    rows = "".join(
-        f"<tr><td>{e.id}</td><td>{e.username or e.user_id or '-'}</td><td>{e.url}</td>"
-        f"<td>{e.status}</td><td>{e.detail}</td><td>{_format_time(e.updated_at)}</td></tr>"
-        for e in entries
-    )
-    log_lines = "".join(f"<li>{line}</li>" for line in logs)
-    return f"""
+def _naive_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    """Il tracker usa orari UTC senza fuso: converte eventuali orari con fuso."""
+
+    if dt is None or dt.tzinfo is None:
+        return dt
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _entry_to_dict(e: DownloadEntry) -> dict:
+    return {
+        "id": e.id,
+        "url": e.url,
+        "user_id": e.user_id,
+        "username": e.username,
+        "status": e.status,
+        "detail": e.detail,
+        "updated_at": e.updated_at.isoformat(),
+        "bytes_done": e.bytes_done,
+        "bytes_total": e.bytes_total,
+        "speed_bps": e.speed_bps,
+        "eta_s": e.eta_s,
+        "version": e.version,
+    }
+
+
+def _log_level(name: Optional[str]) -> int:
+    """Livello minimo dei filtri sui log (``INFO``, ``warning``, ``30``...)."""
+
+    if not name:
+        return logging.NOTSET
+    if name.isdigit():
+        return int(name)
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise HTTPException(status_code=400, detail=f"Livello di log sconosciuto: {name}")
+    return level
+
+
+def _etag(request: Request, version: int) -> str:
+    """ETag di una risposta che dipende solo dalla versione dei dati e dai parametri."""
+
+    return f'"{_BOOT_ID}-{version}-{zlib.crc32(request.url.query.encode()):x}"'
+
+
+def _cached_json(request: Request, etag: str, build: Callable[[], dict]) -> Response:
+    """Risponde 304 se il client ha già questa versione, altrimenti costruisce il JSON."""
+
+    if_none_match = request.headers.get("if-none-match", "")
+    known = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in known:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(build(), headers=headers)
+
+
+_INDEX_HTML = f"""
     <html>
     <head>
         <title>Telegram Downloader - Stato</title>
@@ -40,47 +115,317 @@ def build_html(entries: List[DownloadEntry], logs: List[str]) -> str:
                 <thead>
                     <tr><th>ID</th><th>Utente</th><th>URL</th><th>Stato</th><th>Dettagli</th><th>Ultimo aggiornamento</th></tr>
                 </thead>
-                <tbody>{rows or '<tr><td colspan="6">Nessun download ancora.</td></tr>'}</tbody>
+                <tbody id="downloads"><tr id="empty"><td colspan="6">Nessun download ancora.</td></tr></tbody>
+            </table>
+            <button id="more" hidden>Carica altri</button>
+        </div>
+        <div class="section">
+            <h2>Limiti per sito</h2>
+            <table>
+                <thead>
+                    <tr><th>Sito</th><th>Richieste/min</th><th>Massimo/min</th><th>Pausa (s)</th><th>Errori consecutivi</th><th>Richieste rifiutate</th></tr>
+                </thead>
+                <tbody id="limits"><tr><td colspan="6">Nessuna richiesta ancora.</td></tr></tbody>
             </table>
         </div>
         <div class="section">
             <h2>Log recenti</h2>
-            <ol>{log_lines or '<li>Nessun log ancora.</li>'}</ol>
+            <ol id="logs"></ol>
         </div>
+        <script>
+            // I download arrivano a pagine da /api/status, poi solo le modifiche via SSE;
+            // i log vengono chiesti ogni pochi secondi a partire dall'ultima riga ricevuta.
+            const body = document.getElementById("downloads");
+            const more = document.getElementById("more");
+            const logList = document.getElementById("logs");
+            const rows = new Map();
+            let nextBeforeId = null;
+            let lastLogSeq = 0;
+
+            const cell = (value) => {{
+                const td = document.createElement("td");
+                td.textContent = value;
+                return td;
+            }};
+            const render = (e) => {{
+                const tr = rows.get(e.id) || document.createElement("tr");
+                const updated = e.updated_at.slice(0, 19).replace("T", " ");
+                tr.replaceChildren(
+                    ...[e.id, e.username || e.user_id || "-", e.url, e.status, e.detail, updated].map(cell)
+                );
+                tr.dataset.id = e.id;
+                rows.set(e.id, tr);
+                document.getElementById("empty")?.remove();
+                return tr;
+            }};
+            const upsert = (e) => {{
+                if (rows.has(e.id)) {{
+                    render(e);
+                }} else if (!body.firstElementChild || e.id > Number(body.firstElementChild.dataset.id || 0)) {{
+                    body.prepend(render(e));
+                }}
+            }};
+
+            async function loadPage() {{
+                const params = new URLSearchParams({{ limit: {_PAGE_SIZE} }});
+                if (nextBeforeId) params.set("before_id", nextBeforeId);
+                const data = await (await fetch(`/api/status?${{params}}`)).json();
+                data.downloads.filter((e) => !rows.has(e.id)).forEach((e) => body.appendChild(render(e)));
+                nextBeforeId = data.next_before_id;
+                more.hidden = !nextBeforeId;
+                return data.version;
+            }}
+
+            async function loadLogs() {{
+                const response = await fetch(`/api/logs?since=${{lastLogSeq}}`);
+                if (response.ok) {{
+                    const data = await response.json();
+                    data.logs.slice().reverse().forEach((line) => {{
+                        const li = document.createElement("li");
+                        li.textContent = line;
+                        logList.prepend(li);
+                    }});
+                    while (logList.children.length > {config.LOG_BUFFER_LIMIT}) logList.lastChild.remove();
+                    lastLogSeq = data.last_seq;
+                }}
+                setTimeout(loadLogs, 3000);
+            }}
+
+            async function loadLimits() {{
+                const response = await fetch("/api/limits");
+                if (response.ok) {{
+                    const data = await response.json();
+                    if (data.hosts.length) {{
+                        document.getElementById("limits").replaceChildren(...data.hosts.map((h) => {{
+                            const tr = document.createElement("tr");
+                            tr.replaceChildren(...[
+                                h.host, h.per_min, h.max_per_min, h.backoff_s, h.consecutive_errors, h.limited_total,
+                            ].map(cell));
+                            return tr;
+                        }}));
+                    }}
+                }}
+                setTimeout(loadLimits, 5000);
+            }}
+
+            more.onclick = loadPage;
+            loadPage().then((version) => {{
+                const events = new EventSource(`/api/events?since=${{version}}`);
+                events.onmessage = (event) => {{
+                    const data = JSON.parse(event.data);
+                    if (data.reset) {{
+                        location.reload();
+                        return;
+                    }}
+                    data.downloads.forEach(upsert);
+                }};
+            }});
+            loadLogs();
+            loadLimits();
+        </script>
     </body>
     </html>
     """
 
 
-def create_web_app() -> FastAPI:
+def create_web_app(telegram_app: Optional[Application] = None, webhook_secret: str = "") -> FastAPI:
+    """
+    App della web GUI. Con ``telegram_app`` riceve anche gli update di Telegram
+    (modalità webhook) su ``TELEGRAM_WEBHOOK_PATH``, accettando solo le richieste con
+    ``webhook_secret``.
+    """
+
     app = FastAPI(title="Telegram Video Bot Monitor")
+    # Le pagine grandi di /api/status e /api/logs viaggiano compresse; i flussi SSE no
+    # (text/event-stream è escluso da starlette>=0.46, vedi requirements.txt).
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+    if telegram_app is not None:
+        expected_secret = webhook_secret.encode()
+
+        @app.post(config.TELEGRAM_WEBHOOK_PATH, include_in_schema=False)
+        async def telegram_webhook(request: Request) -> Response:
+            received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+            if not hmac.compare_digest(received, expected_secret):
+                raise HTTPException(status_code=403, detail="Segreto del webhook non valido")
+            try:
+                update = Update.de_json(await request.json(), telegram_app.bot)
+            except Exception:
+                logger.warning("Update del webhook non valido", exc_info=True)
+                raise HTTPException(status_code=400, detail="Update non valido")
+            # Risponde subito: l'elaborazione (in parallelo, vedi BOT_CONCURRENT_UPDATES)
+            # avviene nell'Application, così Telegram non resta in attesa dei download.
+            await telegram_app.update_queue.put(update)
+            return Response(status_code=200)
 
     @app.get("/", response_class=HTMLResponse)
     async def index() -> str:
-        entries = await tracker.list_entries()
-        logs = log_buffer.list_logs()
-        return build_html(entries, logs)
+        return _INDEX_HTML
 
     @app.get("/api/status")
-    async def status() -> dict:
-        entries = await tracker.list_entries()
-        return {
-            "downloads": [
-                {
-                    "id": e.id,
-                    "url": e.url,
-                    "user_id": e.user_id,
-                    "username": e.username,
-                    "status": e.status,
-                    "detail": e.detail,
-                    "updated_at": e.updated_at.isoformat(),
+    async def status(
+        request: Request,
+        user_id: Optional[int] = None,
+        status: Optional[str] = None,
+        created_after: Optional[datetime] = None,
+        created_before: Optional[datetime] = None,
+        before_id: Optional[int] = None,
+        since: Optional[int] = None,
+        limit: int = Query(_PAGE_SIZE, ge=1, le=_MAX_PAGE_SIZE),
+    ) -> Response:
+        """
+        Download dal più recente, filtrabili per utente, stato e intervallo di creazione
+        (UTC). ``next_before_id`` va passato come ``before_id`` per la pagina successiva.
+        Con ``since=<version>`` restituisce solo le voci modificate dopo quella versione
+        (gli altri filtri sono ignorati); ``reset`` indica che conviene ricaricare tutto.
+        """
+
+        def build() -> dict:
+            if since is not None:
+                changes = tracker.changed_since(since, limit) if since <= tracker.version else None
+                return {
+                    "downloads": [_entry_to_dict(e) for e in changes or []],
+                    "version": tracker.version,
+                    "reset": changes is None,
                 }
-                for e in entries
-            ]
-        }
+            entries = tracker.query(
+                user_id=user_id,
+                status=status,
+                created_after=_naive_utc(created_after),
+                created_before=_naive_utc(created_before),
+                before_id=before_id,
+                limit=limit,
+            )
+            return {
+                "downloads": [_entry_to_dict(e) for e in entries],
+                "version": tracker.version,
+                "next_before_id": entries[-1].id if len(entries) == limit else None,
+            }
+
+        return _cached_json(request, _etag(request, tracker.version), build)
+
+    @app.get("/api/events")
+    async def events(request: Request, since: Optional[int] = None) -> StreamingResponse:
+        """
+        Flusso SSE con le voci modificate dopo ``since`` (o dopo l'ultimo evento
+        ricevuto, in caso di riconnessione), al massimo un evento ogni
+        ``_EVENT_MIN_INTERVAL_S`` secondi.
+        """
+
+        last_event_id = request.headers.get("last-event-id", "")
+        if last_event_id.isdigit():
+            since = int(last_event_id)
+
+        async def stream() -> AsyncIterator[str]:
+            version = tracker.version if since is None else since
+            while not await request.is_disconnected():
+                if not await tracker.wait_for_change(version, timeout=_KEEPALIVE_S):
+                    yield ": keepalive\n\n"
+                    continue
+                changes = None
+                if version <= tracker.version:
+                    changes = tracker.changed_since(version, _MAX_PAGE_SIZE)
+                version = tracker.version
+                if changes is None:
+                    payload = {"reset": True}
+                else:
+                    payload = {"downloads": [_entry_to_dict(e) for e in changes], "version": version}
+                yield f"id: {version}\ndata: {json.dumps(payload)}\n\n"
+                await asyncio.sleep(_EVENT_MIN_INTERVAL_S)
+
+        return StreamingResponse(
+            stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.post("/api/jobs/{entry_id}/cancel")
+    async def cancel_job(entry_id: int) -> dict:
+        if not (await batch_runner.cancel(entry_id) or await download_queue.cancel(entry_id)):
+            raise HTTPException(status_code=404, detail="Job non attivo")
+        return {"cancelled": entry_id}
+
+    @app.get("/api/limits")
+    async def limits() -> dict:
+        """Stato del limite di richieste per ogni sito contattato (velocità attuale e backoff)."""
+
+        return {"enabled": config.RATE_LIMIT_ENABLED, "hosts": rate_limiter.state()}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics() -> PlainTextResponse:
+        """Metriche in formato testo di Prometheus."""
+
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
     @app.get("/api/logs")
-    async def logs() -> dict:
-        return {"logs": log_buffer.list_logs()}
+    async def logs(
+        request: Request,
+        since: int = 0,
+        limit: int = Query(config.LOG_BUFFER_LIMIT, ge=1),
+        level: Optional[str] = None,
+        logger: Optional[str] = None,
+        job_id: Optional[int] = None,
+    ) -> Response:
+        """
+        Righe di log dalla più recente; con ``since`` solo quelle successive a ``last_seq``.
+        Filtri opzionali: livello minimo (``level=WARNING``), logger (``logger=app.hosts``) e job.
+        """
+
+        levelno = _log_level(level)
+
+        def build() -> dict:
+            # Un ``since`` oltre l'ultima riga viene da un processo precedente: si riparte da zero.
+            start = since if since <= log_buffer.last_seq else 0
+            if levelno or logger or job_id is not None:
+                records = [
+                    (record["seq"], record["line"])
+                    for record in log_buffer.records_since(start, limit, levelno, logger, job_id)
+                ]
+            else:
+                records = log_buffer.logs_since(start, limit)
+            # Le righe arrivano da altri thread: last_seq è l'ultima riga effettivamente inclusa.
+            return {"logs": [line for _, line in records], "last_seq": records[0][0] if records else start}
+
+        return _cached_json(request, _etag(request, log_buffer.last_seq), build)
+
+    @app.get("/api/logs/stream")
+    async def stream_logs(
+        request: Request,
+        tail: int = Query(0, ge=0, le=config.LOG_BUFFER_LIMIT),
+        level: Optional[str] = None,
+        logger: Optional[str] = None,
+        job_id: Optional[int] = None,
+    ) -> StreamingResponse:
+        """
+        Flusso SSE dei log come record strutturati (livello, logger, job, messaggio, riga),
+        dal più vecchio, a partire dalle ultime ``tail`` righe. Accetta gli stessi filtri
+        di ``/api/logs``.
+        """
+
+        levelno = _log_level(level)
+        last_event_id = request.headers.get("last-event-id", "")
+        seq = int(last_event_id) if last_event_id.isdigit() else max(log_buffer.last_seq - tail, 0)
+
+        async def stream() -> AsyncIterator[str]:
+            nonlocal seq
+            idle_s = 0.0
+            while not await request.is_disconnected():
+                latest = log_buffer.last_seq
+                records = log_buffer.records_since(seq, config.LOG_BUFFER_LIMIT, levelno, logger, job_id)
+                seq = max([latest, *(record["seq"] for record in records)])
+                if records:
+                    idle_s = 0.0
+                    yield f"id: {seq}\ndata: {json.dumps({'logs': records[::-1]})}\n\n"
+                elif idle_s >= _KEEPALIVE_S:
+                    idle_s = 0.0
+                    yield ": keepalive\n\n"
+                await asyncio.sleep(_EVENT_MIN_INTERVAL_S)
+                idle_s += _EVENT_MIN_INTERVAL_S
+
+        return StreamingResponse(
+            stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     return app
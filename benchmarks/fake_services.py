@@ -0,0 +1,134 @@
+"""
+Servizi finti per i benchmark: un server HTTP che genera file sintetici e una
+Bot API che accetta gli upload e risponde come Telegram.
+
+Girano in un processo separato, così CPU e memoria dei server non si mescolano
+con quelle del bot misurato.
+"""
+
+import json
+import multiprocessing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from typing import Tuple
+from urllib.parse import parse_qs, urlparse
+
+_CHUNK = 1024 * 1024
+_message_ids = count(1)
+
+
+def synthetic_chunk(video_id: str, size: int) -> bytes:
+    """Blocco che contiene l'id del video: file diversi hanno contenuto diverso."""
+
+    pattern = f"{video_id}:".encode()
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+class _MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        query = parse_qs(urlparse(self.path).query)
+        video_id = query.get("id", ["0"])[0]
+        size = int(query.get("size", ["0"])[0])
+        latency = float(query.get("latency", ["0"])[0])
+        time.sleep(latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        chunk = synthetic_chunk(video_id, _CHUNK)
+        remaining = size
+        while remaining > 0:
+            piece = chunk[: min(_CHUNK, remaining)]
+            self.wfile.write(piece)
+            remaining -= len(piece)
+
+
+class _BotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _drain_body(self) -> int:
+        """Legge e scarta il corpo (anche chunked) senza tenerlo in memoria."""
+
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            total = 0
+            while True:
+                size = int(self.rfile.readline().strip() or b"0", 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return total
+                remaining = size
+                while remaining:
+                    remaining -= len(self.rfile.read(min(_CHUNK, remaining)))
+                self.rfile.readline()
+                total += size
+        remaining = int(self.headers.get("Content-Length", "0"))
+        total = remaining
+        while remaining:
+            data = self.rfile.read(min(_CHUNK, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+        return total
+
+    def _reply(self, result) -> None:
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        size = self._drain_body()
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getMe":
+            self._reply({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+            return
+        message_id = next(_message_ids)
+        message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": 1, "type": "private"}}
+        if method in ("sendVideo", "sendDocument"):
+            kind = "video" if method == "sendVideo" else "document"
+            media = {"file_id": f"bench-{message_id}", "file_unique_id": f"u{message_id}", "file_size": size}
+            if kind == "video":
+                media.update(width=1280, height=720, duration=60)
+            message[kind] = media
+        else:
+            message["text"] = "ok"
+        self._reply(message)
+
+    do_GET = do_POST
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Il backlog di default (5) fa rifiutare connessioni quando arrivano molti job insieme.
+    request_queue_size = 256
+
+
+def _serve(ports: "multiprocessing.Queue[Tuple[int, int]]") -> None:
+    media = _Server(("127.0.0.1", 0), _MediaHandler)
+    bot_api = _Server(("127.0.0.1", 0), _BotApiHandler)
+    threading.Thread(target=bot_api.serve_forever, daemon=True).start()
+    ports.put((media.server_address[1], bot_api.server_address[1]))
+    media.serve_forever()
+
+
+def start_services() -> Tuple[multiprocessing.Process, int, int]:
+    """Avvia i server in un processo figlio; restituisce processo, porta media e porta Bot API."""
+
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    process = context.Process(target=_serve, args=(ports,), name="bench-services", daemon=True)
+    process.start()
+    media_port, bot_api_port = ports.get(timeout=30)
+    return process, media_port, bot_api_port
@@ -0,0 +1,325 @@
+"""
+Benchmark delle modalità di merge video+audio (``MERGE_MODE``).
+
+Genera con ffmpeg una traccia video e una audio della dimensione richiesta, le
+serve da un server HTTP locale e le scarica con il vero yt-dlp tramite
+``downloader.download_video``, una volta per modalità. Per ogni modalità misura:
+
+- i byte scritti verso il disco (``write_bytes`` di ``/proc/self/io``, che
+  include i processi ffmpeg figli; le scritture su tmpfs non vengono contate);
+- il picco di spazio occupato in ``DOWNLOAD_DIR`` e nella cartella temporanea;
+- il tempo totale e quello del merge.
+
+Esempi (dalla cartella del progetto, con ffmpeg nel PATH):
+
+    python -m benchmarks.merge_bench --size-mb 4096 --output merge.json
+    python -m benchmarks.merge_bench --size-mb 512 --modes default,ffmpeg
+
+Serve spazio libero per circa tre volte ``--size-mb`` nella cartella di lavoro e,
+per la modalità ``tmpfs``, RAM libera per il doppio in ``--tmpfs-dir``. Solo Linux.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .pipeline_bench import git_commit
+
+MODES = ("default", "ffmpeg", "tempdir", "tmpfs")
+
+_CLIP_S = 10
+_AUDIO_KBPS = 160
+_SAMPLE_INTERVAL_S = 0.1
+
+
+def run_ffmpeg(*args: str) -> None:
+    subprocess.run(["ffmpeg", "-nostdin", "-v", "error", "-y", *args], check=True)
+
+
+def generate_sources(directory: Path, size_mb: float) -> Tuple[Path, Path, float]:
+    """Crea ``video.mp4`` (solo video) e ``audio.m4a`` (solo audio) di circa ``size_mb``."""
+
+    clip = directory / "clip.mp4"
+    run_ffmpeg(
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={_CLIP_S}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "40M", str(clip),
+    )
+    # Ripete la clip senza ricodificarla fino alla dimensione voluta.
+    loops = max(1, math.ceil(size_mb * 1024 * 1024 / clip.stat().st_size))
+    duration = loops * _CLIP_S
+    video = directory / "video.mp4"
+    run_ffmpeg(
+        "-stream_loop", str(loops - 1), "-i", str(clip),
+        "-c", "copy", "-movflags", "+faststart", str(video),
+    )
+    clip.unlink()
+    audio = directory / "audio.m4a"
+    run_ffmpeg(
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:a", "aac", "-b:a", f"{_AUDIO_KBPS}k", "-movflags", "+faststart", str(audio),
+    )
+    return video, audio, float(duration)
+
+
+class _RangeHandler(SimpleHTTPRequestHandler):
+    """File statici con il supporto minimo alle richieste ``Range`` usate da ffmpeg."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def send_head(self):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return None
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        ranged = self.headers.get("Range", "").startswith("bytes=")
+        if ranged:
+            first, _, last = self.headers["Range"][6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+        handle = path.open("rb")
+        handle.seek(start)
+        self.send_response(206 if ranged else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if ranged:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        return _LimitedReader(handle, end - start + 1)
+
+
+class _LimitedReader:
+    def __init__(self, handle, remaining: int) -> None:
+        self._handle = handle
+        self._remaining = remaining
+
+    def read(self, size: int = -1) -> bytes:
+        if self._remaining <= 0:
+            return b""
+        size = self._remaining if size < 0 else min(size, self._remaining)
+        data = self._handle.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        self._handle.close()
+
+
+def start_media_server(directory: Path) -> Tuple[ThreadingHTTPServer, int]:
+    handler = lambda *args: _RangeHandler(*args, directory=str(directory))  # noqa: E731
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def media_info(base_url: str, video: Path, audio: Path, duration: float) -> dict:
+    """Metadati come quelli di ``extract_info`` per un video con tracce separate."""
+
+    video_size = video.stat().st_size
+    audio_size = audio.stat().st_size
+    formats = [
+        {
+            "format_id": "audio",
+            "url": f"{base_url}/{audio.name}",
+            "ext": "m4a",
+            "protocol": "http",
+            "vcodec": "none",
+            "acodec": "mp4a.40.2",
+            "filesize": audio_size,
+            "abr": audio_size * 8 / duration / 1000,
+        },
+        {
+            "format_id": "video",
+            "url": f"{base_url}/{video.name}",
+            "ext": "mp4",
+            "protocol": "http",
+            "vcodec": "avc1.640028",
+            "acodec": "none",
+            "width": 1920,
+            "height": 1080,
+            "filesize": video_size,
+            "vbr": video_size * 8 / duration / 1000,
+        },
+    ]
+    return {
+        "id": "merge-bench",
+        "title": "merge-bench",
+        "extractor": "generic",
+        "extractor_key": "Generic",
+        "webpage_url": base_url,
+        "duration": duration,
+        "formats": formats,
+        "requested_formats": [formats[1], formats[0]],
+    }
+
+
+def disk_writes() -> Dict[str, int]:
+    """Contatori di I/O del processo, compresi i figli già terminati (ffmpeg)."""
+
+    counters = {}
+    with open("/proc/self/io") as handle:
+        for line in handle:
+            key, _, value = line.partition(":")
+            counters[key] = int(value)
+    return counters
+
+
+def directory_usage(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class UsageSampler:
+    """Campiona in un thread lo spazio occupato dalle cartelle e ne tiene il massimo."""
+
+    def __init__(self, paths: Dict[str, Path]) -> None:
+        self.peaks = {name: 0 for name in paths}
+        self._paths = paths
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "UsageSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            for name, path in self._paths.items():
+                self.peaks[name] = max(self.peaks[name], directory_usage(path))
+            if self._stop.wait(_SAMPLE_INTERVAL_S):
+                return
+
+
+def run_mode(mode: str, info: dict, work_dir: Path, tmpfs_dir: Path) -> dict:
+    from app import config, downloader
+
+    download_dir = work_dir / f"downloads-{mode}"
+    download_dir.mkdir()
+    temp_dir = download_dir / ".cache" / "tmp"
+    config.MERGE_MODE = "tempdir" if mode == "tmpfs" else mode
+    config.MERGE_TEMP_DIR = ""
+    if mode == "tmpfs":
+        temp_dir = Path(tempfile.mkdtemp(prefix="tgdl-merge-", dir=tmpfs_dir))
+        config.MERGE_TEMP_DIR = str(temp_dir)
+
+    os.sync()
+    before = disk_writes()
+    started = time.monotonic()
+    try:
+        with UsageSampler({"download_dir": download_dir, "temp_dir": temp_dir}) as sampler:
+            outcome = downloader.download_video(info["webpage_url"], str(download_dir), info=info)
+        elapsed = time.monotonic() - started
+        after = disk_writes()
+        if outcome.path is None:
+            raise RuntimeError(f"download fallito in modalità {mode}")
+        return {
+            "wall_time_s": elapsed,
+            "postprocess_s": outcome.postprocess_s,
+            "output_mb": outcome.path.stat().st_size / (1024 * 1024),
+            "disk_write_mb": (after["write_bytes"] - before["write_bytes"]) / (1024 * 1024),
+            "cancelled_write_mb": (after["cancelled_write_bytes"] - before["cancelled_write_bytes"])
+            / (1024 * 1024),
+            "peak_download_dir_mb": sampler.peaks["download_dir"] / (1024 * 1024),
+            "peak_temp_dir_mb": sampler.peaks["temp_dir"] / (1024 * 1024),
+        }
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+        if mode == "tmpfs":
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=2048, help="dimensione della traccia video")
+    parser.add_argument("--modes", default=",".join(MODES), help="modalità da misurare, separate da virgola")
+    parser.add_argument("--tmpfs-dir", type=Path, default=Path("/dev/shm"), help="tmpfs per la modalità tmpfs")
+    parser.add_argument("--work-dir", type=Path, help="cartella di lavoro su disco (default: temporanea)")
+    parser.add_argument("--output", type=Path, help="file JSON dei risultati (default: stdout)")
+    args = parser.parse_args(argv)
+    args.modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"modalità sconosciute: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    if not shutil.which("ffmpeg"):
+        raise SystemExit("ffmpeg non trovato nel PATH")
+    if not os.path.exists("/proc/self/io"):
+        raise SystemExit("/proc/self/io non disponibile: il benchmark funziona solo su Linux")
+
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix="tgdl-merge-bench-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    sources = work_dir / "sources"
+    sources.mkdir(exist_ok=True)
+    server = None
+    try:
+        video, audio, duration = generate_sources(sources, args.size_mb)
+        server, port = start_media_server(sources)
+        info = media_info(f"http://127.0.0.1:{port}", video, audio, duration)
+        parameters = {
+            "video_mb": video.stat().st_size / (1024 * 1024),
+            "audio_mb": audio.stat().st_size / (1024 * 1024),
+            "duration_s": duration,
+            "modes": args.modes,
+        }
+        results = {}
+        for mode in args.modes:
+            if mode == "tmpfs" and not args.tmpfs_dir.is_dir():
+                results[mode] = {"skipped": f"{args.tmpfs_dir} non esiste"}
+                continue
+            results[mode] = run_mode(mode, info, work_dir, args.tmpfs_dir)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(sources, ignore_errors=True)
+
+    report = {
+        "parameters": parameters,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
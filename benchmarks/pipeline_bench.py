@@ -0,0 +1,354 @@
+"""
+Benchmark end-to-end della pipeline dei download, senza YouTube né Telegram.
+
+``DownloadQueue`` gira con la sua configurazione reale (pipeline, cache, coda
+persistente, upload in streaming verso la Bot API self-hosted); cambiano solo
+le estremità: ``YoutubeDL`` è sostituito da ``StubYoutubeDL`` e la Bot API e i
+file da scaricare sono serviti da ``fake_services`` in un processo separato.
+
+Esempi (dalla cartella del progetto):
+
+    python -m benchmarks.pipeline_bench --workload small-clips --output small.json
+    python -m benchmarks.pipeline_bench --workload large-merges --output merges.json
+    python -m benchmarks.pipeline_bench --jobs 50 --users 5 --size-mb 20 --output custom.json
+    python -m benchmarks.pipeline_bench --broker sqlite --cluster-workers 2 --output cluster.json
+    python -m benchmarks.pipeline_bench --broker redis --broker-url redis://127.0.0.1:6379/0
+
+Con ``--broker`` questo processo fa da front end (``APP_ROLE = "frontend"``) e
+avvia ``--cluster-workers`` worker in processi separati, collegati dal broker
+scelto e con ``DOWNLOAD_DIR`` condivisa. Per Redis serve un server raggiungibile.
+
+Il JSON prodotto contiene parametri, commit e risultati, così due esecuzioni si
+possono confrontare direttamente.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .fake_services import start_services
+from .stub_ytdlp import StubYoutubeDL, bench_url
+
+WORKLOADS: Dict[str, dict] = {
+    "small-clips": {"jobs": 200, "users": 10, "size_mb": 2, "merge": False, "extract_s": 0.05, "latency_s": 0.02},
+    "large-merges": {"jobs": 5, "users": 1, "size_mb": 1536, "merge": True, "extract_s": 0.5, "latency_s": 0.1},
+}
+
+TERMINAL_STATUSES = {
+    "inviato",
+    "inviato come documento",
+    "scaricato",
+    "troppo grande",
+    "errore",
+    "annullato",
+    "non confermato",
+}
+
+_LAG_INTERVAL_S = 0.05
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Percentile con il metodo nearest-rank."""
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summary(values: List[float]) -> dict:
+    return {
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss è in KB su Linux e in byte su macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoopLagMonitor:
+    """Misura di quanto il loop asyncio ritarda un ``sleep`` breve."""
+
+    def __init__(self) -> None:
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(_LAG_INTERVAL_S)
+            self.samples.append(max(loop.time() - started - _LAG_INTERVAL_S, 0.0))
+
+
+def configure_app(args: argparse.Namespace, download_dir: Path, bot_api_port: int) -> None:
+    """Imposta ``app.config`` prima che gli altri moduli dell'app vengano importati."""
+
+    from app import config
+
+    config.DOWNLOAD_DIR = str(download_dir)
+    config.TELEGRAM_BOT_API_ENABLED = True
+    config.TELEGRAM_BOT_API_LOCAL_MODE = False
+    config.TELEGRAM_BOT_API_BASE_URL = f"http://127.0.0.1:{bot_api_port}/bot"
+    config.DELETE_AFTER_SEND = True
+    config.EXECUTION_BACKEND = "thread"
+    config.EXTRACT_WORKERS = args.extract_workers
+    config.DOWNLOAD_WORKERS = args.download_workers
+    config.UPLOAD_WORKERS = args.upload_workers
+    # I servizi finti sono locali: il limite di richieste misurerebbe solo le attese.
+    config.RATE_LIMIT_ENABLED = False
+    if args.broker:
+        config.APP_ROLE = args.role
+        config.BROKER_URL = args.broker_url
+        config.CLUSTER_SHARED_STORAGE = True
+        config.CLUSTER_POLL_INTERVAL_S = 0.05
+
+
+def broker_url(args: argparse.Namespace, download_dir: Path) -> str:
+    if args.broker_url:
+        return args.broker_url
+    if args.broker == "redis":
+        return "redis://127.0.0.1:6379/0"
+    return f"sqlite:///{download_dir / '.cache' / 'broker.sqlite3'}"
+
+
+def start_cluster_workers(
+    args: argparse.Namespace, download_dir: Path, media_port: int, bot_api_port: int
+) -> List[subprocess.Popen]:
+    """Avvia i worker del cluster, ognuno con la propria ``DownloadQueue``."""
+
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.pipeline_bench",
+        "--role",
+        "worker",
+        "--broker",
+        args.broker,
+        "--broker-url",
+        args.broker_url,
+        "--download-dir",
+        str(download_dir),
+        "--media-port",
+        str(media_port),
+        "--bot-api-port",
+        str(bot_api_port),
+        "--extract-workers",
+        str(args.extract_workers),
+        "--download-workers",
+        str(args.download_workers),
+        "--upload-workers",
+        str(args.upload_workers),
+    ]
+    return [subprocess.Popen(command + ["--node-id", f"bench-{index}"]) for index in range(args.cluster_workers)]
+
+
+def run_cluster_worker(args: argparse.Namespace) -> None:
+    """Processo worker avviato da ``start_cluster_workers``: gira finché non viene terminato."""
+
+    configure_app(args, args.download_dir, args.bot_api_port)
+    from app import config, downloader
+    from app.main import run_worker
+
+    config.CLUSTER_NODE_ID = args.node_id
+    downloader.YoutubeDL = StubYoutubeDL
+    StubYoutubeDL.media_base_url = f"http://127.0.0.1:{args.media_port}"
+    asyncio.run(run_worker())
+
+
+async def run_workload(args: argparse.Namespace, bot_api_port: int) -> dict:
+    from telegram import Bot
+
+    from app.download_queue import DownloadJob, download_queue
+    from app.job_store import job_store
+    from app.status_tracker import tracker
+    from app.uploader import local_api_uploader
+
+    bot = Bot("123456:bench", base_url=f"http://127.0.0.1:{bot_api_port}/bot")
+    await bot.initialize()
+    frontend = None
+    if args.broker:
+        from app.broker import create_broker
+        from app.cluster import ClusterFrontend
+
+        frontend = ClusterFrontend(create_broker(args.broker_url))
+        download_queue.attach_frontend(frontend)
+        await frontend.start()
+    lag = LoopLagMonitor()
+    lag.start()
+
+    started = time.monotonic()
+    enqueued_at: Dict[int, float] = {}
+    for index in range(args.jobs):
+        user_id = index % args.users
+        url = bench_url(f"{args.run_id}-{index}", args.size_mb, args.merge, args.extract_s, args.latency_s)
+        entry_id = await tracker.add(url=url, user_id=user_id, username=None, status="in coda")
+        enqueued_at[entry_id] = time.monotonic()
+        job = DownloadJob(entry_id=entry_id, url=url, chat_id=1, user_id=user_id, username=None)
+        job.status_message_id = 1
+        await download_queue.enqueue(job, bot)
+
+    finished_at: Dict[int, float] = {}
+    statuses: Dict[str, int] = {}
+    version = 0
+    deadline = started + args.timeout_s
+    while len(finished_at) < len(enqueued_at) and time.monotonic() < deadline:
+        await tracker.wait_for_change(version, timeout=1.0)
+        changes = tracker.changed_since(version, limit=len(enqueued_at) * 1000) or []
+        version = tracker.version
+        now = time.monotonic()
+        for entry in changes:
+            if entry.id in enqueued_at and entry.id not in finished_at and entry.status in TERMINAL_STATUSES:
+                finished_at[entry.id] = now
+                statuses[entry.status] = statuses.get(entry.status, 0) + 1
+    elapsed = time.monotonic() - started
+    lag.stop()
+
+    # Chiude i worker e le modifiche dei messaggi in volo prima di spegnere il client HTTP.
+    workers = list(download_queue._worker_tasks)
+    if frontend is not None:
+        workers.extend(frontend._tasks)
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, *download_queue._edit_tasks.values(), return_exceptions=True)
+    await local_api_uploader.close()
+    await bot.shutdown()
+    job_store.close()
+
+    latencies = [finished_at[entry_id] - enqueued_at[entry_id] for entry_id in finished_at]
+    return {
+        "completed_jobs": len(finished_at),
+        "timed_out_jobs": len(enqueued_at) - len(finished_at),
+        "statuses": statuses,
+        "wall_time_s": elapsed,
+        "jobs_per_s": len(finished_at) / elapsed if elapsed else None,
+        "throughput_mb_per_s": len(finished_at) * args.size_mb / elapsed if elapsed else None,
+        "latency_s": summary(latencies),
+        "event_loop_lag_s": summary(lag.samples),
+        "peak_rss_mb": peak_rss_mb(),
+        "job_store": job_store.stats(),
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="small-clips")
+    parser.add_argument("--jobs", type=int, help="numero di job (sovrascrive il workload)")
+    parser.add_argument("--users", type=int, help="utenti tra cui distribuire i job")
+    parser.add_argument("--size-mb", type=float, help="dimensione di ogni video")
+    parser.add_argument("--merge", action=argparse.BooleanOptionalAction, default=None, help="video+audio da unire")
+    parser.add_argument("--extract-s", type=float, help="latenza simulata di extract_info")
+    parser.add_argument("--latency-s", type=float, help="latenza del server media prima del primo byte")
+    parser.add_argument("--extract-workers", type=int, default=2)
+    parser.add_argument("--download-workers", type=int, default=2)
+    parser.add_argument("--upload-workers", type=int, default=2)
+    parser.add_argument("--timeout-s", type=float, default=3600)
+    parser.add_argument("--download-dir", type=Path, help="cartella di lavoro (default: temporanea)")
+    parser.add_argument("--output", type=Path, help="file JSON dei risultati (default: stdout)")
+    parser.add_argument("--broker", choices=["sqlite", "redis"], help="front end e worker separati dal broker")
+    parser.add_argument("--broker-url", default="", help="BROKER_URL (default: SQLite nella cartella di lavoro)")
+    parser.add_argument("--cluster-workers", type=int, default=1, help="processi worker con --broker")
+    # Usati solo dai processi worker avviati con --broker.
+    parser.add_argument("--role", default="frontend", help=argparse.SUPPRESS)
+    parser.add_argument("--node-id", default="", help=argparse.SUPPRESS)
+    parser.add_argument("--media-port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--bot-api-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    for key, value in WORKLOADS[args.workload].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    args.run_id = str(int(time.time()))
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    if args.role == "worker":
+        run_cluster_worker(args)
+        return
+    services, media_port, bot_api_port = start_services()
+    download_dir = args.download_dir or Path(tempfile.mkdtemp(prefix="tgdl-bench-"))
+    cluster_workers: List[subprocess.Popen] = []
+    try:
+        if args.broker:
+            args.broker_url = broker_url(args, download_dir)
+            cluster_workers = start_cluster_workers(args, download_dir, media_port, bot_api_port)
+        configure_app(args, download_dir, bot_api_port)
+        from app import downloader
+
+        downloader.YoutubeDL = StubYoutubeDL
+        StubYoutubeDL.media_base_url = f"http://127.0.0.1:{media_port}"
+        results = asyncio.run(run_workload(args, bot_api_port))
+    finally:
+        for process in cluster_workers:
+            process.terminate()
+            process.wait(timeout=10)
+        services.terminate()
+        if args.download_dir is None:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+    report = {
+        "workload": args.workload,
+        "parameters": {
+            key: getattr(args, key)
+            for key in (
+                "jobs",
+                "users",
+                "size_mb",
+                "merge",
+                "extract_s",
+                "latency_s",
+                "extract_workers",
+                "download_workers",
+                "upload_workers",
+                "broker",
+                "cluster_workers",
+            )
+        },
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Benchmark dell'avvio: tempo di import e memoria di base di ``app.main``, e costo del
+primo job, quando yt-dlp viene caricato e deve riconoscere i link.
+
+Ogni misura gira in un processo Python nuovo, ripetuta ``--runs`` volte (si riporta
+la mediana). Il primo job è simulato senza rete: ``warm_up`` crea ``YoutubeDL`` e gli
+estrattori registrati vengono confrontati con alcuni link, come fa ``extract_info``
+prima di contattare il sito. Lo scenario ``all`` usa tutti gli estrattori, lo scenario
+``allowlist`` solo quelli di ``--extractors`` (vedi ``YTDLP_EXTRACTORS``).
+
+Esempi (dalla cartella del progetto):
+
+    python -m benchmarks.startup_bench --output startup.json
+    python -m benchmarks.startup_bench --runs 10 --extractors "youtube.*,generic"
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .pipeline_bench import git_commit, peak_rss_mb
+
+SAMPLE_URLS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.instagram.com/reel/C0abcdefghi/",
+    "https://example.com/video.mp4",
+]
+
+
+def child(extractors: List[str]) -> dict:
+    """Misure dentro il processo nuovo; il risultato va su stdout come JSON."""
+
+    started = time.perf_counter()
+    import app.main  # noqa: F401
+
+    import_s = time.perf_counter() - started
+    import_rss_mb = peak_rss_mb()
+    ytdlp_loaded = "yt_dlp" in sys.modules
+
+    from app import config, downloader
+
+    config.YTDLP_EXTRACTORS = extractors
+    started = time.perf_counter()
+    downloader.warm_up()
+    with downloader._youtube_dl({"quiet": True}) as ydl:
+        extractors_loaded = len(ydl._ies)
+        matched = [
+            next((ie.IE_NAME for ie in ydl._ies.values() if ie.suitable(url)), None) for url in SAMPLE_URLS
+        ]
+    return {
+        "import_s": import_s,
+        "import_rss_mb": import_rss_mb,
+        "ytdlp_loaded_at_import": ytdlp_loaded,
+        "first_job_s": time.perf_counter() - started,
+        "first_job_rss_mb": peak_rss_mb(),
+        "extractors": extractors_loaded,
+        "matched": matched,
+    }
+
+
+def run_child(extractors: List[str]) -> dict:
+    command = [sys.executable, "-m", "benchmarks.startup_bench", "--child", ",".join(extractors)]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def slowest_imports(count: int) -> List[dict]:
+    """Moduli con il tempo di import cumulativo più alto (``python -X importtime``)."""
+
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"], capture_output=True, text=True, check=True
+    ).stderr
+    modules = []
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        modules.append({"module": parts[2].strip(), "cumulative_s": int(parts[1]) / 1e6})
+    return sorted(modules, key=lambda module: module["cumulative_s"], reverse=True)[:count]
+
+
+def scenario(extractors: List[str], runs: int) -> dict:
+    samples = [run_child(extractors) for _ in range(runs)]
+    result: Dict[str, object] = {
+        key: statistics.median(sample[key] for sample in samples)
+        for key in ("import_s", "import_rss_mb", "first_job_s", "first_job_rss_mb")
+    }
+    result.update(
+        ytdlp_loaded_at_import=any(sample["ytdlp_loaded_at_import"] for sample in samples),
+        extractors=samples[0]["extractors"],
+        matched=dict(zip(SAMPLE_URLS, samples[0]["matched"])),
+    )
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="processi per scenario")
+    parser.add_argument(
+        "--extractors",
+        default="youtube.*,instagram.*,tiktok.*,twitter,generic",
+        help="estrattori dello scenario allowlist, separati da virgole",
+    )
+    parser.add_argument("--output", type=Path, help="file JSON dei risultati (default: stdout)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    if args.child is not None:
+        print(json.dumps(child([name for name in args.child.split(",") if name])))
+        return
+
+    allowlist = [name for name in args.extractors.split(",") if name]
+    report = {
+        "parameters": {"runs": args.runs, "extractors": allowlist},
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": {
+            "all": scenario([], args.runs),
+            "allowlist": scenario(allowlist, args.runs),
+            "slowest_imports": slowest_imports(10),
+        },
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+``YoutubeDL`` finto per i benchmark.
+
+Riconosce URL del tipo ``https://bench.invalid/watch/<id>?size_mb=..&merge=1&extract_s=..&latency_s=..``
+e scarica dati sintetici dal server di ``fake_services``, chiamando gli stessi hook
+di avanzamento e di post-processing del vero yt-dlp. Con ``merge=1`` scarica una
+traccia video e una audio e poi le unisce copiando i byte, come farebbe il merge
+di ffmpeg con ``-c copy``.
+"""
+
+import shutil
+import time
+import urllib.request
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+_CHUNK = 1024 * 1024
+
+
+def bench_url(video_id: str, size_mb: float, merge: bool, extract_s: float, latency_s: float) -> str:
+    return (
+        f"https://bench.invalid/watch/{video_id}?size_mb={size_mb}&merge={int(merge)}"
+        f"&extract_s={extract_s}&latency_s={latency_s}"
+    )
+
+
+class StubYoutubeDL:
+    media_base_url = "http://127.0.0.1:0"
+
+    def __init__(self, params: Optional[dict] = None) -> None:
+        self.params = params or {}
+
+    def __enter__(self) -> "StubYoutubeDL":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+    def extract_info(self, url: str, download: bool = False) -> dict:
+        parsed = urlparse(url)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        time.sleep(float(query.get("extract_s", 0)))
+        video_id = parsed.path.rsplit("/", 1)[-1]
+        size = int(float(query.get("size_mb", 1)) * 1024 * 1024)
+        info = {
+            "id": video_id,
+            "extractor_key": "Bench",
+            "title": f"bench-{video_id}",
+            "ext": "mp4",
+            "webpage_url": url,
+            "latency_s": float(query.get("latency_s", 0)),
+        }
+        if query.get("merge") == "1":
+            video_size = size * 9 // 10
+            info["requested_formats"] = [
+                {"format_id": "video", "filesize": video_size, "ext": "mp4"},
+                {"format_id": "audio", "filesize": size - video_size, "ext": "m4a"},
+            ]
+        else:
+            info["filesize"] = size
+        return info
+
+    @staticmethod
+    def sanitize_info(info: dict) -> dict:
+        return info
+
+    def prepare_filename(self, info: dict) -> str:
+        template = self.params.get("outtmpl", "%(title).80s.%(ext)s")
+        return template.replace("%(title).80s", info["title"][:80]).replace("%(ext)s", info["ext"])
+
+    def process_ie_result(self, info: dict, download: bool = True) -> dict:
+        path = Path(self.prepare_filename(info))
+        formats = info.get("requested_formats") or [
+            {"format_id": "single", "filesize": info["filesize"]}
+        ]
+        parts = []
+        for fmt in formats:
+            part = path.with_name(f"{path.stem}.f{fmt['format_id']}.{info['ext']}")
+            self._fetch(info, fmt, part)
+            parts.append(part)
+
+        if len(parts) == 1:
+            parts[0].replace(path)
+        else:
+            self._postprocessor_hook("started")
+            with path.open("wb") as output:
+                for part in parts:
+                    with part.open("rb") as source:
+                        shutil.copyfileobj(source, output, _CHUNK)
+                    part.unlink()
+            self._postprocessor_hook("finished")
+        return dict(info, requested_downloads=[{"filepath": str(path)}])
+
+    def _fetch(self, info: dict, fmt: dict, target: Path) -> None:
+        size = fmt["filesize"]
+        url = (
+            f"{self.media_base_url}/media?id={info['id']}-{fmt['format_id']}"
+            f"&size={size}&latency={info['latency_s']}"
+        )
+        started = time.monotonic()
+        done = 0
+        with urllib.request.urlopen(url) as response, target.open("wb") as output:
+            while True:
+                chunk = response.read(_CHUNK)
+                if not chunk:
+                    break
+                output.write(chunk)
+                done += len(chunk)
+                elapsed = max(time.monotonic() - started, 1e-6)
+                self._progress_hook(
+                    {
+                        "status": "downloading",
+                        "downloaded_bytes": done,
+                        "total_bytes": size,
+                        "speed": done / elapsed,
+                        "eta": (size - done) / (done / elapsed),
+                    }
+                )
+        self._progress_hook({"status": "finished", "downloaded_bytes": done, "total_bytes": size})
+
+    def _progress_hook(self, data: dict) -> None:
+        for hook in self.params.get("progress_hooks", []):
+            hook(data)
+
+    def _postprocessor_hook(self, status: str) -> None:
+        for hook in self.params.get("postprocessor_hooks", []):
+            hook({"status": status, "postprocessor": "Merger"})
@@ -0,0 +1,199 @@
+"""
+Benchmark della ricezione degli update in modalità webhook, senza Telegram.
+
+Un client finto fa la parte di Telegram: manda a raffiche update di testo al
+webhook della web GUI (lo stesso server uvicorn e lo stesso loop del bot) con il
+segreto corretto, e verifica che una richiesta senza segreto venga rifiutata.
+Il bot usa i suoi veri handler; le risposte vanno alla Bot API finta di
+``fake_services``. ``--reply-latency-s`` simula il tempo di andata e ritorno verso
+Telegram di ogni risposta, che è ciò che ``BOT_CONCURRENT_UPDATES`` sovrappone.
+
+Esempi (dalla cartella del progetto):
+
+    python -m benchmarks.webhook_bench --updates 500 --burst 50 --output webhook.json
+    python -m benchmarks.webhook_bench --concurrent-updates 1 --reply-latency-s 0.05
+
+Misura la latenza della risposta HTTP al client (quanto Telegram resta in attesa)
+e quella end-to-end, dall'invio dell'update alla fine dei suoi handler.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import socket
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .fake_services import start_services
+from .pipeline_bench import git_commit, peak_rss_mb, summary
+
+_SECRET = "bench-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure_app(args: argparse.Namespace, bot_api_port: int) -> None:
+    """Imposta ``app.config`` prima che gli altri moduli dell'app vengano importati."""
+
+    from app import config
+
+    config.BOT_TOKEN = "123456:bench"
+    config.TELEGRAM_BOT_API_ENABLED = True
+    config.TELEGRAM_BOT_API_LOCAL_MODE = False
+    config.TELEGRAM_BOT_API_BASE_URL = f"http://127.0.0.1:{bot_api_port}/bot"
+    config.TELEGRAM_WEBHOOK_ENABLED = True
+    config.BOT_CONCURRENT_UPDATES = args.concurrent_updates
+    config.ALLOWED_USER_IDS = list(range(1, args.users + 1))
+    config.DURABLE_QUEUE_ENABLED = False
+
+
+def fake_update(update_id: int, user_id: int) -> dict:
+    """Messaggio di testo senza link: il bot risponde con un messaggio e non scarica nulla."""
+
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"utente {user_id}"},
+            "text": "ciao",
+        },
+    }
+
+
+async def run_workload(args: argparse.Namespace) -> dict:
+    import httpx
+    import uvicorn
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    from app.main import build_application
+    from app.web import create_web_app
+
+    application = build_application()
+    sent_at: Dict[int, float] = {}
+    handled_at: Dict[int, float] = {}
+
+    async def simulate_latency(update: Update, context) -> None:
+        await asyncio.sleep(args.reply_latency_s)
+
+    async def record(update: Update, context) -> None:
+        handled_at[update.update_id] = time.monotonic()
+
+    # Prima degli handler del bot la latenza simulata, dopo la registrazione del tempo.
+    application.add_handler(TypeHandler(Update, simulate_latency), group=-1)
+    application.add_handler(TypeHandler(Update, record), group=1)
+
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_web_app(application, _SECRET),
+            host="127.0.0.1",
+            port=port,
+            log_level="warning",
+            access_log=False,
+        )
+    )
+    serving = asyncio.create_task(server.serve())
+    await application.initialize()
+    await application.start()
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    from app import config
+
+    url = f"http://127.0.0.1:{port}{config.TELEGRAM_WEBHOOK_PATH}"
+    ack_latencies: List[float] = []
+    limits = httpx.Limits(max_connections=args.burst, max_keepalive_connections=args.burst)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        rejected = await client.post(url, json=fake_update(0, 1))
+
+        async def deliver(update_id: int) -> None:
+            sent_at[update_id] = time.monotonic()
+            response = await client.post(
+                url,
+                json=fake_update(update_id, update_id % args.users + 1),
+                headers={"X-Telegram-Bot-Api-Secret-Token": _SECRET},
+            )
+            response.raise_for_status()
+            ack_latencies.append(time.monotonic() - sent_at[update_id])
+
+        started = time.monotonic()
+        for first in range(1, args.updates + 1, args.burst):
+            last = min(first + args.burst, args.updates + 1)
+            await asyncio.gather(*(deliver(update_id) for update_id in range(first, last)))
+            if args.burst_interval_s:
+                await asyncio.sleep(args.burst_interval_s)
+        deadline = time.monotonic() + args.timeout_s
+        while len(handled_at) < len(sent_at) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.monotonic() - started
+
+    await application.stop()
+    await application.shutdown()
+    server.should_exit = True
+    await serving
+
+    latencies = [handled_at[update_id] - sent_at[update_id] for update_id in handled_at]
+    return {
+        "rejected_without_secret": rejected.status_code == 403,
+        "handled_updates": len(handled_at),
+        "lost_updates": len(sent_at) - len(handled_at),
+        "wall_time_s": elapsed,
+        "updates_per_s": len(handled_at) / elapsed if elapsed else None,
+        "ack_latency_s": summary(ack_latencies),
+        "end_to_end_latency_s": summary(latencies),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=500, help="update da inviare in totale")
+    parser.add_argument("--burst", type=int, default=50, help="update inviati insieme")
+    parser.add_argument("--burst-interval-s", type=float, default=0.0, help="pausa tra due raffiche")
+    parser.add_argument("--users", type=int, default=10, help="utenti tra cui distribuire gli update")
+    parser.add_argument("--concurrent-updates", type=int, default=16, help="valore di BOT_CONCURRENT_UPDATES")
+    parser.add_argument("--reply-latency-s", type=float, default=0.02, help="latenza simulata verso Telegram")
+    parser.add_argument("--timeout-s", type=float, default=300)
+    parser.add_argument("--output", type=Path, help="file JSON dei risultati (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    services, _, bot_api_port = start_services()
+    try:
+        configure_app(args, bot_api_port)
+        results = asyncio.run(run_workload(args))
+    finally:
+        services.terminate()
+
+    report = {
+        "parameters": {
+            key: getattr(args, key)
+            for key in ("updates", "burst", "burst_interval_s", "users", "concurrent_updates", "reply_latency_s")
+        },
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()